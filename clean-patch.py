@@ -56,13 +56,19 @@ If a tag is found on the commit, then that tag is also CC's - so you should
 have all tags defined in your config file.
 '''
 
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
+import hashlib
+import multiprocessing
 import os
+import pickle
 import re
 import shutil
+import StringIO
 import subprocess
 import sys
 import tempfile
+import time
 import unittest
 
 
@@ -88,7 +94,42 @@ re_copyright = re.compile('\+ \* Copyright \(c\) 2011, Google Inc. '
 
 re_commit = re.compile('commit (.*)')
 
-re_space_before_tab = re.compile('^[+].* \t')
+# Any character which is not 7-bit ASCII
+re_non_ascii = re.compile('[\x80-\xff]')
+
+# The kinds of line which PatchStream.ProcessLine() handles specially: each
+# has a name, the characters it can start with and its regex
+line_kinds = [
+    ['prog', 'BTCR', re_prog],
+    ['cover', 'C', re_cover],
+    ['series', 'S', re_series],
+    ['tag', 'TAS', re_tag],
+    ['copyright', '+', re_copyright],
+    ['commit', 'c', re_commit],
+]
+
+def MakeLineDispatch(kinds):
+    """Build a table of the regex to use for each first character of a line
+
+    For each character, the regexes of the kinds of line which can start with
+    it are combined into one, with a named group for each kind. A line only
+    needs to be matched once, and then match.lastgroup gives its kind.
+
+    Args:
+        kinds: List of [name, first characters, regex]
+
+    Returns:
+        Dictionary: key is the first character, value is the combined regex
+    """
+    patterns = {}
+    for name, chars, regex in kinds:
+        for ch in chars:
+            patterns.setdefault(ch, []).append('(?P<%s>%s)' %
+                                               (name, regex.pattern))
+    return dict((ch, re.compile('|'.join(pats)))
+                for ch, pats in patterns.iteritems())
+
+line_dispatch = MakeLineDispatch(line_kinds)
 
 valid_series = ['to', 'cc', 'version', 'changes', 'prefix', 'notes'];
 
@@ -255,7 +296,7 @@ STATE_PATCH_HEADER = 2      # In patch header (after the subject)
 STATE_DIFFS = 3             # In the diff part (past --- line)
 
 class PatchStream:
-    def __init__(self, series={}, name=None, is_log=False):
+    def __init__(self, series={}, name=None, is_log=False, collect=None):
         self.skip_blank = False          # True to skip a single blank line
         self.found_test = False          # Found a TEST= line
         self.lines_after_test = 0        # MNumber of lines found after TEST=
@@ -267,6 +308,9 @@ class PatchStream:
         self.section = []                # The current section...END section
         self.series = series             # Info about the patch series
         self.is_log = is_log             # True if indent like git log
+        if collect is None:
+            collect = is_log
+        self.collect = collect           # True to add Series- tags to series
         self.in_change = 0               # Non-zero if we are in a change list
         self.changes = {}                # List of changelogs
         self.blank_count = 0             # Number of blank lines stored up
@@ -275,6 +319,8 @@ class PatchStream:
         self.signoff = None              # Contents of signoff line
         self.commits = []                # List of commits found
         self.commit = None               # Current commit
+        self.check_ascii = True          # Look for non-ASCII characters
+        self.check_space_before_tab = True  # Look for space before tab
 
         # Set up 'cc' which must a list
         if not self.series.get('cc'):
@@ -282,19 +328,21 @@ class PatchStream:
 
     def AddToSeries(self, line, name, value):
         if name == 'notes':
+            # The notes are in the section which follows; see Finalize()
             self.in_section = name
             self.skip_blank = False
+            return
         if name in self.series:
             values = value.split(',')
             values = [str.strip() for str in values]
-            if self.is_log:
+            if self.collect:
                 if type(self.series[name]) != type([]):
                     raise ValueError("In %s: line '%s': Cannot add another value "
                             "'%s' to series '%s'" %
                                 (self.commit.hash, line, values, self.series[name]))
                 self.series[name] += values
         elif name in valid_series:
-            if self.is_log:
+            if self.collect:
                 self.series[name] = value
         elif not self.is_log:
             raise ValueError("In %s: line '%s': Unknown 'Series-%s': valid "
@@ -320,9 +368,18 @@ class PatchStream:
         if self.is_log:
             if line[:4] == '    ':
                 line = line[4:]
-        series_match = re_series.match(line)
-        commit_match = re_commit.match(line) if self.is_log else None
-        tag_match = re_tag.match(line) if self.state == STATE_PATCH_HEADER else None
+
+        # Most lines cannot match any of our patterns, so look up the first
+        # character to see which regex (if any) we need to try
+        kind = None
+        regex = line_dispatch.get(line[:1])
+        if regex:
+            match = regex.match(line)
+            if match:
+                kind = match.lastgroup
+                if ((kind == 'tag' and self.state != STATE_PATCH_HEADER) or
+                        (kind == 'commit' and not self.is_log)):
+                    kind = None
         is_blank = not line.strip()
         if is_blank:
             if (self.state == STATE_MSG_HEADER
@@ -333,18 +390,18 @@ class PatchStream:
             # It has its own line with a Subject: tag
             if not self.is_log and self.state == STATE_PATCH_SUBJECT:
                 self.state += 1
-        elif commit_match:
+        elif kind == 'commit':
             self.state = STATE_MSG_HEADER
 
         if not is_blank and self.state == STATE_PATCH_SUBJECT:
             self.commit.subject = line
-        elif re_prog.match(line):
+        elif kind == 'prog':
             self.skip_blank = True
             if line.startswith('TEST='):
                 self.found_test = True
         elif self.skip_blank and is_blank:
             self.skip_blank = False
-        elif re_cover.match(line):
+        elif kind == 'cover':
             self.in_section = 'cover'
             self.skip_blank = False
         elif self.in_section:
@@ -367,11 +424,12 @@ class PatchStream:
             else:
                 self.changes[self.in_change].append(line)
             self.skip_blank = False
-        elif re_copyright.match(line):
+        elif kind == 'copyright':
             out = ['+ * Copyright (c) 2011 The Chromium OS Authors.']
             self.warn.append("Changed copyright from '%s'" % line)
             self.skip_blank = False
-        elif series_match:
+        elif kind == 'series':
+            series_match = re_series.match(line)
             name = series_match.group(1)
             value = series_match.group(2)
             if name == 'changes':
@@ -383,10 +441,11 @@ class PatchStream:
             else:
                 self.AddToSeries(line, name, value)
                 self.skip_blank = True
-        elif commit_match:
+        elif kind == 'commit':
             self.CloseCommit()
-            self.commit = Commit(commit_match.group(1)[:7])
-        elif tag_match:
+            self.commit = Commit(re_commit.match(line).group(1)[:7])
+        elif kind == 'tag':
+            tag_match = re_tag.match(line)
             if tag_match.group(1) == 'Signed-off-by':
                 if self.signoff:
                     self.warn.append('Patch has more than one Signed-off-by '
@@ -399,18 +458,17 @@ class PatchStream:
             else:
                 self.tags.append(line)
         else:
-            pos = 1
             # TODO: Would be nicer to report source filename and line
-            for ch in line:
-                if ord(ch) > 0x80:
+            if self.check_ascii:
+                for m in re_non_ascii.finditer(line):
                     self.warn.append('Line %d/%d has funny ascii character' %
-                        (self.linenum, pos))
-                pos += 1
+                        (self.linenum, m.start() + 1))
 
-            m = re_space_before_tab.match(line)
-            if m:
-                self.warn.append('Line %d/%d has space before tab' %
-                    (self.linenum, m.start()))
+            if self.check_space_before_tab and line[:1] == '+':
+                pos = line.find(' \t')
+                if pos != -1:
+                    self.warn.append('Line %d/%d has space before tab' %
+                        (self.linenum, pos + 1))
 
             out = [line]
             self.linenum += 1
@@ -439,7 +497,7 @@ class PatchStream:
         if self.cover:
             self.series['cover'] = self.cover
         if self.notes:
-            self.series['notes'] = self.notes
+            self.series['notes'] = self.series.get('notes', []) + self.notes
         if self.commits:
             self.series['commits'] = self.commits
 
@@ -447,22 +505,29 @@ class PatchStream:
         """Copy a stream from infd to outfd, filtering out unwanting things.
 
         Args:
-            infd: Input stream
+            infd: Input stream, or list of lines
             outfd: Output stream"""
 
+        if not isinstance(infd, list):
+            infd = infd.readlines()
+
+        # Check the whole input at once for things which we warn about, so
+        # that ProcessLine() only needs to look for them if they are present
+        data = ''.join(infd)
+        self.check_ascii = re_non_ascii.search(data) is not None
+        self.check_space_before_tab = ' \t' in data
+
         # Extract the filename from each diff, for nice warnings
         fname = None
         last_fname = None
         re_fname = re.compile('diff --git a/(.*) b/.*')
-        while True:
-            line = infd.readline()
-            if not line:
-                break
+        output = []
+        for line in infd:
             out = self.ProcessLine(line)
             for line in out:
                 # Swallow blank lines at end of file;
                 # git format-patch 1.7.3.1 creates these for unknown reasons.
-                match = re_fname.match(line)
+                match = line.startswith('diff --git') and re_fname.match(line)
                 if match:
                     last_fname = fname
                     fname = match.group(1)
@@ -472,66 +537,70 @@ class PatchStream:
                     if self.blank_count and (line == '-- ' or match):
                         self.warn.append("Found possible blank lines at "
                                 "end of file '%s'" % last_fname)
-                    outfd.write('+\n' * self.blank_count)
-                    outfd.write(line + '\n')
+                    output.append('+\n' * self.blank_count)
+                    output.append(line + '\n')
                     self.blank_count = 0
+        outfd.write(''.join(output))
         self.Finalize()
 
 
-def GetMetaData(start, count):
-    """Reads out patch series metadata from the commits
+# The 'From' line which starts each message in 'git format-patch --stdout'
+re_mbox_from = re.compile('^From ([0-9a-f]{40}) Mon Sep 17 00:00:00 2001$')
+
+def SplitMessages(infd):
+    """Split the output of 'git format-patch --stdout' into messages
 
     Args:
-        start: Commit to start from: 0=HEAD, 1=next one, etc.
-        count: Number of commits to list
+        infd: Input stream
+
+    Returns:
+        Generator yielding the list of lines in each message, starting with
+        its 'From <hash>' line
     """
-    cmd = Command()
-    pipe = [['git', 'log', '--reverse', 'HEAD~%d' % start, '-n%d' % count]]
-    stdout = cmd.RunPipe(pipe, capture=True)
-    ps = PatchStream(is_log=True)
-    for line in stdout.splitlines():
-        ps.ProcessLine(line)
-    ps.Finalize()
-    return ps.series, ps.changes
-
-def FixPatch(backup_dir, fname, series, name, commit):
-    """Fix up a patch file, putting a backup in back_dir (if not None).
-
-    Returns a list of errors, or [] if all ok."""
-    handle, tmpname = tempfile.mkstemp()
-    outfd = os.fdopen(handle, 'w')
-    infd = open(fname, 'r')
-    ps = PatchStream(series, name)
-    ps.commit = commit
-    ps.ProcessStream(infd, outfd, fname)
-    infd.close()
-    outfd.close()
-
-    # Create a backup file if required
-    if backup_dir:
-        shutil.copy(fname, os.path.join(backup_dir, os.path.basename(fname)))
-    shutil.move(tmpname, fname)
-    return ps.warn
-
-def FixPatches(series, fnames):
-    """Fix up a list of patches identified by filename
-    TODO: Tidy this up by integrating properly with checkpatch
+    lines = []
+    for line in infd:
+        if re_mbox_from.match(line) and lines:
+            yield lines
+            lines = []
+        lines.append(line)
+    if lines:
+        yield lines
+
+def GetSubject(lines):
+    """Get the commit subject from the headers of a message
+
+    Args:
+        lines: Lines of the message
+
+    Returns:
+        Subject, without the '[PATCH n/m]' prefix, or None if none
     """
-    backup_dir = tempfile.mkdtemp('clean-patch')
-    count = 0
-#    series = {}
-    for fname in fnames:
-        commit = series['commits'][count]
-        commit.patch = fname
-        result = FixPatch(backup_dir, fname, series, 'patch %d' % count, commit)
-        if result:
-            print '%d warnings for %s:' % (len(result), fname)
-            for warn in result:
-                print '\t', warn
-            print
-        count += 1
-    print 'Cleaned %d patches' % count
-    return series
+    subject = None
+    for line in lines:
+        if not line.strip():
+            break
+        if line.startswith('Subject:'):
+            subject = re_subject_prefix.sub('', line.rstrip('\n'))
+        elif subject is not None and line[0] in ' \t':
+            subject += line.rstrip('\n')
+        elif subject is not None:
+            break
+    return subject
+
+def GetPatchFilename(num, subject):
+    """Work out the filename for a patch, in the same way as git format-patch
+
+    Args:
+        num: Patch number, starting at 1
+        subject: Commit subject
+
+    Returns:
+        Filename, e.g. '0001-Add-more-clock-support.patch'
+    """
+    name = re.sub('[^A-Za-z0-9._]+', '-', subject or '').strip('-')
+    name = re.sub('\.\.+', '.', name)
+    name = name[:52].rstrip('.-')
+    return '%04d-%s.patch' % (num, name)
 
 def GetPatchPrefix(series):
     # Get version string
@@ -545,33 +614,71 @@ def GetPatchPrefix(series):
         prefix = '%s ' % series['prefix']
     return '%sPATCH%s' % (prefix, version)
 
-def CreatePatches(start, count, series):
-    """Create a series of patches from the top of the current branch.
+def CreatePatches(start, count):
+    """Create a series of cleaned-up patches from the top of the current branch
+
+    The output of 'git format-patch --stdout' is read once. Each message goes
+    through a PatchStream, which collects the series information, change lists
+    and commits while cleaning up the patch. Each patch file, and the cover
+    letter if the series has one, is then written once.
 
     Args:
         start: Commit to start from: 0=HEAD, 1=next one, etc.
         count: number of commits to include
+
     Returns:
-        Filename of cover letter
+        Series dictionary
+        Change list, dictionary keyed by version 1, 2, 3
+        Filename of cover letter, or None if none
         List of filenames of patch files"""
-    if series.get('version'):
-        version = '%s ' % series['version']
-    cmd = ['git', 'format-patch', '--signoff']
-    if series.get('cover'):
-        cmd.append('--cover-letter')
-    prefix = GetPatchPrefix(series)
-    if prefix:
-        cmd += ['--subject-prefix=%s' % prefix]
-    cmd += ['HEAD~%d..HEAD~%d' % (start + count, start)]
-
+    cmd = ['git', 'format-patch', '--stdout', '--signoff', '--cover-letter',
+           'HEAD~%d..HEAD~%d' % (start + count, start)]
     pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    stdout, stderr = pipe.communicate()
-    files = stdout.splitlines()
-    #print '%d files' % len(files)
+    series = {'commits': []}
+    changes = {}
+    messages = SplitMessages(pipe.stdout)
+
+    # The cover letter comes first; we fill it in once we have the series
+    cover = next(messages, [])
+    patches = []
+    for lines in messages:
+        commit = Commit(re_mbox_from.match(lines[0]).group(1)[:7])
+        commit.subject = GetSubject(lines)
+        commit.patch = GetPatchFilename(len(patches) + 1, commit.subject)
+        ps = PatchStream(series, collect=True)
+        ps.commit = commit
+        outfd = StringIO.StringIO()
+        ps.ProcessStream(lines, outfd)
+        series['commits'].append(commit)
+        for version, items in ps.changes.iteritems():
+            changes.setdefault(version, []).extend(items)
+        if ps.warn:
+            print '%d warnings for %s:' % (len(ps.warn), commit.patch)
+            for warn in ps.warn:
+                print '\t', warn
+            print
+        patches.append(outfd.getvalue())
+    pipe.wait()
+
+    # Now that we know the version and prefix, write out the files
+    prefix = GetPatchPrefix(series)
+    args = []
+    for commit, data in zip(series['commits'], patches):
+        # git numbers a lone patch only because we asked for a cover letter
+        if len(patches) == 1 and not series.get('cover'):
+            data = data.replace('Subject: [PATCH 1/1]', 'Subject: [PATCH]', 1)
+        with open(commit.patch, 'w') as fd:
+            fd.write(data.replace('Subject: [PATCH', 'Subject: [%s' % prefix,
+                                  1))
+        args.append(commit.patch)
+    print 'Cleaned %d patches' % len(args)
+
+    cover_fname = None
     if series.get('cover'):
-       return files[0], files[1:]
-    else:
-       return None, files
+        cover_fname = '0000-cover-letter.patch'
+        with open(cover_fname, 'w') as fd:
+            fd.writelines(FixCoverLetter(cover, series, changes, count))
+    return series, changes, cover_fname, args
 
 def FindCheckPatch():
     path = os.getcwd()
@@ -584,9 +691,126 @@ def FindCheckPatch():
     print 'Could not find checkpatch.pl'
     return None
 
-def CheckPatch(verbose, fname):
+# Patch header lines which change each time a series is created
+re_volatile = re.compile('^(From [0-9a-f]{40} |Date:|Message-I[dD]:)')
+
+# The subject prefix, e.g. '[PATCH v2 3/7] '
+re_subject_prefix = re.compile('^Subject: \[[^]]*\] *')
+
+# Data files read by checkpatch.pl from its own directory
+CHECKPATCH_DATA = ['spelling.txt', 'const_structs.checkpatch']
+
+# Directories which checkpatch.pl searches for .checkpatch.conf
+CHECKPATCH_CONF_DIRS = ['.', '~', '.scripts']
+CHECKPATCH_CONF = '.checkpatch.conf'
+
+# Cache of file hashes: key is (filename, mtime), value is SHA1 hex digest
+file_hashes = {}
+
+def GetFileHash(fname):
+    '''Get the SHA1 hash of a file, reading it only once per run
+
+    Args:
+        fname: Filename to hash
+
+    Returns:
+        SHA1 hex digest of the file contents
+    '''
+    key = (fname, os.path.getmtime(fname))
+    if key not in file_hashes:
+        with open(fname, 'rb') as fd:
+            file_hashes[key] = hashlib.sha1(fd.read()).hexdigest()
+    return file_hashes[key]
+
+def GetCheckPatchKey(chk, fname):
+    '''Work out the cache key for the checkpatch.pl result for a patch
+
+    This covers checkpatch.pl itself, the data files and configuration it reads
+    and the patch. Header lines which change
+    each time the patch is created (the commit hash, date, Message-Id and
+    subject prefix) are left out, so an unchanged patch has the same key in
+    each version of a series.
+
+    Args:
+        chk: Path to checkpatch.pl
+        fname: Patch file
+
+    Returns:
+        Key, as a hex string
+    '''
+    sha = hashlib.sha1(GetFileHash(chk))
+    dirname = os.path.dirname(chk)
+    paths = [os.path.join(dirname, name) for name in CHECKPATCH_DATA]
+    paths += [os.path.expanduser(os.path.join(conf_dir, CHECKPATCH_CONF))
+              for conf_dir in CHECKPATCH_CONF_DIRS]
+    for path in paths:
+        if os.path.isfile(path):
+            sha.update('%s %s\n' % (path, GetFileHash(path)))
+    in_header = True
+    with open(fname) as fd:
+        for line in fd:
+            if in_header:
+                if not line.strip():
+                    in_header = False
+                elif re_volatile.match(line):
+                    continue
+                else:
+                    line = re_subject_prefix.sub('Subject: ', line)
+            sha.update(line)
+    return sha.hexdigest()
+
+def ReadCheckCache(cache_dir, key):
+    '''Read a checkpatch.pl result from the cache
+
+    Args:
+        cache_dir: Cache directory
+        key: Key, as returned by GetCheckPatchKey()
+
+    Returns:
+        Result tuple as returned by CheckPatch(), or None if not cached
+    '''
+    try:
+        with open(os.path.join(cache_dir, key), 'rb') as fd:
+            return pickle.load(fd)
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+
+def WriteCheckCache(cache_dir, key, result):
+    '''Write a checkpatch.pl result to the cache
+
+    The file is written under a temporary name and then renamed, so that
+    readers never see a partial result. The cache is only an optimisation, so
+    failures (e.g. a read-only or full filesystem) are ignored.
+
+    Args:
+        cache_dir: Cache directory
+        key: Key, as returned by GetCheckPatchKey()
+        result: Result tuple as returned by CheckPatch()
+    '''
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass    # Another thread created it
+    tmpname = None
+    try:
+        handle, tmpname = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(handle, 'wb') as fd:
+            pickle.dump(result, fd, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, os.path.join(cache_dir, key))
+    except (IOError, OSError):
+        if tmpname and os.path.exists(tmpname):
+            os.remove(tmpname)
+
+def CheckPatch(verbose, fname, cache_dir=None):
     '''Run checkpatch.pl on a file.
 
+    Args:
+        verbose: Print out checkpatch.pl output verbatim
+        fname: Patch file to check
+        cache_dir: Directory to cache results in, or None to always run
+            checkpatch.pl
+
     Returns:
         4-tuple containing:
             result: None = checkpatch broken, False=failure, True=ok
@@ -601,6 +825,14 @@ def CheckPatch(verbose, fname):
     problems = []
     chk = FindCheckPatch()
     item = {}
+    if chk and cache_dir:
+        key = GetCheckPatchKey(chk, fname)
+        cached = ReadCheckCache(cache_dir, key)
+        if cached:
+            if verbose:
+                for line in cached[-1].splitlines():
+                    print line
+            return cached
     if chk:
         cmd = [chk, fname]
         pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE)
@@ -643,6 +875,9 @@ def CheckPatch(verbose, fname):
                 # Record it and start the next one
                 problems.append(item)
                 item = {}
+        if cache_dir and result is not None:
+            WriteCheckCache(cache_dir, key, (result, problems, error_count,
+                    warning_count, lines, stdout))
     return result, problems, error_count, warning_count, lines, stdout
 
 def GetWarningMsg(msg_type, fname, line, msg):
@@ -660,26 +895,51 @@ def GetWarningMsg(msg_type, fname, line, msg):
         msg_type = col.Color(col.RED, msg_type)
     return '%s: %s,%d: %s' % (msg_type, fname, line, msg)
 
-def CheckPatches(verbose, args):
-    '''Run the checkpatch.pl script on each patch'''
+def CheckPatches(verbose, args, jobs=1, cache_dir=None):
+    '''Run the checkpatch.pl script on each patch
+
+    Up to 'jobs' patches are checked at once. The results are still shown
+    in series order, as each one becomes available.
+
+    Args:
+        verbose: Print out checkpatch.pl output verbatim
+        args: List of patch files to check
+        jobs: Maximum number of checkpatch.pl processes to run at once
+        cache_dir: Directory to cache results in, or None to always run
+            checkpatch.pl
+
+    Returns:
+        True if there were no errors or warnings, else False
+    '''
     error_count = 0
     warning_count = 0
     col = Color()
 
-    for fname in args:
-        ok, problems, errors, warnings, lines, stdout = CheckPatch(verbose,
-                    fname)
-        if not ok:
-            error_count += errors
-            warning_count += warnings
-            print '%d errors, %d warnings for %s:' % (errors,
-                    warnings, fname)
-            if len(problems) != error_count + warning_count:
-                print "Internal error: some problems lost"
-            for item in problems:
-                print GetWarningMsg(item['type'], item['file'], item['line'],
-                        item['msg'])
-            #print stdout
+    pool = ThreadPool(max(1, min(jobs, len(args))))
+    try:
+        results = pool.imap(lambda fname: CheckPatch(False, fname, cache_dir),
+                            args)
+        for upto, result in enumerate(results):
+            fname = args[upto]
+            ok, problems, errors, warnings, lines, stdout = result
+            if verbose:
+                for line in stdout.splitlines():
+                    print line
+            if not ok:
+                error_count += errors
+                warning_count += warnings
+                print '%d errors, %d warnings for %s:' % (errors,
+                        warnings, fname)
+                if len(problems) != errors + warnings:
+                    print "Internal error: some problems lost"
+                for item in problems:
+                    print GetWarningMsg(item['type'], item['file'],
+                            item['line'], item['msg'])
+                #print stdout
+    finally:
+        # All results are in by now, unless a worker raised an exception
+        pool.terminate()
+        pool.join()
     if error_count != 0 or warning_count != 0:
         str = 'checkpatch.pl found %d error(s), %d warning(s)' % (
             error_count, warning_count)
@@ -692,12 +952,24 @@ def CheckPatches(verbose, args):
         return False
     return True
 
-def ApplyPatch(verbose, fname):
-    '''Apply a patch with git am to test it
+def ApplyPatch(verbose, fname, env=None, top=None):
+    '''Apply a patch to the index with git apply, to test it
+
+    Args:
+        verbose: Print out 'git apply' output verbatim
+        fname: Patch file to apply
+        env: Environment for git, which selects the index to use
+        top: Top directory of the tree, or None for the current directory.
+            git apply skips files outside the directory it is run in
+
+    Returns:
+        2-tuple containing:
+            True if the patch applied, else False
+            Output from git apply
     '''
-    cmd = ['git', 'am', fname]
+    cmd = ['git', 'apply', '--cached', os.path.abspath(fname)]
     pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
+            stderr=subprocess.PIPE, env=env, cwd=top)
     stdout, stderr = pipe.communicate()
     re_error = re.compile('^error: patch failed: (.+):(\d+)')
     for line in stderr.splitlines():
@@ -710,10 +982,14 @@ def ApplyPatch(verbose, fname):
     return pipe.returncode == 0, stdout
 
 def ApplyPatches(verbose, args, start_point):
-    """Apply the patches with git am to make sure all is well
+    """Apply the patches with git apply to make sure all is well
+
+    The patches are applied to a temporary index which starts with the
+    commit before the series, so the working tree, the index and HEAD are
+    not touched.
 
     Args:
-        verbose: Print out 'git am' output verbatim
+        verbose: Print out 'git apply' output verbatim
         args: List of patch files to apply
         start_point: Number of commits back from HEAD to start applying.
             Normally this is len(args), but it can be larger if a start
@@ -722,65 +998,60 @@ def ApplyPatches(verbose, args, start_point):
     error_count = 0
     col = Color()
 
-    cmd = ['git', 'name-rev', 'HEAD', '--name-only']
-    pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    stdout, stderr = pipe.communicate()
-    if pipe.returncode:
-        str = 'Could not find current commit name'
-        print col.Color(col.RED, str)
-        print stdout
-        return False
-    old_head = stdout.splitlines()[0]
-
-    cmd = ['git', 'checkout', 'HEAD~%d' % start_point]
+    cmd = ['git', 'rev-parse', '--verify', 'HEAD~%d^{commit}' % start_point]
     pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE,
             stderr=subprocess.PIPE)
     stdout, stderr = pipe.communicate()
     if pipe.returncode:
-        str = 'Could not move to commit before patch series'
+        str = 'Could not find commit before patch series'
         print col.Color(col.RED, str)
         print stdout, stderr
         return False
+    base = stdout.strip()
+    top = subprocess.Popen(['git', 'rev-parse', '--show-toplevel'],
+            stdout=subprocess.PIPE).communicate()[0].strip()
 
-    for fname in args:
-        ok, stdout = ApplyPatch(verbose, fname)
-        if not ok:
-            print col.Color(col.RED, 'git am returned errors for %s: will '
-                    'skip this patch' % fname)
-            if verbose:
-                print stdout
-            error_count += 1
-            cmd = ['git', 'am', '--skip']
-            pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-            stdout, stderr = pipe.communicate()
-            if pipe.returncode != 0:
-                print col.Color(col.RED, 'Unable to skip patch! Aborting...')
-                print stdout
-                break
-
-    cmd = ['git', 'checkout', old_head]
-    pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = pipe.communicate()
-    if pipe.returncode:
-        print col.Color(col.RED, 'Could not move back to head commit')
-        print stdout, stderr
+    tmpdir = tempfile.mkdtemp('clean-patch')
+    env = dict(os.environ)
+    env['GIT_INDEX_FILE'] = os.path.join(tmpdir, 'index')
+    try:
+        cmd = ['git', 'read-tree', base]
+        pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, env=env)
+        stdout, stderr = pipe.communicate()
+        if pipe.returncode:
+            str = 'Could not read commit before patch series'
+            print col.Color(col.RED, str)
+            print stdout, stderr
+            return False
+
+        for fname in args:
+            ok, stdout = ApplyPatch(verbose, fname, env, top)
+            if not ok:
+                # The index is unchanged, so this patch is skipped
+                print col.Color(col.RED, 'git apply returned errors for %s: '
+                        'will skip this patch' % fname)
+                if verbose:
+                    print stdout
+                error_count += 1
+    finally:
+        shutil.rmtree(tmpdir)
     return error_count == 0
 
-def InsertCoverLetter(fname, series, changes, count):
-    """Creates a cover letter with the required info
+def FixCoverLetter(lines, series, changes, count):
+    """Fill in a cover letter with the required info
 
     Args:
-        fname: Output filename
+        lines: Lines of the cover letter created by git format-patch
         series: Series dictionary, containing element 'cover'
         changes: Change list, dictionary keyed by version 1, 2, 3;
                 each item is an unsorted list of changes, one per line
         count: Number of patches in the series
-    """
-    fd = open(fname, 'r')
-    lines = fd.readlines()
-    fd.close()
 
-    fd = open(fname, 'w')
+    Returns:
+        List of lines of the filled-in cover letter
+    """
+    out = []
     text = series['cover']
     prefix = GetPatchPrefix(series)
     for line in lines:
@@ -793,10 +1064,9 @@ def InsertCoverLetter(fname, series, changes, count):
                 line += '\n'.join(series['notes']) + '\n'
 
             # Now the change list
-            out = MakeChangeLog(changes)
-            line += '\n' + '\n'.join(out)
-        fd.write(line)
-    fd.close()
+            line += '\n' + '\n'.join(MakeChangeLog(changes))
+        out.append(line)
+    return out
 
 def LookupEmail(name):
     """If an email address is an alias, look it up and return the full name
@@ -897,6 +1167,98 @@ def CountCommitsToBranch():
     patch_count =int(stdout)
     return patch_count
 
+def MakeSyntheticSeries(count):
+    """Create a synthetic patch series, as from 'git format-patch --stdout'
+
+    Each patch has the Chrome OS tags which are removed, Series- tags, a
+    change list and a diff of about 200 lines. A few lines have non-ASCII
+    characters or a space before a tab, so the warnings are exercised too.
+
+    Args:
+        count: Number of patches to create
+
+    Returns:
+        List of lines, each ending in a newline
+    """
+    lines = []
+    for num in range(1, count + 1):
+        sha = '%040x' % (0x1234567 * num)
+        lines += [
+            'From %s Mon Sep 17 00:00:00 2001' % sha,
+            'From: Simon Glass <sjg@chromium.org>',
+            'Date: Thu, 28 Apr 2011 09:58:51 -0700',
+            'Subject: [PATCH %d/%d] bench: Add feature %d' % (num, count, num),
+            '',
+            'This adds feature %d, which does something useful with the' % num,
+            'board. It is needed by later patches in this series.',
+            '',
+            'BUG=chromium-os:%d' % num,
+            'TEST=build U-Boot for Seaboard, boot',
+            '',
+            'Change-Id: I%s' % sha,
+            '',
+            'Review URL: http://codereview.chromium.org/%d' % num,
+            '',
+        ]
+        if num == 1:
+            lines += ['Series-version: 2', 'Series-prefix: RFC', '']
+        lines += [
+            'Series-cc: Person %d <person%d@example.com>' % (num, num),
+            'Series-changes: 2',
+            '- Tidy up feature %d' % num,
+            '',
+            'Signed-off-by: Simon Glass <sjg@chromium.org>',
+            'Acked-by: Someone Else <someone@example.com>',
+            '---',
+            ' common/feature%d.c | 190 ++++++++++++++++++++' % num,
+            ' 1 files changed, 190 insertions(+), 0 deletions(-)',
+            ' create mode 100644 common/feature%d.c' % num,
+            '',
+            'diff --git a/common/feature%d.c b/common/feature%d.c' % (num, num),
+            'new file mode 100644',
+            'index 0000000..%s' % sha[:7],
+            '--- /dev/null',
+            '+++ b/common/feature%d.c' % num,
+            '@@ -0,0 +1,190 @@',
+            '+/*',
+            '+ * Copyright (c) 2011 The Chromium OS Authors.',
+            '+ */',
+        ]
+        for upto in range(187):
+            if upto % 50 == 0:
+                lines.append('+/* Caf\xc3\xa9 %d */' % upto)
+            elif upto % 70 == 0:
+                lines.append('+int var%d; \t/* space before tab */' % upto)
+            elif upto % 3 == 0:
+                lines.append('+')
+            else:
+                lines.append('+\tvalue = read_reg(%d) & mask; /* step %d */' %
+                             (upto, upto))
+        lines += ['-- ', '1.7.3.1', '']
+    return [line + '\n' for line in lines]
+
+def RunBench(count):
+    """Time PatchStream over a synthetic series of patches
+
+    Args:
+        count: Number of patches in the series
+
+    Returns:
+        Tuple:
+            Number of lines processed
+            Time taken in seconds
+            Series dictionary collected from the patches
+    """
+    lines = MakeSyntheticSeries(count)
+    series = {'commits': []}
+    start = time.time()
+    for msg in SplitMessages(lines):
+        ps = PatchStream(series, collect=True)
+        ps.commit = Commit(re_mbox_from.match(msg[0]).group(1)[:7])
+        ps.ProcessStream(msg, StringIO.StringIO())
+        series['commits'].append(ps.commit)
+    return len(lines), time.time() - start, series
+
 class TestPatch(unittest.TestCase):
     """Test this silly program"""
 
@@ -939,23 +1301,11 @@ Signed-off-by: Simon Glass <sjg@chromium.org>
  arch/arm/cpu/armv7/tegra2/ap20.c           |   57 ++----
  arch/arm/cpu/armv7/tegra2/clock.c          |  163 +++++++++++++++++
 '''
-        out = ''
-        inhandle, inname = tempfile.mkstemp()
-        infd = os.fdopen(inhandle, 'w')
-        infd.write(data)
-        infd.close()
-
-        exphandle, expname = tempfile.mkstemp()
-        expfd = os.fdopen(exphandle, 'w')
-        expfd.write(expected)
-        expfd.close()
-
-        FixPatch(None, inname)
-        rc = os.system('diff -u %s %s' % (inname, expname))
-        self.assertEqual(rc, 0)
-
-        os.remove(inname)
-        os.remove(expname)
+        ps = PatchStream({})
+        ps.commit = Commit('656c9a8')
+        out = StringIO.StringIO()
+        ps.ProcessStream(data.splitlines(True), out)
+        self.assertEqual(expected, out.getvalue())
 
     def GetData(self, data_type):
         data='''
@@ -1105,6 +1455,280 @@ index 0000000..2234c87
         self.assertEqual(lines, 67)
         os.remove(inname)
 
+    def testCreatePatches(self):
+        """Test creating patches and a cover letter from commits"""
+        cwd = os.getcwd()
+        tmpdir = tempfile.mkdtemp()
+        msgs = [
+            'Initial commit',
+            '''Add the first line
+
+This adds a line.
+
+BUG=chromium-os:1234
+TEST=cat file.c
+
+Series-version: 2
+Series-changes: 2
+- Use a better line
+
+Cover-letter:
+Add some lines
+This series adds some lines to a file.
+END
+''',
+            '''Add the second line
+
+Series-changes: 2
+- Make it longer
+
+Series-notes:
+Some notes on the series
+END
+''']
+        try:
+            os.chdir(tmpdir)
+            subprocess.check_call(['git', 'init', '-q'])
+            subprocess.check_call(['git', 'config', 'user.name', 'Test'])
+            subprocess.check_call(['git', 'config', 'user.email',
+                                   'test@x.org'])
+            for upto, msg in enumerate(msgs):
+                with open('file.c', 'a') as fd:
+                    fd.write('line %d\n' % upto)
+                subprocess.check_call(['git', 'add', 'file.c'])
+                subprocess.check_call(['git', 'commit', '-qm', msg])
+
+            old_stdout = sys.stdout
+            sys.stdout = out = StringIO.StringIO()
+            try:
+                series, changes, cover_fname, args = CreatePatches(0, 2)
+            finally:
+                sys.stdout = old_stdout
+            self.assertIn('Cleaned 2 patches', out.getvalue())
+            self.assertEqual('2', series['version'])
+            self.assertEqual(['Add some lines',
+                              'This series adds some lines to a file.'],
+                             series['cover'])
+            self.assertEqual({2: ['- Use a better line', '- Make it longer']},
+                             changes)
+            self.assertEqual(['Some notes on the series'], series['notes'])
+            self.assertEqual(['0001-Add-the-first-line.patch',
+                              '0002-Add-the-second-line.patch'], args)
+            self.assertEqual(['Add the first line', 'Add the second line'],
+                             [commit.subject for commit in series['commits']])
+            self.assertEqual('0000-cover-letter.patch', cover_fname)
+
+            with open(args[0]) as fd:
+                data = fd.read()
+            self.assertIn('Subject: [PATCH v2 1/2] Add the first line\n', data)
+            self.assertIn('Signed-off-by: Test <test@x.org>\n---\n'
+                          'Changes in v2:\n- Use a better line\n', data)
+            for text in ('BUG=', 'TEST=', 'Series-', 'Cover-letter'):
+                self.assertNotIn(text, data)
+
+            with open(cover_fname) as fd:
+                data = fd.read()
+            self.assertIn('Subject: [PATCH v2 0/2] Add some lines\n', data)
+            self.assertIn('This series adds some lines to a file.\n'
+                          'Some notes on the series\n\n'
+                          'Changes in v2:\n- Use a better line\n'
+                          '- Make it longer\n', data)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
+
+    def testApplyPatches(self):
+        """Test applying patches without touching the checkout"""
+        global col
+        old_col = globals().get('col')
+        cwd = os.getcwd()
+        tmpdir = tempfile.mkdtemp()
+        git = ['git', '-c', 'user.name=Test', '-c', 'user.email=test@x.org']
+        col = Color(False)
+        try:
+            os.chdir(tmpdir)
+            subprocess.check_call(['git', 'init', '-q'])
+            for upto in range(3):
+                with open('file.c', 'a') as fd:
+                    fd.write('line %d\n' % upto)
+                subprocess.check_call(['git', 'add', 'file.c'])
+                subprocess.check_call(git + ['commit', '-qm',
+                                             'Commit %d' % upto])
+            fnames = subprocess.Popen(['git', 'format-patch', 'HEAD~2'],
+                    stdout=subprocess.PIPE).communicate()[0].split()
+            with open('file.c', 'a') as fd:
+                fd.write('local change\n')
+            head = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                    stdout=subprocess.PIPE).communicate()[0]
+
+            old_stdout = sys.stdout
+            sys.stdout = out = StringIO.StringIO()
+            try:
+                self.assertTrue(ApplyPatches(False, fnames, 2))
+
+                # The second patch does not apply on its own
+                self.assertFalse(ApplyPatches(False, fnames[1:], 2))
+
+                # Files outside the current directory are still checked
+                os.mkdir('sub')
+                os.chdir('sub')
+                self.assertFalse(ApplyPatches(False,
+                        [os.path.join('..', fname) for fname in fnames[1:]],
+                        2))
+                os.chdir(tmpdir)
+            finally:
+                sys.stdout = old_stdout
+            self.assertIn('warning: file.c,1: Patch failed\n', out.getvalue())
+            self.assertIn('git apply returned errors for %s' % fnames[1],
+                          out.getvalue())
+
+            # HEAD and the working tree are as they were
+            self.assertEqual(head, subprocess.Popen(['git', 'rev-parse',
+                    'HEAD'], stdout=subprocess.PIPE).communicate()[0])
+            status = subprocess.Popen(['git', 'status', '--short', '-uno'],
+                    stdout=subprocess.PIPE).communicate()[0]
+            self.assertEqual(' M file.c\n', status)
+        finally:
+            col = old_col
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
+
+    def MakeCheckPatch(self, tmpdir, script):
+        """Create a checkpatch.pl script where FindCheckPatch() will find it
+
+        Args:
+            tmpdir: Directory to use as the top of the source tree
+            script: Contents of the script
+        """
+        scripts = os.path.join(tmpdir, 'src', 'third_party', 'kernel', 'files',
+                               'scripts')
+        os.makedirs(scripts)
+        chk = os.path.join(scripts, 'checkpatch.pl')
+        with open(chk, 'w') as fd:
+            fd.write(script)
+        os.chmod(chk, 0755)
+
+    def testCheckPatchCache(self):
+        """Test that unchanged patches are not checked again"""
+        cwd = os.getcwd()
+        tmpdir = tempfile.mkdtemp()
+        self.MakeCheckPatch(tmpdir, '''#!/bin/sh
+echo $1 >>%s/runs
+echo "total: 0 errors, 0 warnings, 10 lines checked"
+echo "$1 has no obvious style problems and is ready for submission."
+''' % tmpdir)
+        patch = '''From %s Mon Sep 17 00:00:00 2001
+From: Simon Glass <sjg@chromium.org>
+Date: %s
+Subject: [PATCH %s] Tegra2: Add more clock support
+
+This adds functions to enable/disable clocks.
+
+Signed-off-by: Simon Glass <sjg@chromium.org>
+'''
+        versions = [
+            ('v1.patch', '1' * 40, 'Thu, 28 Apr 2011 09:58:51 -0700', '3/7'),
+            ('v2.patch', '2' * 40, 'Fri, 29 Apr 2011 10:00:00 -0700',
+             'v2 4/8'),
+            ]
+        cache_dir = os.path.join(tmpdir, 'cache')
+        try:
+            os.chdir(tmpdir)
+            for fname, commit, date, prefix in versions:
+                with open(fname, 'w') as fd:
+                    fd.write(patch % (commit, date, prefix))
+                result = CheckPatch(False, fname, cache_dir)
+                self.assertEqual((True, [], 0, 0, 10), result[:5])
+
+            # A change to the commit message means checking it again
+            with open('v3.patch', 'w') as fd:
+                fd.write((patch % versions[0][1:]).replace('clocks', 'resets'))
+            CheckPatch(False, 'v3.patch', cache_dir)
+            CheckPatch(False, 'v3.patch')
+            with open('runs') as fd:
+                self.assertEqual(['v1.patch\n', 'v3.patch\n', 'v3.patch\n'],
+                                 fd.readlines())
+
+            # So does a change to the checkpatch.pl data files or config
+            chk = FindCheckPatch()
+            key = GetCheckPatchKey(chk, 'v1.patch')
+            spelling = os.path.join(os.path.dirname(chk), 'spelling.txt')
+            with open(spelling, 'w') as fd:
+                fd.write('abandonned||abandoned\n')
+            spelling_key = GetCheckPatchKey(chk, 'v1.patch')
+            self.assertNotEqual(key, spelling_key)
+            with open('.checkpatch.conf', 'w') as fd:
+                fd.write('--no-tree\n')
+            self.assertNotEqual(spelling_key,
+                                GetCheckPatchKey(chk, 'v1.patch'))
+
+            # A cache which cannot be written is ignored
+            result = CheckPatch(False, 'v1.patch',
+                                os.path.join('runs', 'cache'))
+            self.assertEqual((True, [], 0, 0, 10), result[:5])
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
+
+    def testCheckPatchesParallel(self):
+        """Test that checkpatch results are shown in series order"""
+        global col
+        old_col = globals().get('col')
+        cwd = os.getcwd()
+        tmpdir = tempfile.mkdtemp()
+
+        # The first patch takes longest, so finishes last
+        self.MakeCheckPatch(tmpdir, '''#!/bin/sh
+name=$(basename $1)
+[ $name = 0001.patch ] && sleep 0.5
+echo "WARNING: Problem in $name"
+echo "#1: FILE: $name:3:"
+echo "total: 0 errors, 1 warnings, 10 lines checked"
+echo "$1 has style problems, please review."
+''')
+        fnames = ['%04d.patch' % num for num in range(1, 4)]
+        old_stdout = sys.stdout
+        sys.stdout = out = StringIO.StringIO()
+        col = Color(False)
+        try:
+            os.chdir(tmpdir)
+            ok = CheckPatches(False, fnames, 3)
+        finally:
+            col = old_col
+            sys.stdout = old_stdout
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
+        self.assertEqual(False, ok)
+        expected = ''
+        for fname in fnames:
+            expected += ('0 errors, 1 warnings for %s:\n'
+                         'warning: %s,3: Problem in %s\n' %
+                         (fname, fname, fname))
+        expected += Color().Color(Color.YELLOW,
+                'checkpatch.pl found 0 error(s), 3 warning(s)') + '\n'
+        self.assertEqual(expected, out.getvalue())
+
+    def testBench(self):
+        """Check the benchmark runs on a small synthetic series"""
+        lines, elapsed, series = RunBench(10)
+        self.assertEqual(len(MakeSyntheticSeries(10)), lines)
+        self.assertEqual(10, len(series['commits']))
+        self.assertEqual('2', series['version'])
+        self.assertEqual('RFC', series['prefix'])
+        self.assertEqual(['Person %d <person%d@example.com>' % (num, num)
+                          for num in range(1, 11)], series['cc'])
+
+        # Check the warnings for the first patch
+        ps = PatchStream({})
+        ps.commit = Commit('1234567')
+        out = StringIO.StringIO()
+        ps.ProcessStream(MakeSyntheticSeries(1), out)
+        self.assertIn('Line 23/8 has funny ascii character', ps.warn)
+        self.assertIn('Line 93/12 has space before tab', ps.warn)
+        self.assertNotIn('BUG=', out.getvalue())
+        self.assertIn('+ * Copyright (c) 2011 The Chromium OS Authors.\n',
+                      out.getvalue())
+
 def ShowActions(series, args, cmd):
     """Show what actions we will perform"""
     print 'Dry run, so not doing much. But I would do this:'
@@ -1144,16 +1768,28 @@ parser.add_option('-n', '--dry-run', action='store_true', dest='dry_run',
 parser.add_option('-i', '--ignore-errors', action='store_true',
        dest='ignore_errors', default=False,
        help='Send patches email even if patch errors are found')
+parser.add_option('-j', '--jobs', dest='jobs', type='int',
+       default=multiprocessing.cpu_count(),
+       help='Number of checkpatch.pl processes to run at once')
 parser.add_option('-v', '--verbose', action='store_true', dest='verbose',
        default=False, help='Verbose output of errors and warnings')
 parser.add_option('--cc-cmd', dest='cc_cmd', type='string', action='store',
        default=None, help='Output cc list for patch file (used by git)')
+parser.add_option('--no-cache', action='store_false', dest='cache',
+       default=True, help='Run checkpatch.pl on every patch, ignoring '
+       'results cached from earlier runs')
+parser.add_option('-B', '--bench', dest='bench', type='int', default=0,
+       help='Time processing of a synthetic series of BENCH patches')
 
 (options, args) = parser.parse_args()
 
 if options.test:
     sys.argv = [sys.argv[0]]
     unittest.main()
+elif options.bench:
+    lines, elapsed, series = RunBench(options.bench)
+    print 'Processed %d patches (%d lines) in %.2fs: %d lines/sec' % (
+            options.bench, lines, elapsed, lines / elapsed)
 elif options.cc_cmd:
     fd = open(options.cc_cmd, 'r')
     re_line = re.compile('(\S*) (.*)')
@@ -1175,12 +1811,9 @@ else:
         sys.exit(1)
 
     if options.count:
-        # Read the metadata
-        series, changes = GetMetaData(options.start, options.count)
-        cover_fname, args = CreatePatches(options.start, options.count, series)
-    series = FixPatches(series, args)
-    if series and cover_fname and series.get('cover'):
-        InsertCoverLetter(cover_fname, series, changes, options.count)
+        # Create the patches, collecting the series metadata as we go
+        series, changes, cover_fname, args = CreatePatches(options.start,
+                                                           options.count)
 
     # Check that each version has a change log
     if series.get('version'):
@@ -1213,7 +1846,10 @@ else:
         print >>fd, commit.patch, ', '.join(list)
     fd.close()
 
-    ok = CheckPatches(options.verbose, args)
+    cache_dir = None
+    if options.cache:
+        cache_dir = os.path.expanduser('~/.cache/clean-patch')
+    ok = CheckPatches(options.verbose, args, options.jobs, cache_dir)
     if not ApplyPatches(options.verbose, args, options.count + options.start):
         ok = False
     cmd = ''
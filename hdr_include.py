@@ -3,10 +3,32 @@
 # in them
 
 from argparse import ArgumentParser
+import bisect
+import collections
+import contextlib
+import copy
+import ctypes
+import fnmatch
+import functools
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
 import os
+import pickle
+import random
 import re
+import select
+import shutil
+import socket
 import string
+import struct
+import subprocess
 import sys
+import tempfile
+from time import perf_counter
+import traceback
 import unittest
 
 #sys.path.append('/home/sjg/u/tools')
@@ -20,20 +42,667 @@ ASM = '__ASSEMBLY__'
 HOSTCC = 'USE_HOSTCC'
 ALPHANUM = set(string.ascii_lowercase + string.ascii_uppercase + string.digits +
                '_')
+RE_IDENT = re.compile('[A-Za-z_][A-Za-z0-9_]*')
+
+# Value of ignore_fragments meaning that a symbol must be a whole identifier,
+# so 'ARRAY' does not match 'ARRAY_SIZE'
+WHOLE_IDENT = 'whole'
+RE_INCLUDE = re.compile(r'^\s*#\s*include\s*([<"])([^>"]+)[>"]', re.M)
+
+# Include paths used to find headers, as passed to the compiler with -I
+INCLUDE_PATHS = ['include', 'arch/*/include']
 
 def not_supported(msg, line):
     print('%s: %s' % (msg, line))
 
 
-def remove_comment(line):
-    pos = line.find('/*')
-    end = line.find('*/')
-    line = line[:pos] + line[end + 2:]
-    return line
+# Kinds of token produced by lex()
+TOK_DIRECTIVE = 'directive'     # Start of a preprocessor line, e.g. '#ifdef'
+TOK_COMMENT = 'comment'
+TOK_LITERAL = 'literal'         # String, character or number
+TOK_IDENT = 'ident'
+TOK_CONT = 'cont'               # Line continuation (backslash-newline)
+TOK_NEWLINE = 'newline'
+TOK_SPACE = 'space'
+TOK_STRAY = 'stray'             # '*/' outside a comment
+TOK_PUNCT = 'punct'
+
+RE_TOKEN = re.compile(r'''
+    (?P<directive>^[ \t]*\#[ \t]*[A-Za-z_]*) |
+    (?P<comment>/\*(?:.*?\*/|.*\Z)|//[^\n]*) |
+    (?P<literal>"(?:\\.|[^"\\\n])*"?|'(?:\\.|[^'\\\n])*'?|[0-9][A-Za-z0-9_.]*) |
+    (?P<ident>[A-Za-z_][A-Za-z0-9_]*) |
+    (?P<cont>\\\n) |
+    (?P<newline>\n) |
+    (?P<space>[ \t\r\f\v]+) |
+    (?P<stray>\*/) |
+    (?P<punct>.)
+    ''', re.M | re.S | re.X)
+
+Token = collections.namedtuple('Token', 'kind,text,line')
+
+# Line endings, as recognised by str.splitlines()
+RE_LINE_END = re.compile('\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+
+
+class LineInfo:
+    """Information about a line of C source, worked out from its tokens
+
+    Properties:
+        directive: Name of the preprocessor directive on this line (e.g.
+            'ifdef'), or None if none
+        args: List of tokens following the directive name, without comments
+        code: True if the line has something other than comments and
+            whitespace
+        in_comment: True if the line starts inside a comment
+        continued: True if the line continues the previous one (which ended
+            with a backslash)
+    """
+    __slots__ = ('directive', 'args', 'code', 'in_comment', 'continued')
+
+    def __init__(self):
+        self.directive = None
+        self.args = []
+        self.code = False
+        self.in_comment = False
+        self.continued = False
+
+
+def lex(data):
+    """Split C source into tokens in a single pass
+
+    Comments and string literals are recognised properly, including those
+    which contain '/*' or similar.
+
+    Args:
+        data: String containing the source, with lines separated by newline
+            characters
+
+    Returns:
+        List of Token, each with:
+            kind: TOK_... value
+            text: Text of the token
+            line: Line number where the token starts (0 for the first line)
+    """
+    tokens = []
+    linenum = 0
+    prev_kind = None
+    for m in RE_TOKEN.finditer(data):
+        kind = m.lastgroup
+        text = m.group()
+        if kind == TOK_DIRECTIVE and prev_kind == TOK_CONT:
+            kind = TOK_PUNCT    # e.g. '#x' in a multi-line macro
+        tokens.append(Token(kind, text, linenum))
+        if kind in (TOK_NEWLINE, TOK_CONT):
+            linenum += 1
+        elif kind in (TOK_COMMENT, TOK_LITERAL):
+            linenum += text.count('\n')
+        prev_kind = kind
+    return tokens
+
+
+def get_line_info(tokens, num_lines):
+    """Work out information about each line from a token stream
+
+    Args:
+        tokens: List of Token, as returned by lex()
+        num_lines: Number of lines in the source
+
+    Returns:
+        List of LineInfo, one for each line
+    """
+    infos = [LineInfo() for _ in range(num_lines + 1)]
+    directive = None
+    for tok in tokens:
+        kind = tok.kind
+        info = infos[tok.line]
+        if kind == TOK_COMMENT:
+            for linenum in range(tok.line + 1,
+                                 tok.line + tok.text.count('\n') + 1):
+                infos[linenum].in_comment = True
+        elif kind == TOK_DIRECTIVE:
+            info.directive = tok.text.split('#', 1)[1].strip()
+            info.code = True
+            directive = info
+        elif kind == TOK_NEWLINE:
+            directive = None
+        elif kind == TOK_CONT:
+            infos[tok.line + 1].continued = True
+        elif kind != TOK_SPACE:
+            info.code = True
+            if directive:
+                directive.args.append(tok.text)
+    return infos[:num_lines]
+
+
+def get_code(tokens):
+    """Get the code from a token stream, without comments or string contents
+
+    Args:
+        tokens: List of Token, as returned by lex()
+
+    Returns:
+        String containing the code, with each comment replaced by a space and
+        each string or character literal replaced by an empty one
+    """
+    out = []
+    for kind, text, _ in tokens:
+        if kind == TOK_COMMENT:
+            out.append(' ')
+        elif kind == TOK_LITERAL and text[0] in '"\'':
+            out.append(text[0] * 2)
+        else:
+            out.append(text)
+    return ''.join(out)
+
+
+def find_symbol(code, func, whole=False):
+    """Check whether a symbol appears at an identifier boundary
+
+    This will ignore 'PRBUG(' when looking for 'BUG(', for example.
+
+    Args:
+        code: Code to search
+        func: Symbol to search for
+        whole: True if the symbol must also end at an identifier boundary,
+            so that 'ARRAY' does not match 'ARRAY_SIZE'
+
+    Returns:
+        True if found
+    """
+    start = 0
+    while True:
+        pos = code.find(func, start)
+        if pos == -1:
+            return False
+        end = pos + len(func)
+        if ((pos == 0 or code[pos - 1] not in ALPHANUM) and
+                (not whole or end == len(code) or code[end] not in ALPHANUM)):
+            return True
+        start = pos + 1
+
+
+def read_config(fname):
+    """Read the settings from a Kconfig .config file
+
+    Args:
+        fname: Filename to read
+
+    Returns:
+        dict:
+            key: option name (e.g. 'CONFIG_DM')
+            value: value as a string (e.g. 'y' or '0x1000'), with quotes
+                removed from strings
+    """
+    config = {}
+    with open(fname) as fd:
+        for line in fd:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            name, value = line.split('=', 1)
+            if value.startswith('"') and value.endswith('"'):
+                value = value[1:-1]
+            config[name] = value
+    return config
+
+
+def join_ops(args):
+    """Join up the punctuation in directive arguments into C operators
+
+    Args:
+        args: List of token strings, as in LineInfo.args
+
+    Returns:
+        List of token strings, with e.g. '&', '&' joined into '&&' and line
+        continuations removed
+    """
+    out = []
+    for arg in args:
+        if arg == '\\\n':
+            continue
+        if out and out[-1] + arg in ('&&', '||', '==', '!=', '<=', '>='):
+            out[-1] += arg
+        else:
+            out.append(arg)
+    return out
+
+
+def parse_condition(args):
+    """Parse the condition of an #if, so it can be evaluated with a config
+
+    Only the parts which depend on Kconfig options are understood. Anything
+    else is represented by None, meaning that the value is unknown.
+
+    Args:
+        args: List of token strings after '#if' or '#elif'
+
+    Returns:
+        Parsed condition, a tuple or None, for eval_condition()
+    """
+    toks = join_ops(args)
+    pos = [0]
+
+    def peek():
+        return toks[pos[0]] if pos[0] < len(toks) else None
+
+    def take():
+        pos[0] += 1
+        return toks[pos[0] - 1]
+
+    def get_name():
+        """Get the name in 'NAME' or '(NAME)'"""
+        paren = peek() == '('
+        if paren:
+            take()
+        name = take() if peek() else None
+        if paren and peek() == ')':
+            take()
+        return name
+
+    def primary():
+        tok = take() if peek() else None
+        if tok == '(':
+            cond = parse_or()
+            if peek() == ')':
+                take()
+            return cond
+        if tok == '!':
+            cond = primary()
+            return ('not', cond) if cond else None
+        if tok == 'defined':
+            return ('defined', get_name())
+        if tok == 'CONFIG_IS_ENABLED':
+            return ('phase', get_name())
+        if tok == 'IS_ENABLED':
+            return ('enabled', get_name())
+        if tok and tok[0].isdigit():
+            try:
+                return ('num', int(tok.rstrip('uUlL'), 0))
+            except ValueError:
+                return None
+        if tok and RE_IDENT.match(tok):
+            if peek() == '(':
+                # Some other function-like macro
+                get_name()
+                return None
+            return ('value', tok)
+        return None
+
+    def compare():
+        left = primary()
+        while peek() in ('==', '!=', '<', '>', '<=', '>='):
+            op = take()
+            right = primary()
+            left = ('cmp', op, left, right) if left and right else None
+        return left
+
+    def parse_and():
+        left = compare()
+        while peek() == '&&':
+            take()
+            left = ('and', left, compare())
+        return left
+
+    def parse_or():
+        left = parse_and()
+        while peek() == '||':
+            take()
+            left = ('or', left, parse_and())
+        return left
+
+    cond = parse_or()
+    if peek() is not None:
+        return None
+    return cond
+
+
+def eval_condition(cond, config):
+    """Evaluate a parsed condition with a config
+
+    Args:
+        cond: Parsed condition, as returned by parse_condition()
+        config: dict of Kconfig settings, as returned by read_config()
+
+    Returns:
+        True or False, or None if the value is not known
+    """
+    if cond is None:
+        return None
+    kind = cond[0]
+    if kind == 'not':
+        return not3(eval_condition(cond[1], config))
+    if kind == 'and':
+        return and3(eval_condition(cond[1], config),
+                    eval_condition(cond[2], config))
+    if kind == 'or':
+        return or3(eval_condition(cond[1], config),
+                   eval_condition(cond[2], config))
+    if kind == 'cmp':
+        left = get_cond_value(cond[2], config)
+        right = get_cond_value(cond[3], config)
+        if left is None or right is None:
+            return None
+        op = cond[1]
+        return {'==': left == right, '!=': left != right, '<': left < right,
+                '>': left > right, '<=': left <= right,
+                '>=': left >= right}[op]
+    val = get_cond_value(cond, config)
+    return None if val is None else val != 0
+
+
+# Prefixes used by CONFIG_IS_ENABLED() in each phase of the build, with the
+# option which enables that phase (None if it is always built)
+PHASES = [
+    ('CONFIG_', None),
+    ('CONFIG_SPL_', 'CONFIG_SPL'),
+    ('CONFIG_TPL_', 'CONFIG_TPL'),
+    ('CONFIG_VPL_', 'CONFIG_VPL'),
+]
+
+
+def get_cond_value(cond, config):
+    """Get the integer value of part of a condition
+
+    Args:
+        cond: Parsed condition, as returned by parse_condition()
+        config: dict of Kconfig settings, as returned by read_config()
+
+    Returns:
+        int value, or None if not known
+    """
+    kind, arg = cond[0], cond[1]
+    if kind == 'num':
+        return arg
+    if kind == 'phase':
+        # CONFIG_IS_ENABLED(X) checks CONFIG_SPL_X in SPL, etc., so it is
+        # only known if it has the same value in all the phases being built
+        if not arg:
+            return None
+        vals = set()
+        for prefix, phase in PHASES:
+            if phase and config.get(phase) not in ('y', 'm'):
+                continue
+            vals.add(int(config.get(prefix + arg) in ('y', 'm')))
+        return vals.pop() if len(vals) == 1 else None
+    if kind in ('and', 'or', 'not', 'cmp'):
+        val = eval_condition(cond, config)
+        return None if val is None else int(val)
+    if not arg or not arg.startswith('CONFIG_'):
+        return None
+    value = config.get(arg)
+    if kind == 'defined':
+        return int(value is not None)
+    if kind == 'enabled':
+        return int(value in ('y', 'm'))
+    if value is None:
+        return 0
+    if value in ('y', 'm'):
+        return 1
+    try:
+        return int(value, 0)
+    except ValueError:
+        return None
+
+
+class Kconfig:
+    """Works out which parts of files are used with a set of board configs
+
+    The conditions in each file are parsed once and the resulting dead lines
+    kept, keyed by a hash of the file contents, so checking the same file
+    again (e.g. for another symbol) is just a lookup.
+    """
+    def __init__(self, configs):
+        """Set up the Kconfig
+
+        Args:
+            configs: List of dicts of Kconfig settings, as returned by
+                read_config()
+        """
+        self.configs = configs
+        self.dead = {}      # key: hash of file contents, value: dead lines
+
+    def get_dead_lines(self, data, infos):
+        """Work out which lines of a file are not used with any config
+
+        Args:
+            data: String containing the file contents
+            infos: List of LineInfo for the file, from get_line_info()
+
+        Returns:
+            frozenset of line numbers
+        """
+        key = hashlib.sha1(data.encode('utf-8', 'surrogateescape')).digest()
+        dead = self.dead.get(key)
+        if dead is None:
+            dead = self.scan(infos)
+            self.dead[key] = dead
+        return dead
+
+    def scan(self, infos):
+        """Work out which lines of a file are not used with any config
+
+        Args:
+            infos: List of LineInfo for the file
+
+        Returns:
+            frozenset of line numbers
+        """
+        # Parse the conditions once, then evaluate them for each config
+        directives = []
+        for linenum, info in enumerate(infos):
+            directive = info.directive
+            if info.in_comment or info.continued or not directive:
+                continue
+            if directive in ('if', 'elif'):
+                cond = parse_condition(info.args)
+            elif directive in ('ifdef', 'ifndef'):
+                cond = ('defined', info.args[0]) if info.args else None
+                if directive == 'ifndef' and cond:
+                    cond = ('not', cond)
+            elif directive in ('else', 'endif'):
+                cond = None
+            else:
+                continue
+            directives.append((linenum, directive, cond))
+
+        all_live = []
+        for config in self.configs:
+            live = [True] * len(infos)
+            stack = []      # (parent live, a branch was taken, live)
+            cur = True
+            start = 0
+            for linenum, directive, cond in directives:
+                for num in range(start, linenum):
+                    live[num] = cur
+                start = linenum
+                if directive in ('if', 'ifdef', 'ifndef'):
+                    val = eval_condition(cond, config)
+                    stack.append([cur, val])
+                    cur = and3(cur, val)
+                    start = linenum + 1
+                    live[linenum] = stack[-1][0]
+                elif not stack:
+                    continue
+                elif directive == 'elif':
+                    parent, taken = stack[-1]
+                    val = eval_condition(cond, config)
+                    branch = and3(not3(taken), val)
+                    stack[-1][1] = or3(taken, val)
+                    cur = and3(parent, branch)
+                    live[linenum] = parent
+                    start = linenum + 1
+                elif directive == 'else':
+                    parent, taken = stack[-1]
+                    cur = and3(parent, not3(taken))
+                    live[linenum] = parent
+                    start = linenum + 1
+                elif directive == 'endif':
+                    cur = stack.pop()[0]
+            for num in range(start, len(infos)):
+                live[num] = cur
+            all_live.append(live)
+
+        return frozenset([num for num in range(len(infos))
+                          if all(live[num] is False for live in all_live)])
+
+
+def not3(val):
+    """Three-valued 'not', where None means unknown"""
+    return None if val is None else not val
+
+
+def and3(left, right):
+    """Three-valued 'and', where None means unknown"""
+    if left is False or right is False:
+        return False
+    if left is None or right is None:
+        return None
+    return True
+
+
+def or3(left, right):
+    """Three-valued 'or', where None means unknown"""
+    if left is True or right is True:
+        return True
+    if left is None or right is None:
+        return None
+    return False
+
+
+# Counters kept for each recipe item when profiling
+PROF_EXAMINED = 'examined'              # Files which were checked for the item
+PROF_FAST_REJECT = 'fast_reject'        # Item not in the file at all
+PROF_FRAGMENT_REJECT = 'fragment_reject'  # Only found as part of another
+                                        # identifier, or in a comment/string
+PROF_SKIP_IF = 'skip_if'                # File already has the header, or
+                                        # something in skip_if_hdrs
+PROF_CHECK = 'check'                    # File needs to be checked manually
+PROF_REWRITTEN = 'rewritten'            # Header was added for this item
+
+
+class Profile:
+    """Timings and counters collected while running a conversion
+
+    Properties:
+        stages: Time spent in each stage:
+            key: stage name (e.g. 'read')
+            value: time in seconds
+        items: Counters for each recipe item:
+            key: symbol (e.g. 'BUG(')
+            value: collections.Counter, keyed by PROF_... counter name
+        totals: collections.Counter of counts for whole files, e.g. the
+            number of files rewritten
+        files: Time spent on each file:
+            key: filename
+            value: time in seconds
+        summed: Set of stages whose times were added up from other profiles
+            (e.g. per-file stages from workers). With -j these are CPU time
+            across all workers, not elapsed time
+        start: perf_counter() value when the profile was created
+    """
+    def __init__(self):
+        self.stages = collections.defaultdict(float)
+        self.items = collections.defaultdict(collections.Counter)
+        self.totals = collections.Counter()
+        self.files = {}
+        self.summed = set()
+        self.start = perf_counter()
+
+    def count(self, func, name):
+        """Increment a counter for a recipe item
+
+        Args:
+            func: Symbol for the recipe item (e.g. 'BUG(')
+            name: Counter to increment (PROF_...)
+        """
+        self.items[func][name] += 1
+
+    def merge(self, other):
+        """Add the results from another profile (e.g. from a worker) to this
+
+        Args:
+            other: Profile to add
+        """
+        for stage, secs in other.stages.items():
+            self.stages[stage] += secs
+            self.summed.add(stage)
+        for func, counts in other.items.items():
+            self.items[func].update(counts)
+        self.totals.update(other.totals)
+        self.files.update(other.files)
+
+    def slowest(self, count):
+        """Get the files which took the longest to process
+
+        Args:
+            count: Maximum number of files to return
+
+        Returns:
+            List of (fname, secs) tuples, slowest first
+        """
+        return sorted(self.files.items(), key=lambda item: (-item[1], item[0]))[
+            :count]
+
+    def get_report(self, count=20):
+        """Get a report of the profile, suitable for writing as JSON
+
+        The time spent placing the #include is not measured directly, but is
+        the time spent in process_data() less that spent lexing and checking
+        for fragments.
+
+        Stages listed in 'summed' are added up across files, so with -j they
+        show CPU time. The elapsed time of the whole run is in 'wall', and of
+        processing the files in the 'files' stage.
+
+        Args:
+            count: Number of slowest files to include
+
+        Returns:
+            dict containing the report
+        """
+        stages = dict(self.stages)
+        summed = set(self.summed)
+        if 'process_data' in stages:
+            stages['placement'] = max(0, stages['process_data'] -
+                                      stages.get('lex', 0) -
+                                      stages.get('fragment', 0))
+            if 'process_data' in summed:
+                summed.add('placement')
+        totals = collections.Counter(self.totals)
+        for counts in self.items.values():
+            totals.update(counts)
+        return {
+            'stages': {stage: round(secs, 6) for stage, secs in stages.items()},
+            'summed': sorted(summed),
+            'wall': round(perf_counter() - self.start, 6),
+            'totals': dict(totals),
+            'items': {func: dict(counts) for func, counts in self.items.items()},
+            'slowest': [[fname, round(secs, 6)]
+                        for fname, secs in self.slowest(count)],
+            }
+
+
+@contextlib.contextmanager
+def timer(prof, stage):
+    """Context manager to add the time spent in a block to a profile stage
+
+    Args:
+        prof: Profile to update, or None to do nothing
+        stage: Name of stage (e.g. 'read')
+    """
+    if not prof:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        prof.stages[stage] += perf_counter() - start
 
 
 def process_data(data, func, insert_hdr, ignore_fragments, is_hdr_file=False,
-                 skip_if_hdrs=None):
+                 skip_if_hdrs=None, prof=None, kconfig=None):
     """Process a C file by adding a header to it if needed
 
     Args:
@@ -46,6 +715,10 @@ def process_data(data, func, insert_hdr, ignore_fragments, is_hdr_file=False,
         is_hdr_file: True if this is a header file
         skip_if_hdrs: List of header files that already include insert_hdr
             transitively, or None
+        prof: Profile to record the time spent lexing and checking for
+            fragments, or None
+        kconfig: Kconfig to use to ignore code which is not used with any of
+            its configs, or None
 
     Returns:
         One of:
@@ -53,6 +726,64 @@ def process_data(data, func, insert_hdr, ignore_fragments, is_hdr_file=False,
            None if the header was not added
            str if the header was not added and there is a message
     """
+    linenum = get_insert_line(data, func, insert_hdr, ignore_fragments,
+                              is_hdr_file, skip_if_hdrs, prof, kconfig)
+    if linenum is None or isinstance(linenum, str):
+        return linenum
+    lines = data.splitlines()
+    return lines[:linenum] + ['#include <%s>' % insert_hdr] + lines[linenum:]
+
+def insert_line(data, linenum, text):
+    """Insert a line into some file contents
+
+    The new line uses the same line ending as the one before it (or the first
+    line, when inserting at the start), so CRLF files stay as they are.
+
+    Args:
+        data: String containing the file contents
+        linenum: Line number to insert before, as from str.splitlines()
+        text: Line to insert, without a line ending
+
+    Returns:
+        Updated file contents
+    """
+    pos = 0
+    eol = '\n'
+    for num, m in enumerate(RE_LINE_END.finditer(data)):
+        if num == linenum:
+            if not num:
+                eol = m.group()
+            break
+        pos = m.end()
+        eol = m.group()
+    return data[:pos] + text + eol + data[pos:]
+
+def get_insert_line(data, func, insert_hdr, ignore_fragments, is_hdr_file=False,
+                    skip_if_hdrs=None, prof=None, kconfig=None):
+    """Work out where to add a header to a C file, if needed
+
+    Args:
+        data: String containing the file contents
+        func: Symbol that is provided by the header (e.g. 'BUG(')
+        insert_hdr: Header to add (e.g. 'command.h', 'linux/bug.h')
+        ignore_fragments: True to check that the file actually has the
+            identifier. This will ignore 'PRBUG(' when looking for 'BUG(', for
+            example
+        is_hdr_file: True if this is a header file
+        skip_if_hdrs: List of header files that already include insert_hdr
+            transitively, or None
+        prof: Profile to record the time spent lexing and checking for
+            fragments, or None
+        kconfig: Kconfig to use to ignore code which is not used with any of
+            its configs, or None
+
+    Returns:
+        One of:
+           int: Line number (as from str.splitlines()) to put the new
+               #include before, if the header should be added
+           None if the header should not be added
+           str if the header should not be added and there is a message
+    """
     if func and func not in data:
         return ">'%s' not in file" % func
 
@@ -69,59 +800,36 @@ def process_data(data, func, insert_hdr, ignore_fragments, is_hdr_file=False,
         #return None
     #if '#include <linux/kernel.h>' in data:
         #return None
-    lines = data.splitlines()
-
-    # Make sure that at least one match is the full match string. For example
-    # this will ignore PRBUG() when looking for BUG(
+    with timer(prof, 'lex'):
+        lines = data.splitlines()
+        tokens = lex('\n'.join(lines))
+    infos = None
+    dead = None
+    if kconfig and ignore_fragments:
+        with timer(prof, 'kconfig'):
+            infos = get_line_info(tokens, len(lines))
+            dead = kconfig.get_dead_lines(data, infos)
+
+    # Make sure that at least one match is the full match string, outside a
+    # comment. For example this will ignore PRBUG() when looking for BUG(
     if ignore_fragments:
-        found = False
-        in_comment = False
-        for linenum, line in enumerate(lines):
-            start = 0
-            stripped = line.strip()
-            if stripped.startswith('/*'):
-                if stripped.endswith('*/'):
-                    line = remove_comment(line)
-                else:
-                    in_comment = True
-                    continue
-            elif '/*' in line:
-                pos = line.find('/*')
-                end = line.find('*/')
-                if end == -1:
-                    in_comment = True
-                    continue
-                else:
-                    line = line[:pos] + line[end + 2:]
-            elif stripped == '*/':
-                if not in_comment:
-                    return 'comment error at %d: %s' % (linenum + 1, line)
-                in_comment = False
-                continue
-            elif stripped.endswith('*/'):
-                if '/*' not in stripped and not in_comment:
-                    return 'comment error at %d: %s' % (linenum + 1, line)
-                in_comment = False
-                continue
-            if not in_comment and func:
-                while True:
-                    pos = line.find(func, start)
-                    if pos == -1:
-                        break
-                    if pos == 0 or line[pos - 1] not in ALPHANUM:
-                        found = True
-                        break
-                    start = pos + 1
-                if found:
-                    break
-        if not found:
-            return None
+        with timer(prof, 'fragment'):
+            for tok in tokens:
+                if tok.kind == TOK_STRAY:
+                    return 'comment error at %d: %s' % (tok.line + 1,
+                                                        lines[tok.line])
+            live_tokens = tokens
+            if dead:
+                live_tokens = [tok for tok in tokens if tok.line not in dead]
+            if not func or not find_symbol(get_code(live_tokens), func,
+                                           ignore_fragments == WHOLE_IDENT):
+                return None
 
     # If there are no existing #includes to put this new one near, just put it
     # somewhere near the top of the file
     insert_early = '#include' not in data
 
-    out = []
+    insert_at = None
     done = False
     found_includes = False
     active = True  # We are not in an #ifndef
@@ -131,16 +839,20 @@ def process_data(data, func, insert_hdr, ignore_fragments, is_hdr_file=False,
     wait_for_endif = False  # We are waiting for an #endif
     wait_for_header_guard = False
     found_ifndef = False
-    in_comment = False
-    for line in lines:
-        #if line.strip() and not done:
-        if not done:
-            if line.startswith('#if'):
-                tokens = line.split()
+    if infos is None:
+        infos = get_line_info(tokens, len(lines))
+    for linenum, (line, info) in enumerate(zip(lines, infos)):
+        # Never put anything inside a comment or a multi-line macro
+        if not done and not info.in_comment and not info.continued:
+            directive = info.directive
+            if directive in ('if', 'ifdef', 'ifndef'):
+                parts = ['#' + directive] + info.args
                 wait_for_endif = True
                 active = False
-                if len(tokens) == 2:
-                    cond, sym = tokens
+                # Even a block which is used with all the kconfig configs is
+                # not used with every board, so never put the header there
+                if len(parts) == 2:
+                    cond, sym = parts
                     if sym == UBOOT:
                         if cond == '#ifdef':
                             active = True
@@ -179,26 +891,26 @@ def process_data(data, func, insert_hdr, ignore_fragments, is_hdr_file=False,
                 else:
                     # Unknown ifdef so wait for #endif
                     pass
-            elif line.startswith('#else'):
+            elif directive == 'else':
                 if active:
-                    out.append(to_add)
+                    insert_at = linenum
                     done = True
                 if not wait_for_endif:
                     active = not active
-            elif line.startswith('#endif'):
+            elif directive == 'endif':
                 # We got to an #endif and didn't add the header yet
                 if active:
-                    out.append(to_add)
+                    insert_at = linenum
                     done = True
                 active= True
                 wait_for_endif = False
-            elif (line.startswith('#define') and
-                  line.split()[1] == wait_for_header_guard):
+            elif (directive == 'define' and wait_for_header_guard and
+                  info.args[:1] == [wait_for_header_guard]):
                 wait_for_header_guard = False
                 active = True
             elif active and not wait_for_asm:
-                if line.startswith('#include'):
-                    m = re.match('#include <(.*)>', line)
+                if directive == 'include':
+                    m = re.match(r'\s*#\s*include\s*<(.*)>', line)
                     if m:
                         hdr = m.group(1)
                         if hdr != 'common.h':
@@ -210,103 +922,2763 @@ def process_data(data, func, insert_hdr, ignore_fragments, is_hdr_file=False,
                             elif has_subdir:
                                 todo = True
                             if todo:
-                                out.append(to_add)
+                                insert_at = linenum
                                 done = True
                     else:
                         # If the first include is a local file then probably
                         # the inclusion is handled by that file.
                         if found_includes:
                             # Put it before the first local #include "..."
-                            out.append(to_add)
+                            insert_at = linenum
                         else:
                             inc_name = line.split(' ')[1]
                             return ("local include %s" % inc_name)
                         done = True
                     found_includes = True
-                elif (found_includes or 'struct' in line or func in line or
-                      'enum' in line or 'void' in line):
-                    out.append(to_add)
+                elif (found_includes or 'struct' in line or
+                      (func and func in line) or 'enum' in line or
+                      'void' in line):
+                    insert_at = linenum
                     done = True
-                elif insert_early and line:
-                    # Don't insert it before or inside a comment
-                    stripped = line.strip()
-                    if not stripped:
-                        pass
-                    if '/*' in line:
-                        pos = line.find('/*')
-                        end = line.find('*/')
-                        if end == -1:
-                            in_comment = True
-                        elif remove_comment(line) and not in_comment:
-                            out.append(to_add)
-                            done = True
-                    elif '*/' in line:
-                        in_comment = False
-
-                    # Don't put it on a line that consists only of a comment
-                    elif not remove_comment(line).strip():
-                        pass
-                    elif not in_comment:
-                        out.append(to_add)
-                        done = True
-        out.append(line)
+                elif insert_early and info.code:
+                    # Don't insert it before or inside a comment, or on a line
+                    # that consists only of a comment
+                    insert_at = linenum
+                    done = True
+        if done:
+            break
     if wait_for_header_guard:
         return 'Never found the end of the header guard'
     if not done:
         return 'could not find a suitable place'
-    return out
+    return insert_at
+
+def rename_data(data, renames, is_hdr_file=False):
+    """Rename #includes in a C file
+
+    Where an old #include is in a part of the file which is always used (e.g.
+    not inside '#ifdef CONFIG_...' or '#ifndef __UBOOT__'), it is removed and
+    the new one is added using the same placement rules as process_data(), so
+    the #includes stay sorted. Otherwise, or if process_data() cannot find a
+    place for it, the line is replaced where it is. Each line keeps its own
+    line ending.
+
+    Args:
+        data: String containing the file contents
+        renames: List of (old_hdr, new_hdr) tuples, e.g.
+            [('asm/u-boot.h', 'asm/global_data.h')]
+        is_hdr_file: True if this is a header file
+
+    Returns:
+        String containing the new file contents, or None if there are no
+        #includes to rename
+    """
+    lines = data.splitlines()
+    ends = [line[len(text):]
+            for line, text in zip(data.splitlines(True), lines)]
+    tokens = lex('\n'.join(lines))
+    infos = get_line_info(tokens, len(lines))
+    new_of = dict(renames)
+
+    # Find the old #includes and whether each one can be moved
+    stack = []      # [active, known] for each #if we are inside
+    found_cond = False
+    moves = {}      # key: line number, value: new header
+    replaces = {}   # key: line number, value: new header
+    for linenum, (line, info) in enumerate(zip(lines, infos)):
+        if info.in_comment or info.continued:
+            continue
+        directive = info.directive
+        if directive in ('if', 'ifdef', 'ifndef'):
+            sym = info.args[0] if len(info.args) == 1 else None
+            active = None
+            known = True
+            if directive != 'if' and sym == UBOOT:
+                active = directive == 'ifdef'
+            elif directive != 'if' and sym in (ASM, HOSTCC):
+                active = directive == 'ifndef'
+            else:
+                # Only the header guard is always used
+                known = False
+                active = (is_hdr_file and not found_cond and
+                          directive == 'ifndef' and sym is not None)
+            found_cond = True
+            stack.append([active, known])
+        elif directive == 'else' and stack:
+            if stack[-1][1]:
+                stack[-1][0] = not stack[-1][0]
+            else:
+                stack[-1][0] = False
+        elif directive == 'endif' and stack:
+            stack.pop()
+        elif directive == 'include':
+            m = re.match(r'\s*#\s*include\s*<(.*)>', line)
+            if m and m.group(1) in new_of:
+                new_hdr = new_of[m.group(1)]
+                if all([active for active, _ in stack]):
+                    moves[linenum] = new_hdr
+                else:
+                    replaces[linenum] = new_hdr
+    if not moves and not replaces:
+        return None
+
+    while True:
+        out = []
+        for linenum, (line, end) in enumerate(zip(lines, ends)):
+            if linenum in replaces:
+                out.append('#include <%s>%s' % (replaces[linenum], end))
+            elif linenum not in moves:
+                out.append(line + end)
+        new_data = ''.join(out)
+        failed = None
+        for new_hdr in sorted(set(moves.values())):
+            to_add = '#include <%s>' % new_hdr
+            if to_add in new_data:
+                continue
+            linenum = get_insert_line(new_data, None, new_hdr, False,
+                                      is_hdr_file)
+            if isinstance(linenum, str):
+                failed = new_hdr
+                break
+            new_data = insert_line(new_data, linenum, to_add)
+        if not failed:
+            return new_data
+
+        # There is nowhere else to put it, so replace the old #include
+        for linenum, new_hdr in list(moves.items()):
+            if new_hdr == failed:
+                del moves[linenum]
+                replaces[linenum] = new_hdr
+
+
+class Scanner:
+    """Find which of a set of symbols appear in a file, in a single pass
+
+    All the symbols in a recipe are compiled into one regular expression, so
+    each file is scanned once rather than once per symbol.
+    """
+    def __init__(self, items):
+        """Set up the scanner
+
+        Args:
+            items: List of (func, ignore_fragments) tuples, e.g.
+                [('BUG(', True), ('BUILD_BUG_', False), ('SZ_1', WHOLE_IDENT)]
+        """
+        self.items = items
+        self.funcs = []
+        self.by_first = {}
+        self.whole = set([func for func, ignore_fragments in items
+                          if ignore_fragments == WHOLE_IDENT])
+        for func, _ in items:
+            if func not in self.funcs:
+                self.funcs.append(func)
+                self.by_first.setdefault(func[0], []).append(func)
+
+        # Use a lookahead so that overlapping symbols (e.g. 'printk' and
+        # 'printk_once') are all seen
+        alts = sorted(self.funcs, key=len, reverse=True)
+        self.regex = re.compile('(?=%s)' % '|'.join(re.escape(func)
+                                                    for func in alts))
+        self.bytes_regex = re.compile('|'.join(re.escape(func)
+                                               for func in alts).encode())
+
+    def scan(self, data):
+        """Scan some data for all symbols
+
+        Args:
+            data: String containing the file contents
+
+        Returns:
+            dict:
+                key: symbol that was found
+                value: True if it was found at an identifier boundary (e.g.
+                    'BUG(' in ' BUG(1)'), False if it was only found as a
+                    fragment of a larger identifier (e.g. in 'PRBUG(', or
+                    'SZ_128' for a WHOLE_IDENT item 'SZ_1')
+        """
+        found = {}
+        remaining = len(self.funcs)
+        for m in self.regex.finditer(data):
+            pos = m.start()
+            boundary = pos == 0 or data[pos - 1] not in ALPHANUM
+            for func in self.by_first[data[pos]]:
+                if found.get(func) or not data.startswith(func, pos):
+                    continue
+                ok = boundary
+                if ok and func in self.whole:
+                    end = pos + len(func)
+                    ok = end == len(data) or data[end] not in ALPHANUM
+                found[func] = ok
+                if ok:
+                    remaining -= 1
+            if not remaining:
+                break
+        return found
+
+    def may_match(self, buf):
+        """Check whether any symbol appears in some raw file contents
+
+        This is much faster than scan(), since it stops at the first match and
+        works on bytes, so a file can be rejected before it is decoded.
+
+        Args:
+            buf: bytes-like object (e.g. an mmap) containing the file contents
+
+        Returns:
+            True if any of the symbols are present, even as a fragment
+        """
+        return self.bytes_regex.search(buf) is not None
+
+    def matches(self, data):
+        """Get the recipe items which need to be checked in a file
+
+        Args:
+            data: String containing the file contents
+
+        Returns:
+            List of (func, ignore_fragments) tuples, in recipe order
+        """
+        return self.select(self.scan(data))
+
+    def select(self, found):
+        """Get the recipe items which need to be checked, given scan results
+
+        Args:
+            found: dict returned by scan()
+
+        Returns:
+            List of (func, ignore_fragments) tuples, in recipe order
+        """
+        return [(func, ignore_fragments) for func, ignore_fragments in self.items
+                if func in found and (found[func] or not ignore_fragments)]
+
+
+def want_file(fname):
+    """Check whether a file from 'git grep' should be processed
+
+    Args:
+        fname: Filename relative to the top of the tree
+
+    Returns:
+        True to process it, False to ignore it
+    """
+    if os.path.islink(fname):
+        return False
+    if fname.startswith('tools/') or fname.startswith('scripts/'):
+        return False
+    return True
+
+
+# Matches the source line in a Kbuild .o.cmd file, e.g.
+# 'source_drivers/core/device.o := drivers/core/device.c'
+RE_CMD_SOURCE = re.compile(r'^source_\S+\s*:=\s*(\S+)', re.M)
+
+
+def get_tree_path(path, dirname, top):
+    """Convert a path from a build file to one relative to the top of the tree
+
+    Args:
+        path: Path to convert, which may be absolute
+        dirname: Directory that path is relative to, if it is not absolute
+        top: Absolute path to the top of the tree
+
+    Returns:
+        Path relative to top, or None if it is outside the tree
+    """
+    path = os.path.normpath(os.path.join(dirname, path))
+    rel = os.path.relpath(path, top)
+    if rel.startswith('..'):
+        return None
+    return rel
+
+
+def get_built_files(paths):
+    """Get the files which are compiled in one or more builds
+
+    Args:
+        paths: List of paths, each either a compile_commands.json file or a
+            build directory containing the .o.cmd files written by Kbuild
+
+    Returns:
+        frozenset of C files which are built, relative to the top of the tree
+            in the current directory
+    """
+    top = os.getcwd()
+    built = set()
+    for path in paths:
+        if not os.path.isdir(path):
+            with open(path) as fd:
+                entries = json.load(fd)
+            for entry in entries:
+                fname = get_tree_path(entry['file'], entry['directory'], top)
+                if fname:
+                    built.add(fname)
+            continue
+        for dirpath, _, fnames in os.walk(path):
+            for leaf in fnames:
+                if not leaf.endswith('.o.cmd'):
+                    continue
+                with open(os.path.join(dirpath, leaf), errors='ignore') as fd:
+                    m = RE_CMD_SOURCE.search(fd.read())
+                if not m:
+                    continue
+                # Sources are relative to the tree, unless building with O=
+                # and a tree given with a relative path
+                src = m.group(1)
+                fname = get_tree_path(src, top, top)
+                if not fname or not os.path.exists(fname):
+                    fname = (get_tree_path(src, os.path.abspath(path), top) or
+                             fname)
+                if fname:
+                    built.add(fname)
+    return frozenset(built)
+
+
+def split_built(fnames, built):
+    """Split a list of files into those which are built and those which are not
+
+    Only C files are checked, since headers are not listed as being built.
+
+    Args:
+        fnames: List of filenames
+        built: Set of files which are built, or None if all are
+
+    Returns:
+        tuple:
+            List of files which are built, or are headers
+            List of C files which are not built
+    """
+    if built is None:
+        return fnames, []
+    wanted = []
+    not_built = []
+    for fname in fnames:
+        if fname.endswith('.c') and fname not in built:
+            not_built.append(fname)
+        else:
+            wanted.append(fname)
+    return wanted, not_built
+
+
+def grep_files(funcs, paths=None, cached=False):
+    """Find the files in the tree which contain any of a list of symbols
+
+    This uses a single 'git grep' for all symbols.
+
+    Args:
+        funcs: List of symbols to search for (e.g. ['BUG(', 'WARN('])
+        paths: List of files to limit the search to, or None for all
+        cached: True to search the files in the git index rather than the
+            working tree. The working tree includes new files which are not
+            yet known to git, unless they are ignored
+
+    Returns:
+        List of filenames
+
+    Raises:
+        ValueError: if 'git grep' fails
+    """
+    if paths is not None and not paths:
+        return []
+    cmd = ['git', 'grep', '-l', '-F']
+    cmd.append('--cached' if cached else '--untracked')
+    for func in funcs:
+        cmd += ['-e', func]
+    if paths:
+        cmd += ['--'] + paths
+    result = command.RunPipe([cmd], capture=True, capture_stderr=True,
+                             raise_on_error=False)
+
+    # 'git grep' returns 1 if nothing matches
+    if result.return_code not in (0, 1):
+        raise ValueError('git grep failed: %s' % result.stderr.strip())
+    return [fname for fname in result.stdout.splitlines() if want_file(fname)]
+
+
+def tokenize_file(fname):
+    """Get the set of identifiers used in a file
+
+    Args:
+        fname: Filename to read
+
+    Returns:
+        frozenset of identifiers (empty if the file cannot be read)
+    """
+    try:
+        with open(fname, 'r', errors='ignore') as fd:
+            data = fd.read()
+    except OSError:
+        return frozenset()
+    return frozenset(RE_IDENT.findall(data))
+
+
+def git_files():
+    """Get the .c and .h files in the tree in the current directory
+
+    Returns:
+        tuple:
+            dict: key: filename, value: blob SHA (from the git index)
+            set: filenames which are modified in the working tree
+    """
+    modified = set(command.Output('git', 'ls-files', '-m', '-z').split('\0'))
+    sha_of = {}
+    for entry in command.Output('git', 'ls-files', '-s', '-z').split('\0'):
+        if not entry:
+            continue
+        info, fname = entry.split('\t', 1)
+        mode, sha, _ = info.split()
+        if mode != '120000' and fname[-2:] in ('.c', '.h'):
+            sha_of[fname] = sha
+    return sha_of, modified
+
+
+def get_cache_fname(name):
+    """Get the filename to use for a cache
+
+    Caches are kept in the git directory of the tree in the current directory.
+
+    Args:
+        name: Name of the cache (e.g. 'idx')
+
+    Returns:
+        Full filename for the cache
+    """
+    git_dir = command.Output('git', 'rev-parse', '--git-dir').strip()
+    return os.path.join(git_dir, 'hdr_include.%s' % name)
+
+
+class BlobCache:
+    """Base class for information which is persisted across runs
+
+    Subclasses set VERSION and implement get_state() and set_state(). The
+    cache is discarded if the version does not match, e.g. after the format
+    changes.
+    """
+    VERSION = 1
+
+    def __init__(self, fname=None):
+        """Set up the cache
+
+        Args:
+            fname: Filename to persist the cache in, or None to keep it only in
+                memory
+        """
+        self.fname = fname
+        self.changed = False
+
+    def get_state(self):
+        """Get the state to persist
+
+        Returns:
+            Picklable object
+        """
+        raise NotImplementedError()
+
+    def set_state(self, state):
+        """Restore the state from a previous run
+
+        Args:
+            state: Object previously returned by get_state()
+        """
+        raise NotImplementedError()
+
+    def load(self):
+        """Load the cache from its file, if it exists and is valid"""
+        if not self.fname or not os.path.exists(self.fname):
+            return
+        with open(self.fname, 'rb') as fd:
+            try:
+                version, state = pickle.load(fd)
+            except (pickle.UnpicklingError, EOFError, ValueError):
+                return
+        if version == self.VERSION:
+            self.set_state(state)
+
+    def save(self):
+        """Write the cache to its file, if anything has changed"""
+        if not self.fname or not self.changed:
+            return
+        tmpname = self.fname + '.tmp'
+        with open(tmpname, 'wb') as fd:
+            pickle.dump((self.VERSION, self.get_state()), fd,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, self.fname)
+        self.changed = False
+
+
+class IdentIndex(BlobCache):
+    """Persistent index of which identifiers are used in which files
+
+    This is keyed by git blob SHA, so after the first run only blobs which
+    have changed need to be tokenized again. Files which are modified in the
+    working tree are tokenized on each update, since they have no blob yet.
+
+    Only .c and .h files are indexed, since those are the only ones processed.
+    """
+    def __init__(self, fname=None):
+        super().__init__(fname)
+        self.blobs = {}         # key: blob SHA, value: frozenset of idents
+        self.by_ident = {}      # key: identifier, value: set of blob SHAs
+        self.fnames_by_sha = {} # key: blob SHA, value: list of filenames
+        self.sha_of = {}        # key: filename, value: blob SHA
+        self.modified = {}      # key: filename, value: frozenset of idents
+        self.sorted_idents = None
+
+    def get_state(self):
+        return self.blobs, self.by_ident
+
+    def set_state(self, state):
+        self.blobs, self.by_ident = state
+
+    def add_blob(self, sha, idents):
+        """Add a blob to the index
+
+        Args:
+            sha: Blob SHA
+            idents: frozenset of identifiers in the blob
+        """
+        self.blobs[sha] = idents
+        for ident in idents:
+            self.by_ident.setdefault(ident, set()).add(sha)
+        self.sorted_idents = None
+        self.changed = True
+
+    def remove_blob(self, sha):
+        """Remove a blob from the index
+
+        Args:
+            sha: Blob SHA
+        """
+        for ident in self.blobs.pop(sha):
+            shas = self.by_ident[ident]
+            shas.discard(sha)
+            if not shas:
+                del self.by_ident[ident]
+        self.sorted_idents = None
+        self.changed = True
+
+    def update(self, jobs=1):
+        """Bring the index up to date with the tree in the current directory
+
+        Args:
+            jobs: Number of processes to use for tokenizing files
+        """
+        sha_of, modified = git_files()
+        todo = sorted([fname for fname, sha in sha_of.items()
+                       if fname in modified or sha not in self.blobs])
+        self.modified = {}
+        for fname, idents in run_files(todo, tokenize_file, jobs):
+            if fname in modified:
+                self.modified[fname] = idents
+            elif sha_of[fname] not in self.blobs:
+                self.add_blob(sha_of[fname], idents)
+
+        self.fnames_by_sha = {}
+        self.sha_of = {}
+        for fname, sha in sha_of.items():
+            if fname not in modified:
+                self.fnames_by_sha.setdefault(sha, []).append(fname)
+                self.sha_of[fname] = sha
+        live = set(sha_of.values())
+        for sha in [sha for sha in self.blobs if sha not in live]:
+            self.remove_blob(sha)
+
+    def update_files(self, fnames):
+        """Update the index after files change in the working tree
+
+        The files are treated as modified, so they are tokenized again. Files
+        which no longer exist are removed.
+
+        Args:
+            fnames: Iterable of filenames which changed
+        """
+        for fname in fnames:
+            sha = self.sha_of.pop(fname, None)
+            if sha:
+                self.fnames_by_sha[sha].remove(fname)
+            if os.path.exists(fname):
+                self.modified[fname] = tokenize_file(fname)
+            else:
+                self.modified.pop(fname, None)
+
+    def find_idents(self, func, ignore_fragments):
+        """Find the identifiers in the index which could match a symbol
+
+        Args:
+            func: Symbol to search for (e.g. 'BUG(' or 'GD_FLG_')
+            ignore_fragments: True if the symbol must start at an identifier
+                boundary, WHOLE_IDENT if it must be a whole identifier
+
+        Returns:
+            List of identifiers, or None if the symbol does not start with an
+            identifier, so the index cannot be used
+        """
+        m = RE_IDENT.match(func)
+        if not m:
+            return None
+        tok = m.group(0)
+        # e.g. 'BUG(' must be the whole ident
+        exact = m.end() < len(func) or ignore_fragments == WHOLE_IDENT
+        if ignore_fragments and exact:
+            return [tok]
+        if ignore_fragments:
+            if self.sorted_idents is None:
+                self.sorted_idents = sorted(self.by_ident)
+            idents = []
+            pos = bisect.bisect_left(self.sorted_idents, tok)
+            while (pos < len(self.sorted_idents) and
+                   self.sorted_idents[pos].startswith(tok)):
+                idents.append(self.sorted_idents[pos])
+                pos += 1
+            return idents
+        if exact:
+            return [ident for ident in self.by_ident if ident.endswith(tok)]
+        return [ident for ident in self.by_ident if tok in ident]
+
+    def lookup(self, items):
+        """Find the files which may contain any of a list of symbols
+
+        This may return files that do not actually match (e.g. where the
+        symbol is only in a comment), so the result must still be checked.
+
+        Args:
+            items: List of (func, ignore_fragments) tuples
+
+        Returns:
+            Sorted list of filenames
+        """
+        shas = set()
+        fnames = set()
+        others = []
+        for func, ignore_fragments in items:
+            idents = self.find_idents(func, ignore_fragments)
+            if idents is None:
+                others.append(func)
+                continue
+            for ident in idents:
+                shas |= self.by_ident.get(ident, set())
+            wanted = set(idents)
+            for fname, file_idents in self.modified.items():
+                if not wanted.isdisjoint(file_idents):
+                    fnames.add(fname)
+        for sha in shas:
+            fnames.update(self.fnames_by_sha.get(sha, []))
+        if others:
+            fnames.update(grep_files(others))
+        return sorted([fname for fname in fnames if want_file(fname)])
+
+
+def get_index(jobs=1):
+    """Get an identifier index for the tree in the current directory
+
+    The index is kept in the git directory and updated before it is returned.
+
+    Args:
+        jobs: Number of processes to use for tokenizing files
+
+    Returns:
+        IdentIndex object
+    """
+    index = IdentIndex(get_cache_fname('idx'))
+    index.load()
+    index.update(jobs)
+    index.save()
+    return index
+
+
+# Kinds of declaration found by scan_decls()
+DECL_FUNC = 'func'              # Function, e.g. 'int f(void);'
+DECL_MACRO_FUNC = 'macro_func'  # Function-like macro, e.g. '#define F(x)'
+DECL_MACRO = 'macro'            # Other macro, e.g. '#define SIZE 10'
+DECL_ENUM = 'enum'              # Enumerator, e.g. 'A' in 'enum { A, B };'
+DECL_TYPE = 'type'              # typedef, e.g. 'gd_t'
+DECL_EXTERN = 'extern'          # External variable, e.g. 'extern int x;'
+
+# Identifiers which look like function names but are not
+NOT_FUNCS = set(['__attribute__', '__attribute', '__typeof__', 'typeof',
+                 'sizeof', '__aligned', '__section', '__printf', '__scanf',
+                 'if', 'while', 'for', 'switch', 'return'])
+
+
+def get_func_name(stmt):
+    """Find the name of the function declared by a statement, if any
+
+    Args:
+        stmt: List of token strings making up the statement, not including
+            the final ';' or '{'
+
+    Returns:
+        Name of the function, or None if this is not a function declaration
+    """
+    depth = 0
+    for pos, tok in enumerate(stmt):
+        if tok == '(':
+            depth += 1
+        elif tok == ')':
+            depth -= 1
+        elif (not depth and pos and pos + 1 < len(stmt) and
+              stmt[pos + 1] == '(' and RE_IDENT.match(tok) and
+              tok not in NOT_FUNCS and
+              (stmt[pos - 1] == '*' or RE_IDENT.match(stmt[pos - 1]))):
+            return tok
+    return None
+
+
+def get_decl_name(stmt):
+    """Find the name declared by a typedef or variable declaration
+
+    Args:
+        stmt: List of token strings making up the statement, not including
+            the final ';'
+
+    Returns:
+        Name declared, or None if not found
+    """
+    # A function pointer, e.g. 'typedef int (*name)(void)'
+    for pos in range(len(stmt) - 2):
+        if stmt[pos] == '(' and stmt[pos + 1] == '*':
+            if RE_IDENT.match(stmt[pos + 2]):
+                return stmt[pos + 2]
+    depth = 0
+    name = None
+    for tok in stmt:
+        if tok in ('(', '['):
+            depth += 1
+        elif tok in (')', ']'):
+            depth -= 1
+        elif tok == '=':
+            break
+        elif not depth and RE_IDENT.match(tok):
+            name = tok
+    return name
+
+
+def scan_decls(fname):
+    """Find the declarations in a header file
+
+    This covers functions, macros, enumerators, typedefs and extern variables.
+    Struct and union tags are not included, since a pointer to a struct does
+    not need the header. The macro used as the header guard is ignored.
+
+    Args:
+        fname: Filename to read
+
+    Returns:
+        frozenset of (kind, name) tuples, where kind is a DECL_... value
+    """
+    try:
+        with open(fname, 'r', errors='ignore') as fd:
+            data = fd.read()
+    except OSError:
+        return frozenset()
+    decls = set()
+    guard = None
+    first_cond = True
+    toks = []
+    in_directive = False
+    for tok in lex(data):
+        kind = tok.kind
+        if kind == TOK_DIRECTIVE:
+            in_directive = True
+            directive = tok.text.split('#', 1)[1].strip()
+            args = []
+            func_like = False
+            prev_kind = kind
+            continue
+        if in_directive:
+            if kind == TOK_NEWLINE:
+                in_directive = False
+                if directive == 'ifndef' and first_cond and args:
+                    guard = args[0].text
+                if directive in ('if', 'ifdef', 'ifndef'):
+                    first_cond = False
+                if (directive == 'define' and args and
+                        args[0].kind == TOK_IDENT and args[0].text != guard):
+                    decls.add((DECL_MACRO_FUNC if func_like else DECL_MACRO,
+                               args[0].text))
+            elif kind not in (TOK_COMMENT, TOK_CONT, TOK_SPACE):
+                # A function-like macro has '(' straight after the name
+                if len(args) == 1 and prev_kind == TOK_IDENT:
+                    func_like = tok.text == '('
+                args.append(tok)
+            prev_kind = kind
+            continue
+        if kind not in (TOK_COMMENT, TOK_SPACE, TOK_NEWLINE, TOK_CONT):
+            toks.append(tok.text)
+
+    # Walk through the top-level statements
+    depth = 0
+    stmt = []
+    enum_depth = None
+    prev = None
+    for tok in toks:
+        if tok == '{':
+            if not depth:
+                if 'enum' in stmt:
+                    enum_depth = 1
+                elif 'struct' not in stmt and 'union' not in stmt:
+                    name = get_func_name(stmt)
+                    if name:
+                        decls.add((DECL_FUNC, name))
+                    stmt = []
+            depth += 1
+        elif tok == '}':
+            depth = max(0, depth - 1)
+            if enum_depth is not None and depth < enum_depth:
+                enum_depth = None
+        elif (enum_depth is not None and depth == enum_depth and
+              prev in ('{', ',') and RE_IDENT.match(tok)):
+            decls.add((DECL_ENUM, tok))
+        elif depth:
+            pass
+        elif tok == ';':
+            if stmt and stmt[0] == 'typedef':
+                name = get_decl_name(stmt)
+                if name:
+                    decls.add((DECL_TYPE, name))
+            else:
+                name = get_func_name(stmt)
+                if name:
+                    decls.add((DECL_FUNC, name))
+                elif 'extern' in stmt:
+                    name = get_decl_name(stmt)
+                    if name:
+                        decls.add((DECL_EXTERN, name))
+            stmt = []
+        else:
+            stmt.append(tok)
+        prev = tok
+    return frozenset(decls)
+
+
+class DeclIndex(BlobCache):
+    """Persistent index of the declarations in each header
+
+    This covers the headers in include/ and arch/*/include, which are looked
+    up by the name used to #include them. Like IdentIndex it is keyed by blob
+    SHA, so only headers which have changed need to be scanned again.
+    """
+    def __init__(self, fname=None):
+        super().__init__(fname)
+        self.blobs = {}     # key: blob SHA, value: frozenset of declarations
+        self.by_hdr = {}    # key: header name, value: set of declarations
+
+    def get_state(self):
+        return self.blobs
+
+    def set_state(self, state):
+        self.blobs = state
+
+    def update(self, jobs=1):
+        """Bring the index up to date with the tree in the current directory
+
+        Args:
+            jobs: Number of processes to use for scanning headers
+        """
+        sha_of, modified = git_files()
+        hdrs = sorted([fname for fname in sha_of if fname.endswith('.h') and
+                       get_hdr_name(fname) != fname])
+        todo = [fname for fname in hdrs
+                if fname in modified or sha_of[fname] not in self.blobs]
+        decls_of = dict(run_files(todo, scan_decls, jobs))
+        for fname, decls in decls_of.items():
+            if fname not in modified:
+                self.blobs[sha_of[fname]] = decls
+                self.changed = True
+        live = set(sha_of.values())
+        for sha in [sha for sha in self.blobs if sha not in live]:
+            del self.blobs[sha]
+            self.changed = True
+
+        self.by_hdr = {}
+        for fname in hdrs:
+            decls = decls_of.get(fname)
+            if decls is None:
+                decls = self.blobs[sha_of[fname]]
+            self.by_hdr.setdefault(get_hdr_name(fname), set()).update(decls)
+
+    def get_decls(self, hdr):
+        """Get the declarations in a header
+
+        Where there is more than one header with the name (e.g. asm/io.h),
+        the declarations from all of them are included.
+
+        Args:
+            hdr: Header name (e.g. 'linux/bitops.h')
+
+        Returns:
+            Set of (kind, name) tuples
+
+        Raises:
+            ValueError: if the header is not found
+        """
+        if hdr not in self.by_hdr:
+            raise ValueError("Header '%s' not found in %s" %
+                             (hdr, ', '.join(INCLUDE_PATHS)))
+        return self.by_hdr[hdr]
+
+
+def get_decl_index(jobs=1):
+    """Get a declaration index for the tree in the current directory
+
+    The index is kept in the git directory and updated before it is returned.
+
+    Args:
+        jobs: Number of processes to use for scanning headers
+
+    Returns:
+        DeclIndex object
+    """
+    index = DeclIndex(get_cache_fname('decl'))
+    index.load()
+    index.update(jobs)
+    index.save()
+    return index
+
+
+# Whether the code in a #if block is used in U-Boot
+USED_ALWAYS, USED_NEVER, USED_COND = range(3)
+
+
+def get_includes(data, is_hdr_file=False):
+    """Get the #include directives in some C source
+
+    #includes which are never used in U-Boot, i.e. those inside '#if 0',
+    '#ifndef __UBOOT__', '#ifdef __ASSEMBLY__' or '#ifdef USE_HOSTCC', are
+    left out. Those inside other conditional blocks (e.g. '#ifdef CONFIG_...')
+    are marked as conditional, since they may or may not be used.
+
+    Args:
+        data: String containing the file contents
+        is_hdr_file: True if this is a header file, so that its header guard
+            is not counted as a condition
+
+    Returns:
+        tuple of (local, name, cond) tuples, where local is True for
+        #include "...", name is the header name (e.g. 'linux/bug.h') and cond
+        is True if the #include is inside a conditional block
+    """
+    lines = data.splitlines()
+    tokens = lex('\n'.join(lines))
+    stack = []      # [used, known] for each #if we are inside
+    found_cond = False
+    incs = []
+    for line, info in zip(lines, get_line_info(tokens, len(lines))):
+        if info.in_comment or info.continued:
+            continue
+        directive = info.directive
+        if directive in ('if', 'ifdef', 'ifndef'):
+            sym = info.args[0] if len(info.args) == 1 else None
+            used = USED_COND
+            if directive == 'if':
+                if sym in ('0', '1'):
+                    used = USED_ALWAYS if sym == '1' else USED_NEVER
+            elif sym == UBOOT:
+                used = USED_ALWAYS if directive == 'ifdef' else USED_NEVER
+            elif sym in (ASM, HOSTCC):
+                used = USED_ALWAYS if directive == 'ifndef' else USED_NEVER
+            elif (is_hdr_file and not found_cond and directive == 'ifndef' and
+                  sym is not None):
+                used = USED_ALWAYS
+            found_cond = True
+            stack.append([used, used != USED_COND])
+        elif directive in ('elif', 'else') and stack:
+            used, known = stack[-1]
+            if used == USED_ALWAYS:
+                stack[-1][0] = USED_NEVER
+            elif used == USED_NEVER and known and directive == 'else':
+                stack[-1][0] = USED_ALWAYS
+            else:
+                stack[-1][0] = USED_COND
+        elif directive == 'endif' and stack:
+            stack.pop()
+        elif directive == 'include':
+            m = RE_INCLUDE.match(line)
+            used = [used for used, _ in stack]
+            if m and USED_NEVER not in used:
+                incs.append((m.group(1) == '"', m.group(2),
+                             USED_COND in used))
+    return tuple(incs)
+
+
+def scan_includes(fname):
+    """Get the #include directives in a file
+
+    Args:
+        fname: Filename to read
+
+    Returns:
+        tuple of (local, name, cond) tuples, as from get_includes()
+    """
+    try:
+        with open(fname, 'r', errors='ignore') as fd:
+            data = fd.read()
+    except OSError:
+        return ()
+    return get_includes(data, fname.endswith('.h'))
+
+
+class IncludeGraph(BlobCache):
+    """Persistent #include graph of the tree
+
+    This records the headers included by each file, keyed by blob SHA like
+    IdentIndex. From this it works out which headers each file includes,
+    directly or transitively, so that files which already get a header
+    indirectly can be skipped.
+
+    Where a header could come from more than one directory (e.g. asm/io.h in
+    each arch/*/include), it only counts as including another header if all
+    of the alternatives do. Files within arch/<arch>/ only use their own
+    arch's directory. Conditional #includes (e.g. inside '#ifdef CONFIG_...')
+    do not count, since the header may not be included in every build.
+    """
+    def __init__(self, fname=None, search_paths=None):
+        """Set up the graph
+
+        Args:
+            fname: Filename to persist the graph in, or None to keep it only in
+                memory
+            search_paths: List of include paths, relative to the top of the
+                tree, which may contain wildcards; defaults to
+                INCLUDE_PATHS
+        """
+        super().__init__(fname)
+        self.search_paths = search_paths or INCLUDE_PATHS
+        self.blobs = {}         # key: blob SHA, value: includes in the blob
+        self.includes = {}      # key: filename, value: includes in the file
+        self.dirs = {}          # key: search path, value: list of dirs
+        self.reach = {}         # key: (filename, arch), value: headers
+        self.in_progress = {}   # key: (filename, arch), value: depth
+        self.closures = {}      # key: (name, arch), value: filenames
+
+    def get_state(self):
+        return self.blobs
+
+    def set_state(self, state):
+        self.blobs = state
+
+    def set_files(self, includes):
+        """Set the files in the tree and the headers they include
+
+        Args:
+            includes: dict:
+                key: filename
+                value: tuple of (local, name, cond) tuples, as from
+                    scan_includes()
+        """
+        self.includes = includes
+        all_dirs = set()
+        for fname in includes:
+            dirname = os.path.dirname(fname)
+            while dirname and dirname not in all_dirs:
+                all_dirs.add(dirname)
+                dirname = os.path.dirname(dirname)
+        self.dirs = {}
+        for path in self.search_paths:
+            self.dirs[path] = sorted([dirname for dirname in all_dirs
+                                      if fnmatch.fnmatchcase(dirname, path)])
+        self.reach = {}
+        self.closures = {}
+
+    def update(self, jobs=1):
+        """Bring the graph up to date with the tree in the current directory
+
+        Args:
+            jobs: Number of processes to use for scanning files
+        """
+        sha_of, modified = git_files()
+        todo = sorted([fname for fname, sha in sha_of.items()
+                       if fname in modified or sha not in self.blobs])
+        includes = {}
+        for fname, incs in run_files(todo, scan_includes, jobs):
+            includes[fname] = incs
+            if fname not in modified and sha_of[fname] not in self.blobs:
+                self.blobs[sha_of[fname]] = incs
+                self.changed = True
+        for fname, sha in sha_of.items():
+            if fname not in includes:
+                includes[fname] = self.blobs[sha]
+        live = set(sha_of.values())
+        for sha in [sha for sha in self.blobs if sha not in live]:
+            del self.blobs[sha]
+            self.changed = True
+        self.set_files(includes)
+
+    def update_files(self, fnames):
+        """Update the graph after files change in the working tree
+
+        The directories are only worked out again if files are added or
+        removed.
+
+        Args:
+            fnames: Iterable of filenames which changed
+        """
+        changed = {}
+        removed = []
+        for fname in fnames:
+            if os.path.exists(fname):
+                incs = scan_includes(fname)
+                if self.includes.get(fname) != incs:
+                    changed[fname] = incs
+            elif fname in self.includes:
+                removed.append(fname)
+        if removed or any(fname not in self.includes for fname in changed):
+            includes = dict(self.includes)
+            includes.update(changed)
+            for fname in removed:
+                del includes[fname]
+            self.set_files(includes)
+        elif changed:
+            self.includes.update(changed)
+            self.reach = {}
+            self.closures = {}
+
+    def get_context(self, fname):
+        """Get the arch that a file belongs to
+
+        Args:
+            fname: Filename to check
+
+        Returns:
+            Directory prefix matching the wildcard part of a search path (e.g.
+            'arch/arm' for 'arch/*/include'), or None if none
+        """
+        for path in self.search_paths:
+            parts = path.split('/')
+            for upto, part in enumerate(parts):
+                if '*' in part:
+                    root = '/'.join(parts[:upto + 1])
+                    prefix = '/'.join(fname.split('/')[:upto + 1])
+                    if fnmatch.fnmatchcase(prefix, root):
+                        return prefix
+                    break
+        return None
+
+    def resolve(self, fname, local, name, ctx):
+        """Find the files that an #include may refer to
+
+        Args:
+            fname: File containing the #include
+            local: True for #include "...", False for #include <...>
+            name: Name of the header
+            ctx: Arch context, as returned by get_context(), or None
+
+        Returns:
+            List of filenames (empty if not found in the tree)
+        """
+        if local:
+            path = os.path.normpath(os.path.join(os.path.dirname(fname), name))
+            if path in self.includes:
+                return [path]
+        for path in self.search_paths:
+            dirs = self.dirs[path]
+            if ctx and '*' in path:
+                dirs = [dirname for dirname in dirs
+                        if dirname.startswith(ctx + '/')] or dirs
+            found = []
+            for dirname in dirs:
+                hdr = os.path.join(dirname, name)
+                if hdr in self.includes:
+                    found.append(hdr)
+            if found:
+                return found
+        return []
+
+    def get_reach(self, fname, ctx=None):
+        """Get the headers that a file includes, directly or transitively
+
+        The results are memoized, so each file is only worked out once for
+        each arch.
+
+        Args:
+            fname: Filename to check
+            ctx: Arch context of the file being compiled, or None to use the
+                file's own
+
+        Returns:
+            frozenset of header names (e.g. 'linux/bug.h'), as they appear in
+            #include <...> directives
+        """
+        names, _ = self._get_reach(fname, ctx or self.get_context(fname))
+        return names
+
+    def _get_reach(self, fname, ctx):
+        """Work out the headers that a file includes
+
+        Files in an include cycle only have their result memoized once the
+        first file in the cycle is complete, since until then the results
+        are partial.
+
+        Args:
+            fname: Filename to check
+            ctx: Arch context of the file being compiled, or None
+
+        Returns:
+            tuple:
+                frozenset of header names
+                Depth of the earliest file in an unfinished include cycle
+                    that was found, or None if none
+        """
+        key = (fname, ctx)
+        if key in self.reach:
+            return self.reach[key], None
+        if key in self.in_progress:
+            return frozenset(), self.in_progress[key]
+        depth = len(self.in_progress)
+        self.in_progress[key] = depth
+        names = set()
+        low = None
+        for local, name, cond in self.includes.get(fname, ()):
+            if cond:
+                continue
+            if not local:
+                names.add(name)
+            sets = []
+            for hdr in self.resolve(fname, local, name, ctx):
+                reach, hdr_low = self._get_reach(
+                    hdr, ctx or self.get_context(hdr))
+                sets.append(reach)
+                if hdr_low is not None and (low is None or hdr_low < low):
+                    low = hdr_low
+            if sets:
+                names |= frozenset.intersection(*sets)
+        del self.in_progress[key]
+        result = frozenset(names)
+        if low is None or low >= depth:
+            self.reach[key] = result
+            low = None
+        return result, low
+
+    def reaches(self, fname, hdr):
+        """Check whether a file already includes a header
+
+        Args:
+            fname: Filename to check
+            hdr: Header to look for (e.g. 'linux/bug.h')
+
+        Returns:
+            True if the file includes the header directly or transitively
+        """
+        return hdr in self.get_reach(fname)
+
+    def get_closure(self, fname, local, name, ctx):
+        """Get the header files that an #include brings in
+
+        Where a header could come from more than one directory, all the
+        alternatives are included, as are conditional #includes. Results for
+        #include <...> are memoized.
+
+        Args:
+            fname: File containing the #include
+            local: True for #include "...", False for #include <...>
+            name: Name of the header
+            ctx: Arch context, as returned by get_context(), or None
+
+        Returns:
+            frozenset of filenames, including the header itself
+        """
+        key = (name, ctx)
+        if not local and key in self.closures:
+            return self.closures[key]
+        seen = set()
+        todo = self.resolve(fname, local, name, ctx)
+        while todo:
+            hdr = todo.pop()
+            if hdr in seen:
+                continue
+            seen.add(hdr)
+            for inc_local, inc_name, _ in self.includes.get(hdr, ()):
+                todo += self.resolve(hdr, inc_local, inc_name, ctx)
+        result = frozenset(seen)
+        if not local:
+            self.closures[key] = result
+        return result
+
+
+def get_include_graph(jobs=1):
+    """Get an #include graph for the tree in the current directory
+
+    The graph is kept in the git directory and updated before it is returned.
+
+    Args:
+        jobs: Number of processes to use for scanning files
+
+    Returns:
+        IncludeGraph object
+    """
+    graph = IncludeGraph(get_cache_fname('inc'))
+    graph.load()
+    graph.update(jobs)
+    graph.save()
+    return graph
+
+
+# Matches a line of 'cc -H' output, e.g. '.. include/linux/types.h'
+RE_TRACE = re.compile(r'^(\.+) (.*)$')
+
+
+def trace_includes(fname, settings):
+    """Run the preprocessor on a file to find the headers it includes
+
+    Args:
+        fname: C file to preprocess
+        settings: tuple:
+            str: C compiler to use (e.g. 'gcc')
+            str: Arch to use for files outside arch/ (e.g. 'sandbox')
+            tuple of str: Extra flags to pass to the compiler
+
+    Returns:
+        List of (depth, path) tuples, in the order the headers were opened,
+        where depth is 1 for headers included by the file itself
+    """
+    cc, arch, cflags = settings
+    parts = fname.split('/')
+    if parts[0] == 'arch' and len(parts) > 2:
+        arch = parts[1]
+    cmd = [cc, '-E', '-H', '-w', '-o', os.devnull, '-Iinclude',
+           '-Iarch/%s/include' % arch] + list(cflags) + [fname]
+    result = command.RunPipe([cmd], capture=True, capture_stderr=True,
+                             raise_on_error=False)
+    trace = []
+    for line in result.stderr.splitlines():
+        m = RE_TRACE.match(line)
+        if m:
+            trace.append((len(m.group(1)), os.path.normpath(m.group(2))))
+    return trace
+
+
+class CostCache(BlobCache):
+    """Persistent record of the headers included when compiling each C file
+
+    This is keyed by the blob SHA of the C file. Each trace also records the
+    blob SHA of each header in the tree that it opened, so it is thrown away
+    when any of those headers changes.
+    """
+    def __init__(self, fname=None, settings=None):
+        """Set up the cache
+
+        Args:
+            fname: Filename to persist the cache in, or None to keep it only in
+                memory
+            settings: Settings for trace_includes(); the cache is discarded if
+                these change
+        """
+        super().__init__(fname)
+        self.settings = settings
+        self.traces = {}    # key: blob SHA, value: list of (depth, path, sha)
+
+    def get_state(self):
+        return self.settings, self.traces
+
+    def set_state(self, state):
+        settings, traces = state
+        if settings == self.settings:
+            self.traces = traces
+
+    def update(self, jobs=1):
+        """Bring the cache up to date with the tree in the current directory
+
+        Args:
+            jobs: Number of processes to use to run the preprocessor
+
+        Returns:
+            dict:
+                key: C filename
+                value: list of (depth, path) tuples, as from trace_includes()
+        """
+        sha_of, modified = git_files()
+        cfiles = sorted([fname for fname in sha_of
+                         if fname.endswith('.c') and want_file(fname)])
+
+        def is_valid(trace):
+            return all(sha is None or (path not in modified and
+                                       sha_of.get(path) == sha)
+                       for _, path, sha in trace)
+
+        todo = [fname for fname in cfiles
+                if fname in modified or sha_of[fname] not in self.traces or
+                not is_valid(self.traces[sha_of[fname]])]
+        func = functools.partial(trace_includes, settings=self.settings)
+        traces = {}
+        for fname, trace in run_files(todo, func, jobs):
+            traces[fname] = trace
+            if fname not in modified:
+                self.traces[sha_of[fname]] = [(depth, path, sha_of.get(path))
+                                              for depth, path in trace]
+                self.changed = True
+        for fname in cfiles:
+            if fname not in traces:
+                traces[fname] = [(depth, path) for depth, path, _ in
+                                 self.traces[sha_of[fname]]]
+        live = set(sha_of.values())
+        for sha in [sha for sha in self.traces if sha not in live]:
+            del self.traces[sha]
+            self.changed = True
+        return traces
+
+
+def get_hdr_name(path):
+    """Get the name used to #include a header
+
+    Args:
+        path: Path to the header (e.g. 'arch/arm/include/asm/io.h')
+
+    Returns:
+        Name as used in #include <...> (e.g. 'asm/io.h'), or the path if it is
+        not in an include directory
+    """
+    m = re.match(r'(arch/[^/]+/)?include/(.*)', path)
+    return m.group(2) if m else path
+
+
+def get_header_costs(traces, sizes=None):
+    """Work out how much each header costs to compile, across the tree
+
+    The cost of each inclusion of a header is its size plus that of all the
+    headers it brings in which were not already included.
+
+    Args:
+        traces: dict of traces, as returned by CostCache.update()
+        sizes: dict of file sizes, which is updated as files are checked:
+            key: path
+            value: size in bytes
+
+    Returns:
+        dict:
+            key: header name (e.g. 'linux/printk.h')
+            value: collections.Counter with:
+                bytes: total bytes preprocessed because of the header
+                includes: number of times the header was opened
+                direct: number of times it was included by a C file
+    """
+    if sizes is None:
+        sizes = {}
+    costs = collections.defaultdict(collections.Counter)
+
+    def finish(stack):
+        _, path, total = stack.pop()
+        cost = costs[get_hdr_name(path)]
+        cost['bytes'] += total
+        cost['includes'] += 1
+        if not stack:
+            cost['direct'] += 1
+        else:
+            stack[-1][2] += total
+
+    for trace in traces.values():
+        stack = []
+        for depth, path in trace:
+            while stack and stack[-1][0] >= depth:
+                finish(stack)
+            if path not in sizes:
+                sizes[path] = (os.path.getsize(path) if os.path.exists(path)
+                               else 0)
+            stack.append([depth, path, sizes[path]])
+        while stack:
+            finish(stack)
+    return costs
+
+
+def get_costs(jobs=1, settings=None):
+    """Get the compile cost of each header in the tree in the current directory
+
+    The traces are cached in the git directory, so only C files which have
+    changed, or whose headers have changed, are preprocessed again.
+
+    Args:
+        jobs: Number of processes to use to run the preprocessor
+        settings: Settings for trace_includes()
+
+    Returns:
+        dict of costs, as returned by get_header_costs()
+    """
+    cache = CostCache(get_cache_fname('cost'), settings)
+    cache.load()
+    traces = cache.update(jobs)
+    cache.save()
+    return get_header_costs(traces)
+
+
+class OutcomeCache(BlobCache):
+    """Persistent record of the outcome of applying recipes to each file
+
+    This is keyed by the blob SHA of the file and a hash of the recipes, so a
+    file only needs to be processed again if it changes, or the recipes or
+    this script change.
+
+    Only outcomes which leave the file unchanged (e.g. because the header is
+    already included, or the file needs checking manually) are recorded. A
+    file which is updated is modified in the working tree, so its blob SHA
+    would not match anyway.
+    """
+    def __init__(self, fname=None, kconfig=None):
+        """Set up the cache
+
+        Args:
+            fname: Filename to persist the cache in, or None to keep it only in
+                memory
+            kconfig: Kconfig being used, or None; outcomes are kept separately
+                for each set of configs
+        """
+        super().__init__(fname)
+        self.outcomes = {}  # key: (blob SHA, key), value: tuple of messages
+        self.sha_of = {}
+        self.code_hash = None
+        self.configs = None
+        if kconfig:
+            self.configs = [sorted(config.items())
+                            for config in kconfig.configs]
+
+    def get_state(self):
+        return self.outcomes
+
+    def set_state(self, state):
+        self.outcomes = state
+
+    def get_code_hash(self):
+        """Get a hash of this script, so outcomes are redone when it changes
+
+        Returns:
+            str: hex digest
+        """
+        if self.code_hash is None:
+            with open(__file__, 'rb') as fd:
+                self.code_hash = hashlib.sha1(fd.read()).hexdigest()
+        return self.code_hash
+
+    def get_key(self, fname, recipes):
+        """Get the key for the outcome of applying recipes to a file
+
+        Args:
+            fname: Filename to check
+            recipes: List of Recipe to apply, in order
+
+        Returns:
+            str: hex digest
+        """
+        settings = [(recipe.hdr, recipe.scanner.items, recipe.skip_if_hdrs,
+                     fname in recipe.skip_files) for recipe in recipes]
+        return hashlib.sha1(repr((self.get_code_hash(), settings,
+                                  self.configs)).encode()).hexdigest()
+
+    def lookup(self, fnames, recipes):
+        """Find the files which have a recorded outcome
+
+        This also drops outcomes for blobs which are no longer in the tree.
+
+        Args:
+            fnames: List of filenames to check
+            recipes: List of Recipe to apply, in order
+
+        Returns:
+            tuple:
+                List of filenames which must be processed
+                dict of outcomes for the others:
+                    key: filename
+                    value: list of (hdr, msg) tuples, as returned by
+                        process_file_multi()
+        """
+        self.sha_of, modified = git_files()
+        live = set(self.sha_of.values())
+        for key in [key for key in self.outcomes if key[0] not in live]:
+            del self.outcomes[key]
+            self.changed = True
+        todo = []
+        cached = {}
+        for fname in fnames:
+            sha = self.sha_of.get(fname)
+            msgs = None
+            if sha and fname not in modified:
+                msgs = self.outcomes.get((sha, self.get_key(fname, recipes)))
+            if msgs is None:
+                todo.append(fname)
+            else:
+                cached[fname] = list(msgs)
+        return todo, cached
+
+    def record(self, results, recipes, written=None):
+        """Record the outcomes for files which were not changed
+
+        Args:
+            results: List of (fname, msgs) tuples, as returned by run_files()
+                with process_file_multi()
+            recipes: List of Recipe which were applied
+            written: List of files which were updated without changing the
+                working tree, or None
+        """
+        modified = set(command.Output('git', 'ls-files', '-m',
+                                      '-z').split('\0'))
+        modified.update(written or [])
+        for fname, msgs in results:
+            sha = self.sha_of.get(fname)
+            if sha and fname not in modified:
+                self.outcomes[(sha, self.get_key(fname, recipes))] = tuple(msgs)
+                self.changed = True
+
+
+def get_outcome_cache(kconfig=None):
+    """Get the outcome cache for the tree in the current directory
+
+    Args:
+        kconfig: Kconfig being used, or None
+
+    Returns:
+        OutcomeCache object
+    """
+    cache = OutcomeCache(get_cache_fname('out'), kconfig)
+    cache.load()
+    return cache
+
+
+def changed_files(rev):
+    """Get the files which have changed since a revision
+
+    This includes changes in the working tree which are not committed yet,
+    including new files which are not yet known to git (but not those which
+    are ignored).
+
+    Args:
+        rev: Revision to compare against (e.g. 'origin/master')
+
+    Returns:
+        Sorted list of filenames, not including deleted files
+    """
+    out = command.Output('git', 'diff', '--name-only', '--diff-filter=d',
+                         '-z', rev)
+    out += command.Output('git', 'ls-files', '--others', '--exclude-standard',
+                          '-z')
+    return sorted(set([fname for fname in out.split('\0') if fname]))
+
+
+def read_file(fname, store=None, scanners=None):
+    """Read a file, if it is one that we can process
+
+    Line endings are left as they are.
+
+    Args:
+        fname: Filename to read
+        store: GitStore to read the file from, or None to read it from the
+            working tree
+        scanners: List of Scanner, or None. If provided, a file from the
+            working tree is ignored unless at least one of them may match it.
+            This is checked on the raw file before it is decoded.
+
+    Returns:
+        tuple:
+            str: file contents
+            bool: True if this is a header file
+        or None if the file should be ignored
+    """
+    suffix = fname[-2:]
+    is_hdr_file = suffix == '.h'
+    if is_hdr_file:
+        if fname.startswith('include/linux') and not 'soc' in fname:
+            return None
+    elif suffix != '.c':
+        return None
+    if store:
+        return store.read(fname), is_hdr_file
+    with open(fname, 'rb') as fd:
+        if not os.fstat(fd.fileno()).st_size:
+            return None if scanners else ('', is_hdr_file)
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if scanners and not any([scanner.may_match(buf)
+                                     for scanner in scanners]):
+                return None
+            raw = buf[:]
+    return raw.decode('utf-8', errors='surrogateescape'), is_hdr_file
+
+
+def write_file(fname, out):
+    """Write out a file that has been updated
+
+    Args:
+        fname: Filename to write
+        out: List of lines to write
+    """
+    with open(fname, 'w') as fd:
+        for line in out:
+            print(line, file=fd)
+
+
+def write_data(fname, data):
+    """Write out a file that has been updated, in one call
+
+    Args:
+        fname: Filename to write
+        data: String containing the new contents, with its line endings
+    """
+    with open(fname, 'w', encoding='utf-8', newline='',
+              errors='surrogateescape') as fd:
+        fd.write(data)
+
+
+def run_git(args, data=None, env=None):
+    """Run a git command, optionally passing it data on stdin
+
+    Args:
+        args: List of arguments to pass to git
+        data: String to pass on stdin, or None
+        env: dict of extra environment variables to set, or None
+
+    Returns:
+        str: Output from the command
+
+    Raises:
+        ValueError: if the command fails
+    """
+    full_env = None
+    if env:
+        full_env = dict(os.environ)
+        full_env.update(env)
+    pipe = subprocess.Popen(['git'] + args, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            env=full_env, universal_newlines=True)
+    out, err = pipe.communicate(data)
+    if pipe.returncode:
+        raise ValueError("git %s failed: %s" % (' '.join(args), err.strip()))
+    return out
+
+
+class GitStore:
+    """Reads files from a git index and writes them without using the tree
+
+    Files are read from their blobs through a single 'git cat-file --batch'
+    process and updated files are written to a separate directory. Nothing
+    in the working tree is touched. Once the files have been processed,
+    commit() adds them to the index, or builds a new commit from them.
+
+    This can be passed to worker processes. Each one starts its own
+    'git cat-file' process when it first needs it.
+
+    Properties:
+        message: Commit message to use, or None to update the git index
+        outdir: Directory that updated files are written to
+        index_fname: Index file to use, or None for the normal one
+        head: Commit to use as the parent of the next commit
+        entries: dict of files in the index:
+            key: filename
+            value: tuple:
+                str: mode (e.g. '100644')
+                str: blob SHA
+    """
+    def __init__(self, message=None):
+        """Set up the store
+
+        Args:
+            message: Commit message to use, or None to update the git index
+                directly
+        """
+        self.message = message
+        self.tmpdir = tempfile.mkdtemp(prefix='hdr_include.')
+        self.outdir = os.path.join(self.tmpdir, 'out')
+        self.index_fname = None
+        self.head = None
+        if message:
+            # Use a separate index holding HEAD, so the real one is not
+            # changed and nothing staged there ends up in the commit
+            self.index_fname = os.path.join(self.tmpdir, 'index')
+            self.head = run_git(['rev-parse', 'HEAD']).strip()
+            run_git(['read-tree', self.head], env=self.get_env())
+        self.entries = {}
+        self.proc = None
+        self.load_index()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['proc'] = None
+        return state
+
+    def set_head(self, commit):
+        """Build the next commit on top of a given one
+
+        Args:
+            commit: Commit to use as the parent, whose tree is read into the
+                index
+        """
+        self.head = commit
+        run_git(['read-tree', commit], env=self.get_env())
+        self.load_index()
+
+    def get_env(self):
+        """Get the environment variables needed for git commands
+
+        Returns:
+            dict of environment variables
+        """
+        return {'GIT_INDEX_FILE': self.index_fname} if self.index_fname else {}
+
+    def load_index(self):
+        """Read the files and their blobs from the index"""
+        self.entries = {}
+        out = run_git(['ls-files', '-s', '-z'], env=self.get_env())
+        for entry in out.split('\0'):
+            if not entry:
+                continue
+            info, fname = entry.split('\t', 1)
+            mode, sha, _ = info.split()
+            if mode != '120000':
+                self.entries[fname] = (mode, sha)
+
+    def read(self, fname):
+        """Read a file from its blob
+
+        Args:
+            fname: Filename to read
+
+        Returns:
+            str: Contents of the file
+        """
+        if not self.proc:
+            self.proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+        self.proc.stdin.write(self.entries[fname][1].encode() + b'\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            raise ValueError("Cannot read blob for '%s'" % fname)
+        data = self.proc.stdout.read(int(header[2]))
+        self.proc.stdout.read(1)  # Newline after the contents
+        return data.decode('utf-8', errors='surrogateescape')
+
+    def write(self, fname, data):
+        """Write out a file that has been updated
+
+        Args:
+            fname: Filename to write
+            data: String containing the new contents
+        """
+        path = os.path.join(self.outdir, fname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_data(path, data)
+
+    def get_written(self):
+        """Get the files which have been written
+
+        Returns:
+            Sorted list of filenames, relative to the top of the tree
+        """
+        fnames = []
+        for dirpath, _, leaves in os.walk(self.outdir):
+            for leaf in leaves:
+                fnames.append(os.path.relpath(os.path.join(dirpath, leaf),
+                                              self.outdir))
+        return sorted(fnames)
+
+    def commit(self):
+        """Add the files which have been written to the index or a commit
+
+        Afterwards the index is read again, so that the store can be used for
+        another run, which builds on this one.
+
+        Returns:
+            tuple:
+                List of files which were updated
+                str: New commit, or None if updating the git index
+        """
+        fnames = self.get_written()
+        if not fnames:
+            return fnames, None
+        paths = ''.join([os.path.join(self.outdir, fname) + '\n'
+                         for fname in fnames])
+        shas = run_git(['hash-object', '-w', '--no-filters', '--stdin-paths'],
+                       paths).split()
+        info = ''.join(['%s %s\t%s\0' % (self.entries[fname][0], sha, fname)
+                        for fname, sha in zip(fnames, shas)])
+        run_git(['update-index', '-z', '--index-info'], info, self.get_env())
+        commit = None
+        if self.message:
+            tree = run_git(['write-tree'], env=self.get_env()).strip()
+            commit = run_git(['commit-tree', tree, '-p', self.head, '-m',
+                              self.message]).strip()
+            self.head = commit
+        shutil.rmtree(self.outdir)
+        self.load_index()
+        return fnames, commit
+
+    def close(self):
+        """Stop the 'git cat-file' process and remove temporary files"""
+        if self.proc:
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            self.proc.wait()
+            self.proc = None
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def process_file(fname, func, insert_hdr, to_check_hdr, ignore_fragments,
+                 all_to_check, skip_if_hdrs):
+    skip = False
+    show_only = None
+    #show_only = 'fs/btrfs/inode.c':
+    info = read_file(fname)
+    if not info:
+        return
+    data, is_hdr_file = info
+    if show_only:
+        if fname != show_only:
+            return
+        print('fname', fname)
+    out = process_data(data, func, insert_hdr, ignore_fragments, is_hdr_file,
+                       skip_if_hdrs)
+    if out:
+        if skip:
+            # Don't process this but indicate that it needs a look
+            if fname in to_check_hdr:
+                to_check_hdr[fname].append(func)
+            else:
+                to_check_hdr[fname] = [func]
+                skip = False
+            all_to_check.append(fname)
+        if skip:
+            pass
+        elif isinstance(out, str):
+            if show_only or not out.startswith('>'): # minor issue
+                print('Check %s: %s' % (fname, out))
+                all_to_check.append(fname)
+        else:
+            write_file(fname, out)
+
+
+# A recipe ready to be applied to files. This holds only what the worker
+# processes need, so that it is cheap to send to them:
+#    scanner: Scanner object for the recipe's symbols
+#    hdr: Header to add (e.g. 'linux/bug.h')
+#    skip_if_hdrs: List of header files that already include hdr
+#        transitively, or None
+#    skip_files: Set of files to leave alone, e.g. because they include hdr
+#        indirectly
+Recipe = collections.namedtuple('Recipe', 'scanner,hdr,skip_if_hdrs,skip_files')
+
+
+def count_scan(prof, scanner, found):
+    """Update the profile counters for items rejected by a scan
+
+    Args:
+        prof: Profile to update
+        scanner: Scanner that was used
+        found: dict returned by scanner.scan()
+    """
+    for func, ignore_fragments in scanner.items:
+        prof.count(func, PROF_EXAMINED)
+        if func not in found:
+            prof.count(func, PROF_FAST_REJECT)
+        elif ignore_fragments and not found[func]:
+            prof.count(func, PROF_FRAGMENT_REJECT)
+
+
+def apply_recipe(data, is_hdr_file, recipe, prof=None, kconfig=None):
+    """Work out the change needed to some file contents for a recipe
+
+    Args:
+        data: String containing the file contents
+        is_hdr_file: True if this is a header file
+        recipe: Recipe to apply
+        prof: Profile to update, or None
+        kconfig: Kconfig to use to find the live parts of the file, or None
+
+    Returns:
+        tuple:
+            str: Updated file contents, or None if no change is needed
+            str: Message if the file needs to be checked manually, else None
+    """
+    with timer(prof, 'scan'):
+        found = recipe.scanner.scan(data)
+    if prof:
+        count_scan(prof, recipe.scanner, found)
+    for func, ignore_fragments in recipe.scanner.select(found):
+        with timer(prof, 'process_data'):
+            linenum = get_insert_line(data, func, recipe.hdr, ignore_fragments,
+                                      is_hdr_file, recipe.skip_if_hdrs, prof,
+                                      kconfig)
+        if prof:
+            if linenum is None:
+                prof.count(func, PROF_FRAGMENT_REJECT)
+            elif isinstance(linenum, str):
+                prof.count(func, PROF_SKIP_IF if linenum.startswith('>')
+                           else PROF_CHECK)
+            else:
+                prof.count(func, PROF_REWRITTEN)
+        if linenum is None:
+            continue
+        if isinstance(linenum, str):
+            # The message applies to the file, not just this symbol
+            return None, None if linenum.startswith('>') else linenum
+        return insert_line(data, linenum, '#include <%s>' % recipe.hdr), None
+    return None, None
+
+
+def process_file_multi(fname, recipes, prof=None, store=None, kconfig=None):
+    """Process a file for all the symbols in one or more recipes
+
+    The file is read once and written at most once, no matter how many
+    headers are added. Each recipe sees the changes made by the ones before
+    it, so the new #includes are placed correctly relative to each other.
+
+    This does not print anything, so it is safe to call from a worker process.
+
+    Args:
+        fname: Filename to process
+        recipes: List of Recipe to apply, in order
+        prof: Profile to update, or None
+        store: GitStore to read and write the file, or None to use the
+            working tree
+        kconfig: Kconfig to use to find the live parts of the file, or None
+
+    Returns:
+        List of (hdr, msg) tuples, one for each recipe which needs the file to
+        be checked manually
+    """
+    with timer(prof, 'read'):
+        info = read_file(fname, store,
+                         [recipe.scanner for recipe in recipes
+                          if fname not in recipe.skip_files])
+    if not info:
+        return []
+    data, is_hdr_file = info
+    msgs = []
+    changed = False
+    for recipe in recipes:
+        if fname in recipe.skip_files:
+            if prof:
+                prof.totals['skip_graph'] += 1
+            continue
+        out, msg = apply_recipe(data, is_hdr_file, recipe, prof, kconfig)
+        if msg:
+            msgs.append((recipe.hdr, msg))
+        elif out:
+            data = out
+            changed = True
+    if changed:
+        with timer(prof, 'write'):
+            if store:
+                store.write(fname, data)
+            else:
+                write_data(fname, data)
+        if prof:
+            prof.totals['files_rewritten'] += 1
+    return msgs
+
+
+def rename_file(fname, renames, store=None):
+    """Rename #includes in a file, writing it only if it changes
+
+    This does not print anything, so it is safe to call from a worker process.
+
+    Args:
+        fname: Filename to process
+        renames: List of (old_hdr, new_hdr) tuples
+        store: GitStore to read and write the file, or None to use the
+            working tree
+
+    Returns:
+        True if the file was written
+    """
+    info = read_file(fname, store)
+    if not info:
+        return False
+    data, is_hdr_file = info
+    new_data = rename_data(data, renames, is_hdr_file)
+    if new_data is None or new_data == data:
+        return False
+    if store:
+        store.write(fname, new_data)
+    else:
+        write_data(fname, new_data)
+    return True
+
+
+def profile_file(fname, recipes, store=None, kconfig=None):
+    """Process a file, recording timings and counters
+
+    This is used in place of process_file_multi() when profiling. It can be
+    called from a worker process, since the profile is returned rather than
+    updated in place.
+
+    Args:
+        fname: Filename to process
+        recipes: List of Recipe to apply, in order
+        store: GitStore to read and write the file, or None to use the
+            working tree
+        kconfig: Kconfig to use to find the live parts of the file, or None
+
+    Returns:
+        tuple:
+            List of (hdr, msg) tuples, as returned by process_file_multi()
+            Profile for this file
+    """
+    prof = Profile()
+    start = perf_counter()
+    msgs = process_file_multi(fname, recipes, prof, store, kconfig)
+    prof.files[fname] = perf_counter() - start
+    prof.totals['files_examined'] += 1
+    return msgs, prof
+
+
+class Options:
+    """Settings which control how conversions are run
+
+    Properties:
+        jobs: Number of processes to use
+        index: IdentIndex to use to find files, or None to use 'git grep'
+        graph: IncludeGraph to use to skip files which already include a
+            header indirectly, or None
+        paths: List of files to limit processing to, or None for all
+        profile: Profile to record timings and counters in, or None
+        built: Set of C files which are built, as from get_built_files(), or
+            None to process all C files
+        outcomes: OutcomeCache to reuse the outcomes of previous runs, or
+            None
+        store: GitStore to read and write files through git, without
+            touching the working tree, or None to use the working tree
+        kconfig: Kconfig to use to ignore code which is not used with the
+            board configs, or None
+        journal: Journal to record completed shards in, so the run can be
+            resumed, or None
+        shard_set: tuple (index, count) to handle only some of the shards,
+            as used by in_shard_set(), or None for all
+    """
+    def __init__(self, jobs=1, index=None, graph=None, paths=None,
+                 profile=None, built=None, outcomes=None, store=None,
+                 kconfig=None, journal=None, shard_set=None):
+        self.jobs = jobs
+        self.index = index
+        self.graph = graph
+        self.paths = paths
+        self.profile = profile
+        self.built = built
+        self.outcomes = outcomes
+        self.store = store
+        self.kconfig = kconfig
+        self.journal = journal
+        self.shard_set = shard_set
+
+
+def find_files(items, opts):
+    """Find the files which may need processing for a list of symbols
+
+    Args:
+        items: List of (func, ignore_fragments) tuples
+        opts: Options to use
+
+    Returns:
+        List of filenames
+    """
+    if opts.index:
+        fnames = opts.index.lookup(items)
+        if opts.paths is not None:
+            wanted = set(opts.paths)
+            fnames = [fname for fname in fnames if fname in wanted]
+        return fnames
+    return grep_files(Scanner(items).funcs, opts.paths,
+                      cached=opts.store is not None)
+
+
+# Number of directory levels used to split files into shards, e.g. 2 puts
+# drivers/net/*.c and drivers/net/phy/*.c in the 'drivers/net' shard
+SHARD_DEPTH = 2
+
+# Number of shards to process between saves of the outcome cache
+OUTCOME_SAVE_SHARDS = 50
+
+
+def shard_files(fnames, depth=SHARD_DEPTH):
+    """Split a list of files into shards by directory
+
+    Args:
+        fnames: List of filenames
+        depth: Number of directory levels to use to name each shard
+
+    Returns:
+        OrderedDict:
+            key: shard name, e.g. 'drivers/net', or '.' for the top level
+            value: list of filenames in the shard, in the original order
+        The shards are sorted by name
+    """
+    shards = collections.defaultdict(list)
+    for fname in fnames:
+        parts = os.path.dirname(fname).split('/')[:depth]
+        shards['/'.join(parts) or '.'].append(fname)
+    return collections.OrderedDict(sorted(shards.items()))
+
+
+def in_shard_set(shard, shard_set):
+    """Check whether a shard is one that this process should handle
+
+    Shards are assigned by a hash of their name, so that every worker agrees
+    on the assignment even if they find slightly different files.
+
+    Args:
+        shard: Shard name
+        shard_set: tuple (index, count), meaning that this is worker number
+            index (counting from 0) out of count, or None to handle all
+
+    Returns:
+        True if this process should handle the shard
+    """
+    if not shard_set:
+        return True
+    index, count = shard_set
+    digest = hashlib.sha1(shard.encode('utf-8')).hexdigest()
+    return int(digest, 16) % count == index
+
+
+def get_run_key(recipes, opts):
+    """Get a key which identifies a run, so that it can be resumed
+
+    Args:
+        recipes: List of Recipe being applied
+        opts: Options being used; the paths, built files and kconfig all
+            affect which files are processed and how
+
+    Returns:
+        str: hex digest
+    """
+    settings = [(recipe.hdr, recipe.scanner.items, recipe.skip_if_hdrs)
+                for recipe in recipes]
+    paths = sorted(opts.paths) if opts.paths is not None else None
+    built = sorted(opts.built) if opts.built is not None else None
+    configs = None
+    if opts.kconfig:
+        configs = [sorted(config.items()) for config in opts.kconfig.configs]
+    return hashlib.sha1(repr((settings, paths, built,
+                              configs)).encode()).hexdigest()
+
+
+class Journal:
+    """Record of the shards completed in a run, so that it can be resumed
+
+    Each completed shard is appended to the journal file as a line of JSON,
+    along with the messages for its files. A line which was only partly
+    written (e.g. because the run was killed) is ignored.
+
+    Journals written by separate workers can be read together, to produce
+    a single report.
+
+    When building a commit, each shard also records the commit containing
+    its changes, so that a resumed run can carry on from there.
+    """
+    def __init__(self, fnames):
+        """Set up the journal
+
+        Args:
+            fnames: List of journal filenames to read; completed shards are
+                written to the first one
+        """
+        self.fnames = fnames
+
+    def load(self, key):
+        """Load the completed shards for a run
+
+        Args:
+            key: Key for the run, from get_run_key()
+
+        Returns:
+            dict:
+                key: shard name
+                value: list of (fname, msgs) tuples, where msgs is as returned
+                    by process_file_multi()
+        """
+        done = {}
+        for fname in self.fnames:
+            if not os.path.exists(fname):
+                continue
+            with open(fname) as fd:
+                for line in fd:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get('key') != key:
+                        continue
+                    done[entry['shard']] = [
+                        (fname, [tuple(msg) for msg in msgs])
+                        for fname, msgs in entry['results']]
+        return done
+
+    def get_commit(self, key):
+        """Get the last commit recorded for a run by this worker
+
+        Args:
+            key: Key for the run, from get_run_key()
+
+        Returns:
+            str: Commit, or None if none
+        """
+        commit = None
+        if os.path.exists(self.fnames[0]):
+            with open(self.fnames[0]) as fd:
+                for line in fd:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get('key') == key and entry.get('commit'):
+                        commit = entry['commit']
+        return commit
+
+    def record(self, key, shard, results, commit=None):
+        """Record that a shard is complete
+
+        Args:
+            key: Key for the run, from get_run_key()
+            shard: Shard name
+            results: List of (fname, msgs) tuples for the files in the shard
+            commit: Commit containing the changes so far, or None
+        """
+        entry = {'key': key, 'shard': shard,
+                 'results': [[fname, msgs] for fname, msgs in results if msgs]}
+        if commit:
+            entry['commit'] = commit
+        line = json.dumps(entry)
+        with open(self.fnames[0], 'a') as fd:
+            fd.write(line + '\n')
+            fd.flush()
+            os.fsync(fd.fileno())
+
+
+def run_recipes(convs, opts):
+    """Apply a list of header conversions to the tree
+
+    Candidate files are found once for all the conversions, then each file is
+    read and written at most once.
+
+    Args:
+        convs: List of HdrConv objects to apply, in order
+        opts: Options to use
+
+    Returns:
+        List of files which need to be checked manually
+    """
+    all_items = []
+    scanners = []
+    for conv in convs:
+        items = conv.get_items()
+        all_items += items
+        scanners.append(Scanner(items))
+    prof = opts.profile
+    with timer(prof, 'find'):
+        fnames = find_files(all_items, opts)
+    fnames, not_built = split_built(fnames, opts.built)
+    recipes = []
+    for conv, scanner in zip(convs, scanners):
+        skip_files = set()
+        if opts.graph:
+            with timer(prof, 'graph'):
+                skip_files = set([fname for fname in fnames
+                                  if opts.graph.reaches(fname, conv.hdr)])
+        recipes.append(Recipe(scanner, conv.hdr, conv.skip_if_hdrs,
+                              skip_files))
+
+    msgs_of = {}
+    if opts.journal:
+        key = get_run_key(recipes, opts)
+        done = opts.journal.load(key)
+        commit = opts.journal.get_commit(key)
+        if commit and opts.store and opts.store.message:
+            # Carry on from the changes made before the run was interrupted
+            opts.store.set_head(commit)
+            print('Continuing from commit %s' % commit)
+        skipped = 0
+        shards = collections.OrderedDict()
+        for shard, shard_fnames in shard_files(fnames).items():
+            if shard in done:
+                msgs_of.update(done[shard])
+            elif not in_shard_set(shard, opts.shard_set):
+                skipped += 1
+            else:
+                shards[shard] = shard_fnames
+        msgs_of.update(process_files(None, recipes, opts, shards, key))
+        if done:
+            print('Resumed after %d completed shards' % len(done))
+        if skipped:
+            print('Skipped %d shards for other workers' % skipped)
+    else:
+        msgs_of.update(process_files(fnames, recipes, opts))
+
+    all_to_check = []
+    for fname in fnames:
+        for hdr, msg in msgs_of.get(fname, []):
+            if len(convs) > 1:
+                print('Check %s: %s: %s' % (fname, hdr, msg))
+            else:
+                print('Check %s: %s' % (fname, msg))
+            all_to_check.append(fname)
+    if not_built:
+        print('Skipped %d files which are not built: %s' %
+              (len(not_built), ' '.join(not_built)))
+    return all_to_check
+
+
+def process_files(fnames, recipes, opts, shards=None, key=None):
+    """Apply recipes to a list of files
+
+    The outcome cache is looked up once and a single pool of worker processes
+    is used for the whole run, even when it is split into shards.
+
+    Args:
+        fnames: List of filenames to process, or None if shards is given
+        recipes: List of Recipe to apply, in order
+        opts: Options to use
+        shards: OrderedDict of shards to process, as from shard_files(), or
+            None to process fnames as a single batch. Each shard is committed
+            (if there is a store) and recorded in opts.journal when it is
+            complete
+        key: Key for the run, from get_run_key(), used with opts.journal
+
+    Returns:
+        List of (fname, msgs) tuples, where msgs is as returned by
+            process_file_multi(). Files which do not need processing may be
+            left out
+    """
+    prof = opts.profile
+    if shards is None:
+        shards = collections.OrderedDict([(None, fnames)])
+    else:
+        fnames = [fname for shard_fnames in shards.values()
+                  for fname in shard_fnames]
+    todo = fnames
+    cached = {}
+    if opts.outcomes:
+        with timer(prof, 'outcomes'):
+            todo, cached = opts.outcomes.lookup(fnames, recipes)
+
+    store = opts.store
+    if store:
+        # Files which are not in the index cannot be read from it
+        todo = [fname for fname in todo if fname in store.entries]
+    todo = set(todo)
+    if prof:
+        func = functools.partial(profile_file, recipes=recipes, store=store,
+                                 kconfig=opts.kconfig)
+    else:
+        func = functools.partial(process_file_multi, recipes=recipes,
+                                 store=store, kconfig=opts.kconfig)
+    results = []
+    pending = []  # Results not yet recorded in the outcome cache
+    written = []
+    commit = None
+    pool = None
+    if opts.jobs > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(opts.jobs)
+    try:
+        for seq, (shard, shard_fnames) in enumerate(shards.items()):
+            shard_results = []
+            with timer(prof, 'files'):
+                for fname, msgs in run_files([fname for fname in shard_fnames
+                                              if fname in todo], func,
+                                             opts.jobs, pool):
+                    if prof:
+                        msgs, file_prof = msgs
+                        prof.merge(file_prof)
+                    shard_results.append((fname, msgs))
+            if store:
+                with timer(prof, 'commit'):
+                    shard_written, shard_commit = store.commit()
+                written += shard_written
+                commit = shard_commit or commit
+            if opts.journal and shard is not None:
+                opts.journal.record(key, shard, shard_results + sorted(
+                    [(fname, cached[fname]) for fname in shard_fnames
+                     if fname in cached]), commit)
+            results += shard_results
+            pending += shard_results
+            if opts.outcomes and (seq + 1) % OUTCOME_SAVE_SHARDS == 0:
+                with timer(prof, 'outcomes'):
+                    opts.outcomes.record(pending, recipes, written)
+                    opts.outcomes.save()
+                pending = []
+    finally:
+        if pool:
+            pool.terminate()
+    if store:
+        show_commit(written, commit)
+    if opts.outcomes:
+        with timer(prof, 'outcomes'):
+            opts.outcomes.record(pending, recipes, written)
+            opts.outcomes.save()
+        if prof:
+            prof.totals['files_cached'] += len(cached)
+    return results + sorted(cached.items())
+
+
+def show_commit(written, commit):
+    """Show the result of writing files through a GitStore
+
+    Args:
+        written: List of filenames written
+        commit: New commit, or None if the git index was updated
+    """
+    if commit:
+        print('Created commit %s with %d files' % (commit, len(written)))
+    elif written:
+        print('Updated %d files in the index' % len(written))
+
+
+def commit_store(store):
+    """Write the files changed in a GitStore to the index or a commit
+
+    Args:
+        store: GitStore to commit
+
+    Returns:
+        List of filenames written
+    """
+    written, commit = store.commit()
+    show_commit(written, commit)
+    return written
+
+
+def run_renames(renames, opts):
+    """Rename #includes across the tree
+
+    Args:
+        renames: List of (old_hdr, new_hdr) tuples
+        opts: Options to use
+
+    Returns:
+        List of files which were changed
+    """
+    fnames = grep_files(['<%s>' % old_hdr for old_hdr, _ in renames],
+                        opts.paths, cached=opts.store is not None)
+    fnames, not_built = split_built(fnames, opts.built)
+    store = opts.store
+    if store:
+        fnames = [fname for fname in fnames if fname in store.entries]
+    func = functools.partial(rename_file, renames=renames, store=store)
+    changed = [fname for fname, written in run_files(fnames, func, opts.jobs)
+               if written]
+    if store:
+        commit_store(store)
+    if not_built:
+        print('Skipped %d files which are not built: %s' %
+              (len(not_built), ' '.join(not_built)))
+    return changed
+
+
+def run_files(fnames, func, jobs=1, pool=None):
+    """Run a function on each of a list of files, optionally in parallel
+
+    Files are sent to the worker processes in chunks. The results are returned
+    in the same order as fnames, so reports are the same for any value of jobs.
+
+    Args:
+        fnames: List of filenames to process
+        func: Function to call for each file; it is passed the filename and
+            must be picklable (e.g. a module-level function or a
+            functools.partial() of one)
+        jobs: Number of processes to use (1 to run in this process)
+        pool: multiprocessing.Pool to use, or None to create one if needed
+
+    Returns:
+        List of (fname, result) tuples
+    """
+    if jobs > 1 and len(fnames) > 1:
+        chunksize = max(1, len(fnames) // (jobs * 4))
+        if pool:
+            results = pool.map(func, fnames, chunksize)
+        else:
+            with multiprocessing.Pool(jobs) as pool:
+                results = pool.map(func, fnames, chunksize)
+    else:
+        results = [func(fname) for fname in fnames]
+    return list(zip(fnames, results))
+
+
+def get_used_idents(data, tokens=None, infos=None):
+    """Get the identifiers used in the code of a file
+
+    Identifiers in comments, strings and #include lines are ignored, so that
+    '#include <linux/printk.h>' does not count as using printk.
+
+    Args:
+        data: String containing the file contents
+        tokens: List of Token from lex(), or None to lex the data here
+        infos: List of LineInfo from get_line_info() for the tokens, or None
+            to work it out here
+
+    Returns:
+        Sorted list of identifiers
+    """
+    if tokens is None:
+        tokens = lex(data)
+    if infos is None:
+        infos = get_line_info(tokens, data.count('\n') + 1)
+    return sorted(set([tok.text for tok in tokens if tok.kind == TOK_IDENT and
+                       infos[tok.line].directive != 'include']))
+
 
-def process_file(fname, func, insert_hdr, to_check_hdr, ignore_fragments,
-                 all_to_check, skip_if_hdrs):
-    skip = False
-    show_only = None
-    #show_only = 'fs/btrfs/inode.c':
-    suffix = fname[-2:]
-    is_hdr_file = suffix == '.h'
-    if is_hdr_file:
-        if fname.startswith('include/linux') and not 'soc' in fname:
-            return
-        #skip = True
-    elif suffix != '.c':
-        return
-    with open(fname, 'r') as fd:
-        data = fd.read()
-    if show_only:
-        if fname != show_only:
-            return
-        print('fname', fname)
-    out = process_data(data, func, insert_hdr, ignore_fragments, is_hdr_file,
-                       skip_if_hdrs)
-    if out:
-        if skip:
-            # Don't process this but indicate that it needs a look
-            if fname in to_check_hdr:
-                to_check_hdr[fname].append(func)
-            else:
-                to_check_hdr[fname] = [func]
-                skip = False
-            all_to_check.append(fname)
-        if skip:
-            pass
-        elif isinstance(out, str):
-            if show_only or not out.startswith('>'): # minor issue
-                print('Check %s: %s' % (fname, out))
-                all_to_check.append(fname)
+def uses_item(idents, func, ignore_fragments):
+    """Check whether a file uses a recipe item
+
+    This matches in the same way as IdentIndex.find_idents()
+
+    Args:
+        idents: Sorted list of identifiers used in the file
+        func: Symbol to check (e.g. 'BUG(' or 'GD_FLG_')
+        ignore_fragments: True if the symbol must start at an identifier
+            boundary, WHOLE_IDENT if it must be a whole identifier
+
+    Returns:
+        True if the file uses the item, or if the item does not start with an
+        identifier, so it is not possible to tell
+    """
+    m = RE_IDENT.match(func)
+    if not m:
+        return True
+    tok = m.group(0)
+    # e.g. 'BUG(' must be the whole ident
+    exact = m.end() < len(func) or ignore_fragments == WHOLE_IDENT
+    if ignore_fragments:
+        pos = bisect.bisect_left(idents, tok)
+        if pos == len(idents):
+            return False
+        return idents[pos] == tok if exact else idents[pos].startswith(tok)
+    if exact:
+        return any(ident.endswith(tok) for ident in idents)
+    return any(tok in ident for ident in idents)
+
+
+def find_unused(fname, provides, apply=False, store=None):
+    """Find the #includes in a file which provide nothing that it uses
+
+    Only C files are checked, since a header may include another for the
+    benefit of the files that include it.
+
+    This does not print anything, so it is safe to call from a worker process.
+
+    Args:
+        fname: Filename to check
+        provides: dict:
+            key: header (e.g. 'linux/bug.h')
+            value: list of (func, ignore_fragments) tuples which it provides
+        apply: True to remove the unused #includes from the file. The other
+            lines are left as they are, with their own line endings
+        store: GitStore to read and write the file, or None to use the
+            working tree
+
+    Returns:
+        List of headers which are included but not used
+    """
+    info = read_file(fname, store)
+    if not info or info[1]:
+        return []
+    data = info[0]
+    lines = data.splitlines()
+    tokens = lex('\n'.join(lines))
+    idents = None
+    unused = []
+    drop = set()
+    infos = get_line_info(tokens, len(lines))
+    for num, info in enumerate(infos):
+        if info.directive != 'include' or info.in_comment:
+            continue
+        m = RE_INCLUDE.match(lines[num])
+        if not m or m.group(1) != '<' or m.group(2) not in provides:
+            continue
+        hdr = m.group(2)
+        if idents is None:
+            idents = get_used_idents(data, tokens, infos)
+        if not any(uses_item(idents, func, ignore_fragments)
+                   for func, ignore_fragments in provides[hdr]):
+            unused.append(hdr)
+            drop.add(num)
+    if apply and drop:
+        new_data = ''.join([line for num, line in
+                            enumerate(data.splitlines(True))
+                            if num not in drop])
+        if store:
+            store.write(fname, new_data)
         else:
-            with open(fname, 'w') as fd:
-                for line in out:
-                    print(line, file=fd)
+            write_data(fname, new_data)
+    return unused
+
+
+def estimate_saving(graph, fname, hdr, sizes):
+    """Estimate the preprocessed bytes saved by removing an #include
+
+    This is the size of the headers brought in by the #include which are not
+    brought in by any of the file's other #includes.
+
+    Args:
+        graph: IncludeGraph for the tree
+        fname: File containing the #include
+        hdr: Header to be removed (e.g. 'linux/bug.h')
+        sizes: dict of file sizes, which is updated as files are checked:
+            key: filename
+            value: size in bytes
+
+    Returns:
+        Estimated number of bytes saved
+    """
+    ctx = graph.get_context(fname)
+    removed = graph.get_closure(fname, False, hdr, ctx)
+    others = set()
+    for local, name, _ in graph.includes.get(fname, ()):
+        if local or name != hdr:
+            others |= graph.get_closure(fname, local, name, ctx)
+    total = 0
+    for path in removed - others:
+        if path not in sizes:
+            sizes[path] = os.path.getsize(path)
+        total += sizes[path]
+    return total
+
+
+def run_unused(convs, opts, apply=False):
+    """Find #includes which are not needed, according to a list of recipes
+
+    Each recipe gives a header and the symbols it provides. A C file which
+    includes the header but uses none of the symbols does not need it.
+
+    Args:
+        convs: List of HdrConv objects giving the headers to check
+        opts: Options to use
+        apply: True to remove the unused #includes, False to just report them.
+            With opts.store they are removed in the git index or a new commit
+            instead of the working tree
+
+    Returns:
+        List of (fname, hdr, bytes) tuples, one for each unused #include, where
+            bytes is the estimated number of preprocessed bytes saved by
+            removing it
+    """
+    provides = collections.OrderedDict()
+    for conv in convs:
+        items = provides.setdefault(conv.hdr, [])
+        for item in conv.get_items():
+            if item not in items:
+                items.append(item)
+    store = opts.store
+    fnames = grep_files(['#include <%s>' % hdr for hdr in provides],
+                        opts.paths, cached=store is not None)
+    fnames = [fname for fname in fnames if fname.endswith('.c')]
+    fnames, _ = split_built(fnames, opts.built)
+    if store:
+        fnames = [fname for fname in fnames if fname in store.entries]
+    graph = opts.graph or get_include_graph(opts.jobs)
+    func = functools.partial(find_unused, provides=provides, apply=apply,
+                             store=store)
+    removals = []
+    sizes = {}
+    for fname, unused in run_files(fnames, func, opts.jobs):
+        for hdr in unused:
+            removals.append((fname, hdr,
+                             estimate_saving(graph, fname, hdr, sizes)))
+    if apply and store:
+        commit_store(store)
+    return removals
 
 
 def doit(func, insert_hdr, to_check_hdr, ignore_fragments, all_to_check,
-         skip_if_hdrs):
-    fnames = command.Output('git', 'grep', '-l', func).splitlines()
+         skip_if_hdrs, index=None):
+    if index:
+        fnames = index.lookup([(func, ignore_fragments)])
+    else:
+        fnames = command.Output('git', 'grep', '-l', func).splitlines()
     for fname in fnames:
-        if os.path.islink(fname):
-            continue
-        if fname.startswith('tools/') or fname.startswith('scripts/'):
-            continue
-        if fname.startswith('tools/') or fname.startswith('scripts/'):
+        if not want_file(fname):
             continue
         process_file(fname, func, insert_hdr, to_check_hdr, ignore_fragments,
                      all_to_check, skip_if_hdrs)
@@ -320,10 +3692,11 @@ def process_files_from(list_fname, insert_hdr):
 
 
 class HdrConv:
-    def __init__(self):
+    def __init__(self, opts=None):
         self.hdr = None
         self.searches = []
         self.skip_if_hdrs = None
+        self.opts = opts or Options()
 
     def set_hdr(self, hdr):
         self.hdr = hdr
@@ -336,12 +3709,62 @@ class HdrConv:
         """
         self.skip_if_hdrs = hdrs
 
+    @classmethod
+    def from_header(cls, hdr, index=None, opts=None):
+        """Set up a conversion using the declarations in a header
+
+        Functions and function-like macros are searched for as calls; other
+        macros, enumerators, typedefs and extern variables as whole
+        identifiers, so that e.g. 'SZ_1' does not match 'SZ_128'.
+
+        Args:
+            hdr: Header name (e.g. 'linux/bitops.h')
+            index: DeclIndex to use, or None to get one for the tree in the
+                current directory
+            opts: Options to use, or None for the defaults
+
+        Returns:
+            HdrConv object
+
+        Raises:
+            ValueError: if the header is not found
+        """
+        conv = cls(opts)
+        conv.set_hdr(hdr)
+        if not index:
+            index = get_decl_index(conv.opts.jobs)
+        decls = index.get_decls(hdr)
+        conv.add_funcs(','.join(sorted(
+            [name for kind, name in decls
+             if kind in (DECL_FUNC, DECL_MACRO_FUNC)])))
+        conv.add_text(','.join(sorted(
+            [name for kind, name in decls
+             if kind not in (DECL_FUNC, DECL_MACRO_FUNC)])), WHOLE_IDENT)
+        return conv
+
     def add_funcs(self, funcs, ignore_fragments=True):
         self.searches.append(['(', funcs, ignore_fragments])
 
     def add_text(self, funcs, ignore_fragments=True):
         self.searches.append(['', funcs, ignore_fragments])
 
+    def get_items(self):
+        """Get the individual symbols to search for
+
+        Returns:
+            List of (func, ignore_fragments) tuples, in the order they were
+            added, without duplicates
+        """
+        items = []
+        seen = set()
+        for suffix, funcs, ignore_fragments in self.searches:
+            for item in funcs.split(','):
+                func = item + suffix
+                if item and func not in seen:
+                    seen.add(func)
+                    items.append((func, ignore_fragments))
+        return items
+
     def report(self, to_check_hdr, all_to_check):
         for fname in sorted(to_check_hdr.keys()):
             print("Check header '%s': %s" % (fname, to_check_hdr[fname]))
@@ -351,13 +3774,8 @@ class HdrConv:
 
     def run(self):
         """Find all files that include the fragments and add the header"""
-        all_to_check = []
-        to_check_hdr = {}
-        for suffix, funcs, ignore_fragments in self.searches:
-            for item in funcs.split(','):
-                doit(item + suffix, self.hdr, to_check_hdr, ignore_fragments,
-                     all_to_check, self.skip_if_hdrs)
-        self.report(to_check_hdr, all_to_check)
+        all_to_check = run_recipes([self], self.opts)
+        self.report({}, all_to_check)
 
     def insert(self, files):
         """Add the header to all listed files"""
@@ -368,6 +3786,305 @@ class HdrConv:
                          all_to_check)
 
 
+def get_convs(names, jobs=1, decl_index=None):
+    """Set up the conversions for a list of recipes
+
+    Args:
+        names: List of recipe names, from RECIPES, or header names
+        jobs: Number of processes to use to update the declaration index
+        decl_index: DeclIndex to use for header names, or None to get one
+            for the tree in the current directory if needed
+
+    Returns:
+        List of HdrConv objects
+
+    Raises:
+        ValueError: if a name is not a recipe or a header in the tree
+    """
+    convs = []
+    for name in names:
+        if name.endswith('.h'):
+            if not decl_index:
+                decl_index = get_decl_index(jobs)
+            convs.append(HdrConv.from_header(name, decl_index))
+        elif name in RECIPES:
+            conv = HdrConv()
+            RECIPES[name](conv)
+            convs.append(conv)
+        else:
+            raise ValueError(
+                "Unknown recipe '%s': valid ones are %s, or a header name" %
+                (name, ', '.join(sorted(RECIPES))))
+    return convs
+
+
+# inotify flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE)
+
+
+class Watcher:
+    """Watch a tree for changes to .c and .h files, using inotify
+
+    Properties:
+        fd: inotify file descriptor, which can be passed to select()
+        top: Top directory of the tree
+        dirs: dict: key: watch descriptor, value: directory it watches
+    """
+    def __init__(self, top='.'):
+        """Start watching a tree
+
+        Args:
+            top: Top directory of the tree
+
+        Raises:
+            OSError: if inotify is not available or runs out of watches
+        """
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+        self.top = top
+        self.dirs = {}
+        self.add_tree(top)
+
+    def add_tree(self, top):
+        """Watch a directory and all its subdirectories, except .git
+
+        Args:
+            top: Directory to watch
+
+        Returns:
+            List of .c and .h files in the directory, since these may have
+            been created before the watch was added
+        """
+        found = []
+        for dirpath, dirnames, fnames in os.walk(top):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            found += [os.path.normpath(os.path.join(dirpath, fname))
+                      for fname in fnames if fname[-2:] in ('.c', '.h')]
+            wd = self.libc.inotify_add_watch(self.fd, dirpath.encode(),
+                                             WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(),
+                              "Cannot watch '%s' (see "
+                              "fs.inotify.max_user_watches)" % dirpath)
+            self.dirs[wd] = dirpath
+        return found
+
+    def read(self):
+        """Read the changes which have happened since the last call
+
+        This does not block.
+
+        Returns:
+            Set of .c and .h filenames which have changed, relative to the top
+            of the tree, or None if the kernel's event queue overflowed, so
+            any file may have changed
+        """
+        changed = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, size = struct.unpack_from('iIII', data, pos)
+                pos += 16
+                name = data[pos:pos + size].rstrip(b'\0').decode(
+                    errors='ignore')
+                pos += size
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                if wd not in self.dirs:
+                    continue
+                path = os.path.normpath(os.path.join(self.dirs[wd], name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        changed.update(self.add_tree(path))
+                elif path[-2:] in ('.c', '.h'):
+                    changed.add(path)
+        if overflow:
+            # Directories may have been created without us seeing them
+            self.add_tree(self.top)
+            return None
+        return changed
+
+    def close(self):
+        """Stop watching"""
+        os.close(self.fd)
+
+
+# Time to wait for a client to send its request or accept the reply, in seconds
+REQUEST_TIMEOUT = 10
+
+
+class Daemon:
+    """Server which applies recipes on request, keeping its state between them
+
+    The identifier index (and include graph, with -g) is loaded once and
+    updated as files change, so a request does not need to scan the tree.
+
+    Each request is a line containing a comma-separated list of recipe or
+    header names, sent over a Unix socket. The reply is the output of a run
+    with those recipes, in the format of HdrConv.report(), after which the
+    connection is closed.
+
+    Each request gets its own GitStore and outcome cache, if these are
+    enabled. A journal is not used, since each request is run in full.
+
+    Properties:
+        opts: Options to use for each request
+        watcher: Watcher for the tree
+        decl_index: DeclIndex for header names, or None if not loaded yet
+        use_store: True to write files through a new GitStore for each
+            request
+        message: Commit message for the GitStore, or None to update the git
+            index
+        use_outcomes: True to use the outcome cache
+    """
+    def __init__(self, opts):
+        """Set up the daemon for the tree in the current directory
+
+        Args:
+            opts: Options to use; the identifier index is loaded if needed
+        """
+        self.opts = opts
+        if not opts.index:
+            opts.index = get_index(opts.jobs)
+        self.use_store = opts.store is not None
+        self.message = opts.store.message if opts.store else None
+        if opts.store:
+            opts.store.close()
+            opts.store = None
+        self.use_outcomes = opts.outcomes is not None
+        opts.outcomes = None
+        if opts.journal:
+            print('Ignoring journal: each request is run in full')
+            opts.journal = None
+        self.watcher = Watcher()
+        self.decl_index = None
+
+    def update(self):
+        """Update the state for any files which have changed
+
+        Returns:
+            Set of filenames which changed, or None if the whole tree was
+            scanned again because changes were lost
+        """
+        changed = self.watcher.read()
+        if changed is None:
+            self.opts.index.update(self.opts.jobs)
+            if self.opts.graph:
+                self.opts.graph.update(self.opts.jobs)
+            self.decl_index = None
+            return None
+        if changed:
+            self.opts.index.update_files(changed)
+            if self.opts.graph:
+                self.opts.graph.update_files(changed)
+        for fname in changed:
+            if fname.endswith('.h') and get_hdr_name(fname) != fname:
+                self.decl_index = None
+        return changed
+
+    def handle(self, request):
+        """Handle a request
+
+        Args:
+            request: Comma-separated list of recipe or header names
+
+        Returns:
+            Output to send back
+        """
+        self.update()
+        out = io.StringIO()
+        opts = copy.copy(self.opts)
+        with contextlib.redirect_stdout(out):
+            try:
+                if self.use_outcomes:
+                    opts.outcomes = get_outcome_cache(opts.kconfig)
+                if self.use_store:
+                    opts.store = GitStore(self.message)
+                if not self.decl_index and '.h' in request:
+                    self.decl_index = get_decl_index(opts.jobs)
+                convs = get_convs(request.strip().split(','), opts.jobs,
+                                  self.decl_index)
+                all_to_check = run_recipes(convs, opts)
+                convs[0].report({}, all_to_check)
+            except ValueError as exc:
+                print(exc)
+            except Exception as exc:
+                print('Internal error: %s' % exc)
+                traceback.print_exc()
+            finally:
+                if opts.store:
+                    opts.store.close()
+        return out.getvalue()
+
+    def serve(self, sock_fname):
+        """Handle requests until interrupted
+
+        Args:
+            sock_fname: Filename of the Unix socket to listen on
+        """
+        if os.path.exists(sock_fname):
+            os.unlink(sock_fname)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(sock_fname)
+            sock.listen()
+            try:
+                while True:
+                    ready, _, _ = select.select([sock, self.watcher.fd], [],
+                                                [])
+                    if self.watcher.fd in ready:
+                        self.update()
+                    if sock in ready:
+                        conn, _ = sock.accept()
+                        try:
+                            with conn:
+                                conn.settimeout(REQUEST_TIMEOUT)
+                                with conn.makefile('r') as fd:
+                                    request = fd.readline()
+                                conn.sendall(self.handle(request).encode())
+                        except Exception:
+                            # Don't let one bad client stop the daemon
+                            traceback.print_exc()
+            finally:
+                os.unlink(sock_fname)
+                self.watcher.close()
+                self.opts.index.save()
+
+
+def query_daemon(sock_fname, names):
+    """Send a request to a daemon and get the reply
+
+    Args:
+        sock_fname: Filename of the daemon's Unix socket
+        names: List of recipe or header names
+
+    Returns:
+        Reply from the daemon
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(sock_fname)
+        sock.sendall((','.join(names) + '\n').encode())
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('r') as fd:
+            return fd.read()
+
+
 class Tests(unittest.TestCase):
     def testSimple(self):
         hdrs= '''
@@ -865,6 +4582,938 @@ strcpy(a, b);
         new_hdrs = out[:-len(body.splitlines())]
         self.assertEqual(expect.splitlines(), new_hdrs)
 
+    def testLex(self):
+        """Check that the lexer handles comments, strings and directives"""
+        data = '''#include <common.h> /* start
+ * BUG() in a comment */
+#define X(a) \\
+	a; // BUG(
+str = "/* not a comment"; BUG_ON(1);
+'''
+        tokens = lex(data)
+        comments = [tok for tok in tokens if tok.kind == TOK_COMMENT]
+        self.assertEqual([0, 3], [tok.line for tok in comments])
+        self.assertEqual('str = ""; BUG_ON(1);',
+                         get_code(tokens).splitlines()[-1])
+
+        infos = get_line_info(tokens, len(data.splitlines()))
+        self.assertEqual(['include', None, 'define', None, None],
+                         [info.directive for info in infos])
+        self.assertEqual(['X', '(', 'a', ')', 'a', ';'], infos[2].args)
+        self.assertEqual([False, True, False, False, False],
+                         [info.in_comment for info in infos])
+        self.assertEqual([False, False, False, True, False],
+                         [info.continued for info in infos])
+        self.assertEqual([True, False, True, True, True],
+                         [info.code for info in infos])
+
+    def testStringLiteral(self):
+        """Don't treat a comment marker in a string as a comment"""
+        hdrs = '''
+#include <common.h>
+'''
+        body = '''
+int some_func(void)
+{
+    printf("/* comment start");
+    BUG();
+    printf("*/");
+}
+'''
+        expect = '''
+#include <common.h>
+#include <linux/bug.h>
+'''
+        out = process_data(hdrs + body, 'BUG(', 'linux/bug.h', True)
+        self.assertIsNotNone(out)
+        new_hdrs = out[:-len(body.splitlines())]
+        self.assertEqual(expect.splitlines(), new_hdrs)
+
+        # A symbol in a string does not count
+        body = body.replace('    BUG();', '    printf("BUG()");')
+        out = process_data(hdrs + body, 'BUG(', 'linux/bug.h', True)
+        self.assertIsNone(out)
+
+    def testMacroContinuation(self):
+        """Don't put a header inside a multi-line macro"""
+        hdrs = '''
+/* SPDX */
+#define CHECK(x) \\
+	BUG_ON(x)
+'''
+        body = '''
+int val;
+'''
+        expect = '''
+/* SPDX */
+#include <linux/bug.h>
+#define CHECK(x) \\
+	BUG_ON(x)
+'''
+        out = process_data(hdrs + body, 'BUG_ON(', 'linux/bug.h', True)
+        new_hdrs = out[:-len(body.splitlines())]
+        self.assertEqual(expect.splitlines(), new_hdrs)
+
+    def testScanner(self):
+        """Check that all symbols are found in one pass"""
+        data = '''
+int some_func(void)
+{
+    printk_once("here");
+    PRBUG(1);
+    WARN_ON(1);
+}
+'''
+        scanner = Scanner([('BUG(', True), ('WARN_ON(', True),
+                           ('printk', True), ('printk_once', True),
+                           ('BUILD_BUG_', True), ('PRBUG', False)])
+        self.assertEqual({'BUG(': False, 'WARN_ON(': True, 'printk': True,
+                          'printk_once': True, 'PRBUG': True},
+                         scanner.scan(data))
+        self.assertEqual([('WARN_ON(', True), ('printk', True),
+                          ('printk_once', True), ('PRBUG', False)],
+                         scanner.matches(data))
+
+    def testScannerFragments(self):
+        """Check that fragments are accepted when ignore_fragments is False"""
+        data = 'x = PRBUG(1);\n'
+        self.assertEqual([], Scanner([('BUG(', True)]).matches(data))
+        self.assertEqual([('BUG(', False)],
+                         Scanner([('BUG(', False)]).matches(data))
+
+    def testGetItems(self):
+        """Check that recipe items are split and de-duplicated"""
+        hdr = HdrConv()
+        hdr.add_funcs('BUG,WARN,BUG')
+        hdr.add_text('gd->,', ignore_fragments=False)
+        self.assertEqual([('BUG(', True), ('WARN(', True), ('gd->', False)],
+                         hdr.get_items())
+
+    def testRunFiles(self):
+        """Check that parallel processing gives the same results"""
+        hdrs = '#include <common.h>\n'
+        body = 'void f(void)\n{\n\tBUG();\n}\n'
+        recipe = Recipe(Scanner([('BUG(', True)]), 'linux/bug.h', None, set())
+        func = functools.partial(process_file_multi, recipes=[recipe])
+        outputs = []
+        for jobs in (1, 2):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fnames = []
+                for upto in range(5):
+                    fname = os.path.join(tmpdir, 'file%d.c' % upto)
+                    with open(fname, 'w') as fd:
+                        if upto == 3:
+                            fd.write('#include "local.h"\n' + body)
+                        else:
+                            fd.write(hdrs + body)
+                    fnames.append(fname)
+                results = run_files(fnames, func, jobs)
+                self.assertEqual(fnames, [fname for fname, _ in results])
+                msgs = [msg for _, msg in results]
+                with open(fnames[0]) as fd:
+                    data = fd.read()
+                outputs.append((msgs, data))
+        self.assertEqual(outputs[0], outputs[1])
+        msgs, data = outputs[0]
+        self.assertEqual([[], [], [],
+                          [('linux/bug.h', 'local include "local.h"')], []],
+                         msgs)
+        self.assertEqual(hdrs + '#include <linux/bug.h>\n' + body, data)
+
+    def testBatch(self):
+        """Check applying several recipes with a single write"""
+        hdrs = '#include <common.h>\n#include <dm.h>\n'
+        body = 'void f(void)\n{\n\tBUG();\n\tprintk("x");\n\tgd->flags = 0;\n}\n'
+        recipes = [
+            Recipe(Scanner([('BUG(', True)]), 'linux/bug.h', None, set()),
+            Recipe(Scanner([('printk', True)]), 'linux/printk.h', None, set()),
+            Recipe(Scanner([('gd->', True)]), 'asm/global_data.h', None,
+                   set()),
+            Recipe(Scanner([('WARN(', True)]), 'linux/bug.h', None, set())]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'file.c')
+            with open(fname, 'w') as fd:
+                fd.write(hdrs + body)
+            self.assertEqual([], process_file_multi(fname, recipes))
+            with open(fname) as fd:
+                data = fd.read()
+        expect = '''#include <common.h>
+#include <dm.h>
+#include <asm/global_data.h>
+#include <linux/bug.h>
+#include <linux/printk.h>
+'''
+        self.assertEqual(expect + body, data)
+
+    def testIdentIndex(self):
+        """Check looking up symbols in the identifier index"""
+        index = IdentIndex()
+        index.add_blob('1111', frozenset(['BUG', 'printk_once', 'gd']))
+        index.add_blob('2222', frozenset(['PRBUG', 'GD_FLG_RELOC']))
+        index.fnames_by_sha = {'1111': ['a.c'], '2222': ['b.c', 'c.h']}
+        index.modified = {'d.c': frozenset(['WARN'])}
+        self.assertEqual(['a.c'], index.lookup([('BUG(', True)]))
+        self.assertEqual(['a.c', 'b.c', 'c.h'],
+                         index.lookup([('BUG(', False)]))
+        self.assertEqual(['b.c', 'c.h'], index.lookup([('GD_FLG_', True)]))
+        self.assertEqual(['a.c'], index.lookup([('printk', True)]))
+        self.assertEqual(['a.c', 'd.c'],
+                         index.lookup([('gd->', True), ('WARN(', True)]))
+
+        index.remove_blob('1111')
+        self.assertEqual([], index.lookup([('printk', True)]))
+
+    def testDeclIndex(self):
+        """Check finding the declarations in a header"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'bitops.h')
+            with open(fname, 'w') as fd:
+                fd.write('''/* SPDX-License-Identifier: GPL-2.0 */
+#ifndef __BITOPS_H
+#define __BITOPS_H
+
+#include <linux/types.h>
+
+#define BIT(nr)\t\t(1UL << (nr))
+#define BITS_PER_BYTE\t8
+#define for_each_set_bit(bit, addr, size) \\
+\tfor ((bit) = 0; (bit) < (size); (bit)++)
+
+struct bitmap;
+
+enum bit_order {
+\tBIT_ORDER_LSB,
+\tBIT_ORDER_MSB = 1 << 2,
+};
+
+typedef unsigned long bitmap_t;
+typedef int (*bit_func)(struct bitmap *map);
+
+extern unsigned long bit_mask[4];
+
+__printf(1, 2) int bit_log(const char *fmt, ...);
+unsigned long *find_bits(struct bitmap *map, int (*fn)(int));
+
+static inline int fls(unsigned int x)
+{
+\tif (x)
+\t\treturn generic_fls(x);
+\treturn 0;
+}
+
+#endif /* __BITOPS_H */
+''')
+            decls = scan_decls(fname)
+        self.assertEqual(
+            [(DECL_ENUM, 'BIT_ORDER_LSB'), (DECL_ENUM, 'BIT_ORDER_MSB'),
+             (DECL_EXTERN, 'bit_mask'), (DECL_FUNC, 'bit_log'),
+             (DECL_FUNC, 'find_bits'), (DECL_FUNC, 'fls'),
+             (DECL_MACRO, 'BITS_PER_BYTE'), (DECL_MACRO_FUNC, 'BIT'),
+             (DECL_MACRO_FUNC, 'for_each_set_bit'),
+             (DECL_TYPE, 'bit_func'), (DECL_TYPE, 'bitmap_t')],
+            sorted(decls))
+
+        index = DeclIndex()
+        index.by_hdr = {'linux/bitops.h': decls}
+        conv = HdrConv.from_header('linux/bitops.h', index)
+        self.assertEqual('linux/bitops.h', conv.hdr)
+        items = conv.get_items()
+        self.assertEqual(('BIT(', True), items[0])
+        self.assertIn(('fls(', True), items)
+        self.assertIn(('bitmap_t', WHOLE_IDENT), items)
+        self.assertNotIn(('generic_fls(', True), items)
+        self.assertEqual(11, len(items))
+        with self.assertRaises(ValueError):
+            HdrConv.from_header('linux/missing.h', index)
+
+        # Names which are not calls must match whole identifiers
+        code = 'int f(void)\n{\n\treturn BITS_PER_BYTE_MASK;\n}\n'
+        scanner = Scanner(items)
+        self.assertEqual([], scanner.matches(code))
+        self.assertIsNone(get_insert_line(code, 'BITS_PER_BYTE',
+                                          'linux/bitops.h', WHOLE_IDENT))
+        self.assertFalse(uses_item(['BITS_PER_BYTE_MASK'], 'BITS_PER_BYTE',
+                                   WHOLE_IDENT))
+        code = code.replace('_MASK', '')
+        self.assertEqual([('BITS_PER_BYTE', WHOLE_IDENT)],
+                         scanner.matches(code))
+        self.assertEqual(0, get_insert_line(code, 'BITS_PER_BYTE',
+                                            'linux/bitops.h', WHOLE_IDENT))
+        self.assertTrue(uses_item(['BITS_PER_BYTE'], 'BITS_PER_BYTE',
+                                  WHOLE_IDENT))
+
+    def testRename(self):
+        """Check renaming #includes while keeping them sorted"""
+        renames = [('asm/u-boot.h', 'asm/global_data.h')]
+        out = rename_data('#include <common.h>\n#include <asm/u-boot.h>\n'
+                          '#include <dm.h>\n#include <linux/bug.h>\n', renames)
+        self.assertEqual('#include <common.h>\n#include <dm.h>\n'
+                         '#include <asm/global_data.h>\n'
+                         '#include <linux/bug.h>\n', out)
+
+        # The new header is already there
+        out = rename_data('#include <asm/global_data.h>\n'
+                          '#include <asm/u-boot.h>\n', renames)
+        self.assertEqual('#include <asm/global_data.h>\n', out)
+
+        # Conditional #includes are replaced where they are
+        data = ('#include <dm.h>\n#ifdef CONFIG_FOO\n#include <asm/u-boot.h>\n'
+                '#endif\n#ifndef __UBOOT__\n#include <asm/u-boot.h>\n'
+                '#else\n#include <linux/bug.h>\n#endif\n')
+        out = rename_data(data, renames)
+        self.assertEqual(data.replace('asm/u-boot.h', 'asm/global_data.h'),
+                         out)
+
+        # Header guard and __ASSEMBLY__ blocks are used
+        out = rename_data('#ifndef __FOO_H\n#define __FOO_H\n\n'
+                          '#ifndef __ASSEMBLY__\n#include <linux/bug.h>\n'
+                          '#include <asm/u-boot.h>\n#endif\n#endif\n',
+                          renames, True)
+        self.assertEqual('#ifndef __FOO_H\n#define __FOO_H\n\n'
+                         '#ifndef __ASSEMBLY__\n'
+                         '#include <asm/global_data.h>\n'
+                         '#include <linux/bug.h>\n#endif\n#endif\n', out)
+
+        # There is nowhere else to put it
+        self.assertEqual('#include <asm/global_data.h>\n',
+                         rename_data('#include <asm/u-boot.h>\n', renames))
+
+        # Line endings are kept, with no newline added at the end
+        out = rename_data('#include <common.h>\r\n#include <asm/u-boot.h>\r\n'
+                          '#include <dm.h>\r\nint x;', renames)
+        self.assertEqual('#include <common.h>\r\n#include <dm.h>\r\n'
+                         '#include <asm/global_data.h>\r\nint x;', out)
+        out = rename_data('#ifdef CONFIG_FOO\r\n#include <asm/u-boot.h>\r\n'
+                          '#endif', renames)
+        self.assertEqual('#ifdef CONFIG_FOO\r\n#include <asm/global_data.h>'
+                         '\r\n#endif', out)
+        self.assertIsNone(rename_data('/* #include <asm/u-boot.h> */\n',
+                                      renames))
+
+    def testDaemon(self):
+        """Check that the daemon sees changes to the tree between requests"""
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            try:
+                make_tree(tmpdir, 4)
+                os.chdir(tmpdir)
+                graph = IncludeGraph()
+                graph.update()
+                try:
+                    daemon = Daemon(Options(graph=graph))
+                except OSError as exc:
+                    self.skipTest('inotify not available: %s' % exc)
+                os.mkdir('drivers/new')
+                with open('drivers/new/new.c', 'w') as fd:
+                    fd.write('#include <common.h>\n\nvoid f(void)\n{\n'
+                             '\tBUG();\n}\n')
+                self.assertEqual(set(['drivers/new/new.c']), daemon.update())
+                self.assertIn('drivers/new/new.c',
+                              daemon.opts.index.lookup([('BUG(', True)]))
+                self.assertEqual(((False, 'common.h', False),),
+                                 graph.includes['drivers/new/new.c'])
+
+                out = daemon.handle('bug\n')
+                with open('drivers/new/new.c') as fd:
+                    self.assertIn('#include <linux/bug.h>', fd.read())
+
+                # The daemon sees its own changes
+                self.assertIn('drivers/new/new.c', daemon.update())
+                self.assertIn("Unknown recipe 'nosuch'",
+                              daemon.handle('nosuch\n'))
+
+                # Other errors are reported, without stopping the daemon
+                daemon.opts.jobs = None
+                with contextlib.redirect_stderr(io.StringIO()):
+                    self.assertIn('Internal error', daemon.handle('bug\n'))
+                daemon.watcher.close()
+            finally:
+                os.chdir(cwd)
+
+    def testLineEndings(self):
+        """Check that files are rewritten with their own line endings"""
+        self.assertEqual('a\r\nb\r\nc\r\n', insert_line('a\r\nc\r\n', 1, 'b'))
+        self.assertEqual('b\r\na\r\n', insert_line('a\r\n', 0, 'b'))
+        self.assertEqual('a\nb\nc', insert_line('a\nc', 1, 'b'))
+        self.assertEqual('b\na', insert_line('a', 0, 'b'))
+
+        scanner = Scanner([('BUG(', True)])
+        self.assertTrue(scanner.may_match(b'\tPRBUG();\n'))
+        self.assertFalse(scanner.may_match(b'\tWARN();\n'))
+
+        recipes = [Recipe(scanner, 'linux/bug.h', None, set())]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'file.c')
+            with open(fname, 'wb') as fd:
+                fd.write(b'#include <common.h>\r\n#include <dm.h>\r\n\r\n'
+                         b'/* \xa9 2020 */\r\nvoid f(void)\r\n{\r\n'
+                         b'\tBUG();\r\n}')
+            self.assertEqual([], process_file_multi(fname, recipes))
+            with open(fname, 'rb') as fd:
+                self.assertEqual(b'#include <common.h>\r\n#include <dm.h>\r\n'
+                                 b'#include <linux/bug.h>\r\n\r\n'
+                                 b'/* \xa9 2020 */\r\nvoid f(void)\r\n{\r\n'
+                                 b'\tBUG();\r\n}', fd.read())
+
+            # Files without the symbols are not decoded at all
+            fname = os.path.join(tmpdir, 'other.c')
+            with open(fname, 'w') as fd:
+                fd.write('void f(void)\n{\n}\n')
+            self.assertIsNone(read_file(fname, scanners=[scanner]))
+            self.assertEqual(('void f(void)\n{\n}\n', False),
+                             read_file(fname))
+
+    def testFindFilesSince(self):
+        """Check limiting the files to those which have changed"""
+        index = IdentIndex()
+        index.add_blob('1111', frozenset(['BUG']))
+        index.fnames_by_sha = {'1111': ['a.c', 'b.c', 'c.c']}
+        opts = Options(index=index, paths=['c.c', 'a.c', 'd.c'])
+        self.assertEqual(['a.c', 'c.c'], find_files([('BUG(', True)], opts))
+        opts.paths = []
+        self.assertEqual([], find_files([('BUG(', True)], opts))
+        self.assertEqual([], grep_files(['BUG('], []))
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            try:
+                os.chdir(tmpdir)
+                with open('a.c', 'w') as fd:
+                    fd.write('void f(void)\n{\n}\n')
+                command.Output('git', 'init', '-q')
+                command.Output('git', 'config', 'user.name', 'Test')
+                command.Output('git', 'config', 'user.email', 'test@test')
+                command.Output('git', 'add', '.')
+                command.Output('git', 'commit', '-q', '-m', 'Initial')
+                with open('a.c', 'a') as fd:
+                    fd.write('int x;\n')
+                with open('new.c', 'w') as fd:
+                    fd.write('void g(void)\n{\n\tBUG();\n}\n')
+                self.assertEqual(['a.c', 'new.c'], changed_files('HEAD'))
+
+                # No changed file uses the symbol
+                opts = Options(paths=['a.c'])
+                self.assertEqual([], find_files([('BUG(', True)], opts))
+                opts.paths = changed_files('HEAD')
+                self.assertEqual(['new.c'], find_files([('BUG(', True)],
+                                                       opts))
+
+                # New files are not in the index
+                opts = Options(paths=['new.c'], store=GitStore())
+                try:
+                    self.assertEqual([], find_files([('BUG(', True)], opts))
+                finally:
+                    opts.store.close()
+                with self.assertRaises(ValueError):
+                    grep_files(['BUG('], ['/not/in/tree.c'])
+            finally:
+                os.chdir(cwd)
+
+    def testIncludeGraph(self):
+        """Check finding headers which are included transitively"""
+        graph = IncludeGraph()
+        graph.set_files({
+            'include/common.h': ((False, 'linux/types.h', False),),
+            'include/linux/types.h': ((False, 'asm/types.h', False),),
+            'include/linux/bug.h': ((False, 'linux/types.h', False),),
+            'arch/arm/include/asm/types.h':
+                ((False, 'linux/bug.h', False),),
+            'arch/x86/include/asm/types.h': (),
+            'arch/arm/cpu/cpu.c': ((False, 'common.h', False),),
+            'drivers/cpu.c': ((False, 'common.h', False),
+                              (True, 'cpu.h', False)),
+            'drivers/cpu.h': ((False, 'linux/kernel.h', False),),
+            'include/loop.h': ((False, 'loop.h', False),),
+            })
+        self.assertTrue(graph.reaches('drivers/cpu.c', 'linux/types.h'))
+        self.assertTrue(graph.reaches('drivers/cpu.c', 'asm/types.h'))
+        self.assertTrue(graph.reaches('drivers/cpu.c', 'linux/kernel.h'))
+
+        # Only the arm asm/types.h includes linux/bug.h
+        self.assertFalse(graph.reaches('drivers/cpu.c', 'linux/bug.h'))
+        self.assertTrue(graph.reaches('arch/arm/cpu/cpu.c', 'linux/bug.h'))
+
+        self.assertTrue(graph.reaches('include/loop.h', 'loop.h'))
+        self.assertFalse(graph.reaches('not/in/tree.c', 'common.h'))
+
+        # #includes which are not used in U-Boot are dropped, and conditional
+        # ones do not count
+        compat = get_includes(
+            '#ifndef __LINUX_COMPAT_H\n#define __LINUX_COMPAT_H\n'
+            '#include <linux/types.h>\n#ifndef __UBOOT__\n'
+            '#include <linux/bug.h>\n#else\n#include <common.h>\n#endif\n'
+            '#if 0\n#include <linux/log2.h>\n#endif\n'
+            '#ifdef CONFIG_DM\n#include <dm.h>\n#endif\n'
+            '#ifndef __ASSEMBLY__\n#include <linux/err.h>\n#endif\n'
+            '#endif\n', True)
+        self.assertEqual(((False, 'linux/types.h', False),
+                          (False, 'common.h', False),
+                          (False, 'dm.h', True),
+                          (False, 'linux/err.h', False)), compat)
+        graph.set_files({
+            'include/linux/compat.h': compat,
+            'include/dm.h': (),
+            'include/linux/bug.h': (),
+            'drivers/a.c': ((False, 'linux/compat.h', False),),
+            })
+        self.assertFalse(graph.reaches('drivers/a.c', 'linux/bug.h'))
+        self.assertFalse(graph.reaches('drivers/a.c', 'dm.h'))
+        self.assertTrue(graph.reaches('drivers/a.c', 'linux/err.h'))
+        self.assertIn('include/dm.h', graph.get_closure(
+            'drivers/a.c', False, 'linux/compat.h', None))
+        self.assertEqual(((True, 'a.h', True),),
+                         get_includes('#ifdef CONFIG_A\n#include "a.h"\n'
+                                      '#endif\n'))
+
+    def testUnused(self):
+        """Check finding #includes which are not needed"""
+        data = ('#include <linux/printk.h>\n/* BUG() */\n'
+                'int f(void)\n{\n\treturn GD_FLG_RELOC;\n}\n')
+        idents = get_used_idents(data)
+        self.assertEqual(['GD_FLG_RELOC', 'f', 'int', 'return', 'void'],
+                         idents)
+        self.assertEqual(idents, get_used_idents(data, lex(data)))
+        self.assertFalse(uses_item(idents, 'printk', True))
+        self.assertFalse(uses_item(idents, 'BUG(', True))
+        self.assertTrue(uses_item(idents, 'GD_FLG_', True))
+        self.assertFalse(uses_item(idents, 'GD_FLG(', True))
+        self.assertTrue(uses_item(idents, 'FLG_', False))
+        self.assertTrue(uses_item(idents, '\\->bi_', True))
+
+        provides = {
+            'linux/bug.h': [('BUG(', True), ('WARN_ON(', True)],
+            'linux/printk.h': [('printk', True), ('pr_err', True)],
+            }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'file.c')
+            with open(fname, 'w') as fd:
+                fd.write('#include <common.h>\n#include <linux/bug.h>\n'
+                         '/* #include <linux/printk.h> */\n'
+                         '#include <linux/printk.h>\n\nint f(void)\n{\n'
+                         '\tpr_err("BUG()");\n}\n')
+            self.assertEqual(['linux/bug.h'], find_unused(fname, provides))
+            self.assertEqual(['linux/bug.h'],
+                             find_unused(fname, provides, apply=True))
+            self.assertEqual([], find_unused(fname, provides))
+            with open(fname) as fd:
+                self.assertNotIn('linux/bug.h', fd.read())
+
+            # Other lines are left exactly as they are
+            fname = os.path.join(tmpdir, 'crlf.c')
+            with open(fname, 'wb') as fd:
+                fd.write(b'#include <common.h>\r\n#include <linux/bug.h>\r\n'
+                         b'/* \xa9 2020 */\r\nint f(void)\r\n{\r\n}')
+            self.assertEqual(['linux/bug.h'],
+                             find_unused(fname, provides, apply=True))
+            with open(fname, 'rb') as fd:
+                self.assertEqual(b'#include <common.h>\r\n/* \xa9 2020 */\r\n'
+                                 b'int f(void)\r\n{\r\n}', fd.read())
+
+        graph = IncludeGraph()
+        graph.set_files({
+            'include/common.h': ((False, 'linux/types.h', False),),
+            'include/linux/types.h': (),
+            'include/linux/bug.h': ((False, 'linux/types.h', False),),
+            'include/linux/kernel.h': ((False, 'linux/bug.h', False),),
+            'drivers/a.c': ((False, 'common.h', False),
+                            (False, 'linux/bug.h', False)),
+            'drivers/b.c': ((False, 'linux/kernel.h', False),
+                            (False, 'linux/bug.h', False)),
+            })
+        sizes = {'include/common.h': 100, 'include/linux/types.h': 200,
+                 'include/linux/bug.h': 400, 'include/linux/kernel.h': 800}
+        self.assertEqual(400, estimate_saving(graph, 'drivers/a.c',
+                                              'linux/bug.h', sizes))
+        self.assertEqual(0, estimate_saving(graph, 'drivers/b.c',
+                                            'linux/bug.h', sizes))
+        # linux/bug.h is still included directly
+        self.assertEqual(800, estimate_saving(graph, 'drivers/b.c',
+                                              'linux/kernel.h', sizes))
+
+    def testJournal(self):
+        """Check recording and resuming sharded runs"""
+        fnames = ['a.c', 'drivers/net/a.c', 'drivers/net/phy/b.c',
+                  'drivers/core/c.c', 'drivers/net/d.c']
+        shards = shard_files(fnames)
+        self.assertEqual(['.', 'drivers/core', 'drivers/net'], list(shards))
+        self.assertEqual(['drivers/net/a.c', 'drivers/net/phy/b.c',
+                          'drivers/net/d.c'], shards['drivers/net'])
+
+        # Each shard is handled by exactly one worker
+        for shard in shards:
+            self.assertTrue(in_shard_set(shard, None))
+            self.assertEqual(1, len([index for index in range(3)
+                                     if in_shard_set(shard, (index, 3))]))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            first = os.path.join(tmpdir, 'first')
+            second = os.path.join(tmpdir, 'second')
+            journal = Journal([first])
+            self.assertEqual({}, journal.load('key'))
+            journal.record('key', '.', [('a.c', [('linux/bug.h', 'oops')])])
+            journal.record('other', 'drivers/core', [])
+            with open(first, 'a') as fd:
+                fd.write('{"key": "key", "shard": "drivers/net", "res')
+            self.assertEqual({'.': [('a.c', [('linux/bug.h', 'oops')])]},
+                             journal.load('key'))
+
+            Journal([second]).record('key', 'drivers/core',
+                                     [('drivers/core/c.c', [])])
+            self.assertEqual(['.', 'drivers/core'],
+                             sorted(Journal([first, second]).load('key')))
+
+    def testJournalCommit(self):
+        """Check that a run building a commit resumes from its last commit"""
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            try:
+                make_tree(tmpdir, 20)
+                os.chdir(tmpdir)
+                command.Output('git', 'config', 'user.name', 'Test')
+                command.Output('git', 'config', 'user.email', 'test@test')
+                head = command.Output('git', 'rev-parse', 'HEAD').strip()
+                fname = os.path.join('.git', 'journal')
+                opts = Options(journal=Journal([fname]),
+                               store=GitStore('Add headers'))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    run_recipes(get_convs(['bug']), opts)
+                opts.store.close()
+                with open(fname) as fd:
+                    entries = [json.loads(line) for line in fd]
+                commit = entries[-1]['commit']
+                self.assertEqual(commit, Journal([fname]).get_commit(
+                    entries[-1]['key']))
+                self.assertNotEqual(head, commit)
+                self.assertIn('#include <linux/bug.h>', command.Output(
+                    'git', 'show', commit))
+
+                # A resumed run carries on from that commit, not HEAD
+                opts = Options(journal=Journal([fname]),
+                               store=GitStore('Add headers'))
+                with contextlib.redirect_stdout(io.StringIO()) as out:
+                    run_recipes(get_convs(['bug']), opts)
+                opts.store.close()
+                self.assertIn('Resumed after', out.getvalue())
+                self.assertEqual(commit, opts.store.head)
+
+                # A different set of paths is a different run
+                opts.paths = ['drivers/a.c']
+                self.assertNotEqual(get_run_key([], opts),
+                                    get_run_key([], Options()))
+            finally:
+                os.chdir(cwd)
+
+    def testKconfig(self):
+        """Check working out which parts of a file are used with a config"""
+        config = {'CONFIG_DM': 'y', 'CONFIG_SYS_HZ': '1000'}
+
+        def check(expect, cond):
+            args = get_line_info(lex('#if ' + cond), 1)[0].args
+            self.assertEqual(expect,
+                             eval_condition(parse_condition(args), config))
+
+        check(True, 'defined(CONFIG_DM)')
+        check(True, 'CONFIG_IS_ENABLED(DM) && !defined(CONFIG_X)')
+        check(True, 'CONFIG_SYS_HZ == 1000')
+        check(False, 'CONFIG_SYS_HZ > 1000 || IS_ENABLED(CONFIG_X)')
+        check(True, 'defined(FOO) || CONFIG_DM')
+        check(False, 'defined(FOO) && CONFIG_X')
+        check(None, 'defined(FOO) && CONFIG_DM')
+        check(None, 'FOO(1)')
+
+        # CONFIG_IS_ENABLED() depends on the phase when SPL is built
+        config['CONFIG_SPL'] = 'y'
+        check(None, 'CONFIG_IS_ENABLED(DM)')
+        config['CONFIG_SPL_SERIAL'] = 'y'
+        check(None, 'CONFIG_IS_ENABLED(SERIAL)')
+        check(None, '!CONFIG_IS_ENABLED(SERIAL)')
+        config['CONFIG_SPL_DM'] = 'y'
+        check(True, 'CONFIG_IS_ENABLED(DM)')
+        check(False, 'CONFIG_IS_ENABLED(X)')
+        config = {'CONFIG_DM': 'y', 'CONFIG_SYS_HZ': '1000'}
+
+        data = '''#include <common.h>
+#if CONFIG_IS_ENABLED(DM)
+#include <dm.h>
+#else
+#include <x.h>
+#endif
+#ifdef CONFIG_X
+void g(void) { BUG(); }
+#elif defined(CONFIG_DM)
+void h(void) { }
+#endif
+
+void f(void) { }
+'''
+        kconfig = Kconfig([config])
+        infos = get_line_info(lex(data), data.count('\n'))
+        dead = kconfig.get_dead_lines(data, infos)
+        self.assertEqual(frozenset([4, 7]), dead)
+        self.assertIs(dead, kconfig.get_dead_lines(data, infos))
+
+        # With another config, the #if blocks may or may not be used
+        kconfig = Kconfig([config, {'CONFIG_X': 'y'}])
+        self.assertEqual(frozenset(), kconfig.get_dead_lines(data, infos))
+
+        # BUG() is only used in code which is not built
+        self.assertTrue(process_data(data, 'BUG(', 'linux/bug.h', True))
+        kconfig = Kconfig([config])
+        self.assertIsNone(process_data(data, 'BUG(', 'linux/bug.h', True,
+                                       kconfig=kconfig))
+
+        # The DM block is used with this config but not with every board, so
+        # the header must not go there
+        out = process_data(data, 'f(', 'linux/bug.h', True, kconfig=kconfig)
+        self.assertEqual(['#endif', '#include <linux/bug.h>', ''], out[10:13])
+
+    def testOutcomeCache(self):
+        """Check reusing the outcomes of a previous run"""
+        recipe = Recipe(Scanner([('BUG(', True)]), 'linux/bug.h', None, set())
+        files = {
+            'a.c': '#include <common.h>\n\nvoid f(void)\n{\n\tBUG();\n}\n',
+            'b.c': '#include <linux/bug.h>\n\nvoid f(void)\n{\n\tBUG();\n}\n',
+            'c.c': '#include "local.h"\n\nvoid f(void)\n{\n\tBUG();\n}\n',
+            }
+        fnames = sorted(files)
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            try:
+                os.chdir(tmpdir)
+                for fname, data in files.items():
+                    with open(fname, 'w') as fd:
+                        fd.write(data)
+                command.Output('git', 'init', '-q')
+                command.Output('git', 'add', '.')
+                func = functools.partial(process_file_multi, recipes=[recipe])
+
+                cache = OutcomeCache()
+                todo, cached = cache.lookup(fnames, [recipe])
+                self.assertEqual(fnames, todo)
+                self.assertEqual({}, cached)
+                cache.record(run_files(todo, func), [recipe])
+
+                # a.c was updated, so has no outcome
+                todo, cached = cache.lookup(fnames, [recipe])
+                self.assertEqual(['a.c'], todo)
+                self.assertEqual({'b.c': [],
+                                  'c.c': [('linux/bug.h',
+                                           'local include "local.h"')]},
+                                 cached)
+
+                # A different recipe needs its own outcomes
+                other = Recipe(Scanner([('BUG(', True)]), 'linux/bug.h',
+                               ['common.h'], set())
+                todo, cached = cache.lookup(fnames, [other])
+                self.assertEqual(fnames, todo)
+
+                # Changing a file drops its outcome
+                with open('b.c', 'a') as fd:
+                    fd.write('\n')
+                todo, cached = cache.lookup(fnames, [recipe])
+                self.assertEqual(['a.c', 'b.c'], todo)
+            finally:
+                os.chdir(cwd)
+
+    def testGitStore(self):
+        """Check writing changes through git, not to the working tree"""
+        recipe = Recipe(Scanner([('BUG(', True)]), 'linux/bug.h', None, set())
+        orig = '#include <common.h>\n\nvoid f(void)\n{\n\tBUG();\n}\n'
+        expect = ('#include <common.h>\n#include <linux/bug.h>\n\n'
+                  'void f(void)\n{\n\tBUG();\n}\n')
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            try:
+                os.chdir(tmpdir)
+                with open('a.c', 'w') as fd:
+                    fd.write(orig)
+                command.Output('git', 'init', '-q')
+                command.Output('git', 'config', 'user.name', 'Test')
+                command.Output('git', 'config', 'user.email', 'test@test')
+                command.Output('git', 'add', '.')
+                command.Output('git', 'commit', '-q', '-m', 'Initial')
+                head = command.Output('git', 'rev-parse', 'HEAD').strip()
+                with open('staged.c', 'w') as fd:
+                    fd.write('int staged;\n')
+                command.Output('git', 'add', 'staged.c')
+
+                # Build a commit, leaving the index and working tree alone
+                store = GitStore('Add header')
+                self.assertEqual([], process_file_multi('a.c', [recipe],
+                                                        store=store))
+                fnames, commit = store.commit()
+                store.close()
+                self.assertEqual(['a.c'], fnames)
+                self.assertEqual(expect, command.Output('git', 'show',
+                                                        commit + ':a.c'))
+                self.assertEqual(head, command.Output(
+                    'git', 'rev-parse', commit + '^').strip())
+                self.assertEqual('a.c\n', command.Output(
+                    'git', 'ls-tree', '--name-only', commit))
+                self.assertEqual('A  staged.c\n', command.Output(
+                    'git', 'status', '--porcelain'))
+
+                # Update the index
+                store = GitStore()
+                process_file_multi('a.c', [recipe], store=store)
+                fnames, commit = store.commit()
+                store.close()
+                self.assertEqual(['a.c'], fnames)
+                self.assertIsNone(commit)
+                self.assertEqual(expect, command.Output('git', 'show', ':a.c'))
+                with open('a.c') as fd:
+                    self.assertEqual(orig, fd.read())
+
+                # Remove unused #includes in the index
+                conv = HdrConv()
+                conv.set_hdr('linux/bug.h')
+                conv.add_funcs('WARN_ON')
+                graph = IncludeGraph()
+                graph.set_files({'a.c': ((False, 'common.h', False),
+                                         (False, 'linux/bug.h', False))})
+                opts = Options(store=GitStore(), graph=graph)
+                try:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        removals = run_unused([conv], opts, True)
+                finally:
+                    opts.store.close()
+                self.assertEqual([('a.c', 'linux/bug.h', 0)], removals)
+                self.assertEqual(orig, command.Output('git', 'show', ':a.c'))
+                with open('a.c') as fd:
+                    self.assertEqual(orig, fd.read())
+            finally:
+                os.chdir(cwd)
+
+    def testBuiltFiles(self):
+        """Check finding the files which are built"""
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            top = os.path.join(tmpdir, 'src')
+            build = os.path.join(tmpdir, 'build')
+            os.makedirs(os.path.join(top, 'drivers'))
+            os.makedirs(os.path.join(build, 'drivers'))
+            with open(os.path.join(build, 'drivers', '.a.o.cmd'), 'w') as fd:
+                fd.write('cmd_drivers/a.o := gcc -c -o drivers/a.o '
+                         'drivers/a.c\n\nsource_drivers/a.o := %s\n\n'
+                         'deps_drivers/a.o := \\\n  include/common.h \\\n' %
+                         os.path.join(top, 'drivers/a.c'))
+            with open(os.path.join(build, 'drivers', '.b.o.cmd'), 'w') as fd:
+                fd.write('source_drivers/b.o := drivers/b.c\n')
+            with open(os.path.join(build, 'drivers', 'c.o'), 'w') as fd:
+                fd.write('source_drivers/c.o := drivers/c.c\n')
+            json_fname = os.path.join(tmpdir, 'compile_commands.json')
+            with open(json_fname, 'w') as fd:
+                json.dump([{'directory': top, 'file': 'drivers/d.c',
+                            'command': 'gcc -c drivers/d.c'},
+                           {'directory': tmpdir, 'file': 'other/e.c',
+                            'command': 'gcc -c other/e.c'}], fd)
+            try:
+                os.chdir(top)
+                built = get_built_files([build, json_fname])
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(frozenset(['drivers/a.c', 'drivers/b.c',
+                                    'drivers/d.c']), built)
+        self.assertEqual((['drivers/a.c', 'include/x.h'], ['drivers/c.c']),
+                         split_built(['drivers/a.c', 'drivers/c.c',
+                                      'include/x.h'], built))
+        self.assertEqual((['drivers/c.c'], []),
+                         split_built(['drivers/c.c'], None))
+
+    def testHeaderCosts(self):
+        """Check working out the compile cost of headers"""
+        self.assertEqual('asm/io.h', get_hdr_name('arch/arm/include/asm/io.h'))
+        self.assertEqual('common.h', get_hdr_name('include/common.h'))
+        self.assertEqual('drivers/local.h', get_hdr_name('drivers/local.h'))
+
+        sizes = {'include/common.h': 100, 'include/linux/types.h': 200,
+                 'include/linux/bug.h': 400, 'arch/arm/include/asm/io.h': 800,
+                 'drivers/local.h': 1600}
+        traces = {
+            'drivers/a.c': [(1, 'include/common.h'),
+                            (2, 'include/linux/types.h'),
+                            (1, 'include/linux/bug.h'),
+                            (1, 'drivers/local.h'),
+                            (2, 'arch/arm/include/asm/io.h')],
+            'drivers/b.c': [(1, 'include/linux/bug.h'),
+                            (2, 'include/linux/types.h')],
+            }
+        costs = get_header_costs(traces, sizes)
+        self.assertEqual({'bytes': 1000, 'includes': 2, 'direct': 2},
+                         costs['linux/bug.h'])
+        self.assertEqual({'bytes': 300, 'includes': 1, 'direct': 1},
+                         costs['common.h'])
+        self.assertEqual({'bytes': 400, 'includes': 2},
+                         costs['linux/types.h'])
+        self.assertEqual({'bytes': 2400, 'includes': 1, 'direct': 1},
+                         costs['drivers/local.h'])
+        self.assertEqual({'bytes': 800, 'includes': 1}, costs['asm/io.h'])
+
+    def testProfile(self):
+        """Check the counters and timings recorded when profiling"""
+        recipes = [
+            Recipe(Scanner([('BUG(', True), ('WARN(', True)]), 'linux/bug.h',
+                   None, set()),
+            Recipe(Scanner([('printk', True)]), 'linux/printk.h', None,
+                   set())]
+        files = {
+            'a.c': '#include <common.h>\n\nvoid f(void)\n{\n\tBUG();\n}\n',
+            'b.c': '#include <common.h>\n\nvoid f(void)\n{\n\tPRBUG();\n}\n',
+            'c.c': '#include <common.h>\n/* BUG() */\n#include <linux/printk.h>'
+                   '\nvoid f(void)\n{\n\tprintk("x");\n}\n',
+            }
+        prof = Profile()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for fname, data in sorted(files.items()):
+                path = os.path.join(tmpdir, fname)
+                with open(path, 'w') as fd:
+                    fd.write(data)
+                msgs, file_prof = profile_file(path, recipes)
+                self.assertEqual([], msgs)
+                prof.merge(file_prof)
+        report = prof.get_report(2)
+        self.assertEqual({'examined': 3, 'fragment_reject': 2, 'rewritten': 1},
+                         report['items']['BUG('])
+        self.assertEqual({'examined': 3, 'fast_reject': 3},
+                         report['items']['WARN('])
+        self.assertEqual({'examined': 3, 'fast_reject': 2, 'skip_if': 1},
+                         report['items']['printk'])
+        self.assertEqual(3, report['totals']['files_examined'])
+        self.assertEqual(1, report['totals']['files_rewritten'])
+        self.assertEqual(2, len(report['slowest']))
+        for stage in ['read', 'scan', 'process_data', 'lex', 'fragment',
+                      'placement', 'write']:
+            self.assertIn(stage, report['stages'])
+            self.assertIn(stage, report['summed'])
+        self.assertGreater(report['wall'], 0)
+
+        # Stages timed in this process are elapsed time, not summed
+        with timer(prof, 'files'):
+            pass
+        self.assertNotIn('files', prof.get_report()['summed'])
+
+    def testBench(self):
+        """Check the benchmark runs on a small synthetic tree"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fnames = make_tree(os.path.join(tmpdir, 'a'), 10)
+            self.assertIn('include/linux/bug.h', fnames)
+            self.assertIn('drivers/misc0/local.h', fnames)
+            self.assertEqual(fnames, make_tree(os.path.join(tmpdir, 'b'), 10))
+            with open(os.path.join(tmpdir, 'a', fnames[0])) as fd:
+                data = fd.read()
+            with open(os.path.join(tmpdir, 'b', fnames[0])) as fd:
+                self.assertEqual(data, fd.read())
+
+        cwd = os.getcwd()
+        result = run_bench(10, ['bug', 'printk'])
+        self.assertEqual(cwd, os.getcwd())
+        self.assertEqual(['process_data', 'process_file', 'run'],
+                         sorted(result['stages']))
+        for stage in result['stages'].values():
+            # 10 C files, include/hdr0.h and two local.h files
+            self.assertEqual(13, stage['files'])
+            self.assertGreater(stage['mb_per_sec'], 0)
+
 
 def process_files_from(list_fname, insert_hdr):
     with open(list_fname) as fd:
@@ -1541,17 +6190,383 @@ def kernel_types(hdr):
     hdr.skip_if(['linux/types.h'])
     hdr.add_text('u8,u16,u32')
 
+# Recipes which can be selected with -r
+RECIPES = {
+    'bug': bug,
+    'global_data': global_data,
+    'display_options': display_options,
+    'printk': printk,
+    'time': time,
+    'string': string,
+    'uboot': uboot,
+    'stdio': stdio,
+    'stdarg': stdarg,
+    'vsprintf': vsprintf,
+    'errno': errno,
+    'kernel': kernel,
+    'compiler': compiler,
+    'bool': bool,
+    'types': types,
+    'asm_types': asm_types,
+    'kernel_types': kernel_types,
+    }
+
 #def asm_global_data(hdr):
     #hdr.set_hdr('asm/global_data.h')
     #hdr.add_text('GD_FLG,gd->,gd_board_type')
 
 
+# Pieces used to build the synthetic tree for the benchmark. These are taken
+# from the cases in the Tests class, so that the benchmark exercises the same
+# paths through process_data() as real U-Boot code.
+BENCH_HEADS = [
+    '#include <common.h>\n#include <dm.h>\n#include <linux/types.h>\n',
+    '#ifndef __UBOOT__\n#include <sys/types.h>\n#else\n#include <common.h>\n'
+        '#include <stdio.h>\n#endif\n',
+    '#ifdef __UBOOT__\n#include <common.h>\n#include <stdio.h>\n#else\n'
+        '#include <sys/types.h>\n#endif\n',
+    '#include <common.h>\n#include <stdio.h>\n#include "local.h"\n',
+    '#include "local.h"\n',
+    '/* some other badly formatted comment\n */\n\n'
+        '#define VIRTIO_ID_NET\t\t1 /* virtio net */\n',
+    '#include <common.h>\n#if CONFIG_IS_ENABLED(OF_CONTROL)\n'
+        '#include <fdtdec.h>\n#endif\n',
+    '#include <common.h>\n#include <asm/io.h> /* for readl() */\n'
+        '#define LOG_CATEGORY\tUCLASS_MISC \\\n\t\t\t| 0x100\n',
+    ]
+
+BENCH_USES = [
+    '\tBUG();\n',
+    '\tWARN_ON(val < 0);\n',
+    '\tPRBUG(val);\n',
+    '\t/* BUG() is not called here */\n',
+    '\tprintf("/* BUG() */");\n',
+    '\tprintk(KERN_INFO "val %d\\n", val);\n',
+    '\tgd->flags |= GD_FLG_RELOC;\n',
+    '\tpr_err("bad value\\n");\n',
+    ]
+
+BENCH_FUNC = '''
+/**
+ * %(name)s() - Work out something from a value
+ *
+ * @val: Value to use
+ * Return: new value, or -EINVAL if @val is out of range
+ */
+static int %(name)s(int val)
+{
+	int ret = val * %(mult)d;
+
+%(use)s
+	if (ret < 0)
+		return -EINVAL;
+
+	return ret;
+}
+'''
+
+
+def make_tree(dirname, num_files, seed=0):
+    """Create a synthetic U-Boot-like source tree for benchmarking
+
+    The tree is a git repo with a mix of C files and headers, the headers
+    having include guards and __ASSEMBLY__ blocks. The same seed always
+    produces the same tree.
+
+    Args:
+        dirname: Directory to create the tree in
+        num_files: Number of C files to create (about a tenth as many headers
+            are created too)
+        seed: Seed for the random-number generator
+
+    Returns:
+        Sorted list of filenames in the tree, relative to dirname
+    """
+    rand = random.Random(seed)
+    files = {}
+    files['include/linux/bug.h'] = (
+        '#ifndef _LINUX_BUG_H\n#define _LINUX_BUG_H\n\n'
+        '#define BUG() do { } while (0)\n\n#endif\n')
+    for seq in range(max(1, num_files // 10)):
+        if seq % 4 == 3:
+            fname = 'arch/arm/include/asm/arch%d.h' % seq
+        else:
+            fname = 'include/hdr%d.h' % seq
+        guard = '__HDR%d_H' % seq
+        body = ''.join([BENCH_FUNC % {'name': 'hdr%d_func%d' % (seq, num),
+                                      'mult': num,
+                                      'use': rand.choice(BENCH_USES)}
+                        for num in range(rand.randint(1, 4))])
+        files[fname] = ('/* SPDX-License-Identifier: GPL-2.0+ */\n'
+                        '#ifndef %s\n#define %s\n\n%s\n#ifndef __ASSEMBLY__\n'
+                        '%s\n#endif /* __ASSEMBLY__ */\n\n#endif\n' %
+                        (guard, guard, rand.choice(BENCH_HEADS), body))
+    for seq in range(num_files):
+        fname = 'drivers/misc%d/file%d.c' % (seq % 20, seq)
+        body = ''.join([BENCH_FUNC % {'name': 'func%d' % num, 'mult': num,
+                                      'use': rand.choice(BENCH_USES)}
+                        for num in range(rand.randint(5, 40))])
+        files[fname] = ('// SPDX-License-Identifier: GPL-2.0+\n'
+                        '/*\n * Copyright 2020 Google LLC\n */\n\n%s\n%s' %
+                        (rand.choice(BENCH_HEADS), body))
+        if seq % 5 == 0:
+            files[os.path.join(os.path.dirname(fname), 'local.h')] = (
+                '#include <linux/bug.h>\n')
+
+    for fname, data in files.items():
+        path = os.path.join(dirname, fname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fd:
+            fd.write(data)
+    command.Output('git', '-C', dirname, 'init', '-q')
+    command.Output('git', '-C', dirname, 'add', '.')
+    command.Output('git', '-C', dirname, '-c', 'user.name=bench', '-c',
+                   'user.email=bench@example.com', 'commit', '-q', '-m',
+                   'Synthetic tree')
+    return sorted(files)
+
+
+def get_rate(secs, num_files, num_bytes):
+    """Get the timing results for a benchmark stage
+
+    Args:
+        secs: Time taken in seconds
+        num_files: Number of files processed
+        num_bytes: Total size of those files
+
+    Returns:
+        dict of results, suitable for writing as JSON
+    """
+    secs = max(secs, 1e-9)
+    return {
+        'secs': round(secs, 6),
+        'files': num_files,
+        'bytes': num_bytes,
+        'files_per_sec': round(num_files / secs, 1),
+        'mb_per_sec': round(num_bytes / secs / 1e6, 3),
+        }
+
+
+def run_bench(num_files, names, jobs=1, seed=0):
+    """Time hdr_include on a synthetic tree
+
+    Three stages are timed:
+        process_data: each recipe symbol on every file, in memory
+        process_file: the recipes on every file, including reading and
+            writing files
+        run: HdrConv.run() for each recipe, i.e. the whole conversion
+            including 'git grep'
+
+    Args:
+        num_files: Number of C files to put in the tree
+        names: List of recipe names, from RECIPES
+        jobs: Number of processes to use
+        seed: Seed to use to generate the tree
+
+    Returns:
+        dict of results, suitable for writing as JSON
+    """
+    convs = []
+    for name in names:
+        conv = HdrConv(Options(jobs))
+        RECIPES[name](conv)
+        convs.append(conv)
+    result = {'files': num_files, 'jobs': jobs, 'recipes': names,
+              'seed': seed, 'stages': {}}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tree = os.path.join(tmpdir, 'tree')
+        try:
+            fnames = make_tree(tree, num_files, seed)
+            os.chdir(tree)
+            contents = [(read_file(fname), fname) for fname in fnames]
+            contents = [(info, fname) for info, fname in contents if info]
+            fnames = [fname for _, fname in contents]
+            num_bytes = sum([len(info[0]) for info, _ in contents])
+
+            start = perf_counter()
+            for conv in convs:
+                for func, ignore_fragments in conv.get_items():
+                    for (data, is_hdr_file), _ in contents:
+                        process_data(data, func, conv.hdr, ignore_fragments,
+                                     is_hdr_file, conv.skip_if_hdrs)
+            result['stages']['process_data'] = get_rate(
+                perf_counter() - start, len(fnames), num_bytes)
+
+            recipes = [Recipe(Scanner(conv.get_items()), conv.hdr,
+                              conv.skip_if_hdrs, set()) for conv in convs]
+            func = functools.partial(process_file_multi, recipes=recipes)
+            start = perf_counter()
+            run_files(fnames, func, jobs)
+            result['stages']['process_file'] = get_rate(
+                perf_counter() - start, len(fnames), num_bytes)
+
+            # Put the tree back as it was, so HdrConv.run() has work to do
+            command.Output('git', 'checkout', '-q', '.')
+            start = perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for conv in convs:
+                    conv.run()
+            result['stages']['run'] = get_rate(
+                perf_counter() - start, len(fnames), num_bytes)
+        finally:
+            os.chdir(cwd)
+    return result
+
+
 def run_tests(args):
     sys.argv = [sys.argv[0]] + args
     unittest.main()
 
-def run_conversion():
-    hdr = HdrConv()
+def get_options(args):
+    """Set up the options for a conversion from the program arguments
+
+    Args:
+        args: Program arguments
+
+    Returns:
+        Options object
+    """
+    opts = Options(args.jobs)
+    if args.profile:
+        opts.profile = Profile()
+    if args.index:
+        with timer(opts.profile, 'index'):
+            opts.index = get_index(args.jobs)
+    if args.graph:
+        with timer(opts.profile, 'graph_load'):
+            opts.graph = get_include_graph(args.jobs)
+    if args.since:
+        opts.paths = changed_files(args.since)
+    if args.built:
+        opts.built = get_built_files(args.built)
+    if args.kconfig:
+        opts.kconfig = Kconfig([read_config(fname) for fname in args.kconfig])
+    if args.outcomes:
+        opts.outcomes = get_outcome_cache(opts.kconfig)
+    if args.journal:
+        opts.journal = Journal(args.journal)
+    if args.shard:
+        index, count = args.shard.split('/')
+        opts.shard_set = (int(index), int(count))
+    if args.git_index or args.commit:
+        opts.store = GitStore(args.commit)
+    return opts
+
+def write_profile(prof, fname, count=20):
+    """Write out a profile report and show the slowest files
+
+    Args:
+        prof: Profile to report
+        fname: Filename to write the JSON report to
+        count: Number of slowest files to show
+    """
+    report = prof.get_report(count)
+    with open(fname, 'w') as fd:
+        json.dump(report, fd, indent=4, sort_keys=True)
+    print('Wall time: %.3f s' % report['wall'])
+    print('Stages (cpu = summed across files, so CPU time with -j):')
+    for stage, secs in sorted(report['stages'].items(),
+                              key=lambda item: -item[1]):
+        cpu = ' (cpu)' if stage in report['summed'] else ''
+        print('%10.3f s  %s%s' % (secs, stage, cpu))
+    print('Slowest files:')
+    for fname, secs in report['slowest']:
+        print('%10.3f ms %s' % (secs * 1000, fname))
+
+def run_batch(args, names):
+    """Apply several recipes together, writing each file at most once
+
+    With -u this instead finds #includes of the recipes' headers which are not
+    needed.
+
+    Args:
+        args: Program arguments
+        names: List of recipe names, from RECIPES, or header names
+    """
+    opts = get_options(args)
+    try:
+        try:
+            convs = get_convs(names, args.jobs)
+        except ValueError as exc:
+            print(exc)
+            sys.exit(1)
+        if args.unused:
+            removals = run_unused(convs, opts, args.apply)
+            for fname, hdr, size in removals:
+                print('Unused %s: %s: %d bytes' % (fname, hdr, size))
+            print('%d unused, total %d bytes' %
+                  (len(removals), sum([size for _, _, size in removals])))
+            return
+        all_to_check = run_recipes(convs, opts)
+    finally:
+        if opts.store:
+            opts.store.close()
+    convs[0].report({}, all_to_check)
+    if opts.profile:
+        write_profile(opts.profile, args.profile)
+
+def run_cost(args, count=50):
+    """Show the headers which cost the most to compile across the tree
+
+    Args:
+        args: Program arguments
+        count: Number of headers to show
+    """
+    settings = (os.environ.get('CC', 'gcc'), args.arch,
+                tuple(args.cflags.split()))
+    costs = get_costs(args.jobs, settings)
+    recipe_of = {}
+    for name in sorted(RECIPES):
+        hdr = HdrConv()
+        RECIPES[name](hdr)
+        recipe_of.setdefault(hdr.hdr, name)
+    print('%12s %8s %8s  %-30s %s' % ('Bytes', 'Includes', 'Direct', 'Header',
+                                     'Recipe'))
+    for name, cost in sorted(costs.items(),
+                             key=lambda item: (-item[1]['bytes'], item[0]))[
+                                 :count]:
+        print('%12d %8d %8d  %-30s %s' % (cost['bytes'], cost['includes'],
+                                         cost['direct'], name,
+                                         recipe_of.get(name, '')))
+
+def run_rename(args):
+    """Rename #includes across the tree, as given by the -R option
+
+    Args:
+        args: Program arguments
+    """
+    renames = []
+    for rename in args.rename:
+        if ':' not in rename:
+            print("Invalid rename '%s': use OLD:NEW, e.g. "
+                  "asm/u-boot.h:asm/global_data.h" % rename)
+            sys.exit(1)
+        renames.append(tuple(rename.split(':', 1)))
+    opts = get_options(args)
+    try:
+        changed = run_renames(renames, opts)
+    finally:
+        if opts.store:
+            opts.store.close()
+    print('Renamed in %d files: %s' % (len(changed), ' '.join(changed)))
+
+def run_daemon(args):
+    """Run as a daemon, handling requests sent with -q
+
+    Args:
+        args: Program arguments
+    """
+    daemon = Daemon(get_options(args))
+    print("Listening on '%s'" % args.daemon, flush=True)
+    try:
+        daemon.serve(args.daemon)
+    except KeyboardInterrupt:
+        pass
+
+def run_conversion(args):
+    opts = get_options(args)
+    hdr = HdrConv(opts)
     #bug(hdr)
     #asm_offsets(hdr)
     #stringify(hdr)
@@ -1596,29 +6611,119 @@ def run_conversion():
     kernel_types(hdr)
     hdr.run()
     '''
-    hdr = HdrConv()
+    hdr = HdrConv(opts)
     global_data(hdr)
-    hdr.run()
+    try:
+        hdr.run()
+    finally:
+        if opts.store:
+            opts.store.close()
+    if opts.profile:
+        write_profile(opts.profile, args.profile)
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
 
+    parser.add_argument('-A', '--arch', type=str, default='sandbox',
+                        help='With -c, arch to use for files outside arch/')
+    parser.add_argument('-a', '--apply', action='store_true', default=False,
+                        help='With -u, remove the unused #includes')
+    parser.add_argument('-b', '--built', type=str, action='append',
+                        help='Only process C files built according to a '
+                        'compile_commands.json file or a build directory '
+                        '(may be given more than once)')
+    parser.add_argument('-B', '--bench', type=int, metavar='FILES',
+                        help='Run a benchmark on a synthetic tree of FILES '
+                        'C files, writing the results as JSON')
+    parser.add_argument('-c', '--cost', action='store_true', default=False,
+                        help='Rank headers by the bytes they add to compiles')
+    parser.add_argument('-C', '--cflags', type=str, default='',
+                        help='With -c, extra flags to pass to the compiler')
+    parser.add_argument('-d', '--daemon', type=str, metavar='SOCKET',
+                        help='Run as a daemon which watches the tree and '
+                        'handles requests from -q on a Unix socket')
+    parser.add_argument('-g', '--graph', action='store_true', default=False,
+                        help='Skip files which include the header indirectly')
+    parser.add_argument('-I', '--git-index', action='store_true',
+                        default=False,
+                        help='Write changes to the git index, leaving the '
+                        'working tree alone')
     parser.add_argument('-i', '--insert', type=str,
                         help='Insert header in a list of files')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes to use (0 for one per CPU)')
+    parser.add_argument('-J', '--journal', type=str, action='append',
+                        help='Record completed shards in a journal, so an '
+                        'interrupted run can be resumed; more journals may be '
+                        'given to merge the results of several workers')
+    parser.add_argument('-k', '--kconfig', type=str, action='append',
+                        help='Ignore code which is not used with any of the '
+                        'given board .config files (may be given more than '
+                        'once)')
+    parser.add_argument('-m', '--commit', type=str, metavar='MSG',
+                        help='Write changes to a new commit on top of HEAD, '
+                        'leaving the index and working tree alone')
+    parser.add_argument('-o', '--outcomes', action='store_true',
+                        default=False,
+                        help='Reuse the outcome for files which have not '
+                        'changed since a previous run')
+    parser.add_argument('-P', '--profile', type=str, metavar='JSON',
+                        help='Record timings and counters, writing a report '
+                        'to JSON')
+    parser.add_argument('-q', '--query', type=str, metavar='SOCKET',
+                        help='Send the recipes to a daemon started with -d')
+    parser.add_argument('-r', '--recipes', type=str,
+                        help='Comma-separated list of recipes to apply together; '
+                        'a header name (e.g. linux/bitops.h) uses the '
+                        'declarations in that header')
+    parser.add_argument('-R', '--rename', type=str, action='append',
+                        metavar='OLD:NEW',
+                        help='Rename an #include across the tree, keeping '
+                        'the #includes sorted (may be given more than once)')
+    parser.add_argument('-S', '--shard', type=str, metavar='I/N',
+                        help='With -J, only process shard set I of N '
+                        '(counting from 0)')
+    parser.add_argument('-s', '--since', type=str,
+                        help='Only process files changed since a revision, '
+                        'including uncommitted and untracked files')
     parser.add_argument('-t', '--test', action='store_true', default=False,
                         help='run tests')
+    parser.add_argument('-u', '--unused', action='store_true', default=False,
+                        help="Find #includes of the recipes' headers which "
+                        'are not used')
+    parser.add_argument('-x', '--index', action='store_true', default=False,
+                        help='Use a persistent identifier index, not git grep')
     parser.add_argument('files', nargs='*')
     args = parser.parse_args()
     opt = None
+    if not args.jobs:
+        args.jobs = multiprocessing.cpu_count()
     if args.test:
         run_tests(sys.argv[2:])
+    elif args.daemon:
+        run_daemon(args)
+    elif args.query:
+        names = args.recipes.split(',') if args.recipes else ['bug']
+        print(query_daemon(args.query, names), end='')
+    elif args.cost:
+        run_cost(args)
+    elif args.bench:
+        names = args.recipes.split(',') if args.recipes else ['bug']
+        result = run_bench(args.bench, names, args.jobs)
+        print(json.dumps(result, indent=4, sort_keys=True))
+    elif args.rename:
+        run_rename(args)
     elif args.insert:
         hdr = HdrConv()
         hdr.set_hdr(args.insert)
         hdr.insert(args.files)
+    elif args.recipes:
+        run_batch(args, args.recipes.split(','))
+    elif args.unused:
+        run_batch(args, sorted(RECIPES))
     else:
-        run_conversion()
+        run_conversion(args)
 
 #all = 'BUG,BUG_ON,WARN,WARN_ON,WARN_ON_ONCE,WARN_ONCE'
 #for item in all.split(','):